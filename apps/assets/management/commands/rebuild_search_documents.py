@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from assets.models import Item, update_search_documents
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search document of every asset.  Run it once after upgrading an existing database, it adds the missing search_document column first.'
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        if self.add_column():
+            self.stdout.write('Added the search_document column to the %s table.\n' % Item._meta.db_table)
+
+        pks = list(Item.objects.values_list('pk', flat=True))
+        update_search_documents(pks)
+        self.stdout.write('Rebuilt the search document of %s assets.\n' % len(pks))
+
+    def add_column(self):
+        """
+        Adds the column syncdb doesn't add to an existing table, returns
+        False if it is already there
+        """
+        field = Item._meta.get_field('search_document')
+        cursor = connection.cursor()
+        if field.column in [row[0] for row in connection.introspection.get_table_description(cursor, Item._meta.db_table)]:
+            return False
+
+        qn = connection.ops.quote_name
+        # MySQL can't give text columns a default, it fills in the
+        # existing rows with an empty string anyway
+        default = not settings.DATABASES['default']['ENGINE'].endswith('mysql') and " DEFAULT ''" or ''
+        cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL%s' % (qn(Item._meta.db_table), qn(field.column), field.db_type(connection=connection), default))
+        transaction.set_dirty()
+        return True
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -6,7 +7,9 @@ from django.contrib.auth.models import User, UserManager
 
 from photos.models import GenericPhoto
 
-from dynamic_search.api import register
+from common.api import register_list_relations
+from common.db import bulk_update
+from dynamic_search.api import register, objects_changed
 from inventory.models import ItemTemplate, Location
 
 class State(models.Model):
@@ -49,6 +52,18 @@ class ItemState(models.Model):
         return ('state_update', [str(self.id)])
 
 
+class SearchDocumentField(models.TextField):
+    """
+    Text of an asset and of its related objects, filled in whenever the
+    asset is written: by save() as well as by common.db.bulk_insert and
+    bulk_update, so assets can still be imported in bulk
+    """
+    def pre_save(self, model_instance, add):
+        value = model_instance.get_search_document()
+        setattr(model_instance, self.attname, value)
+        return value
+
+
 class Item(models.Model):
     item_template = models.ForeignKey(ItemTemplate, verbose_name=_(u"item template"))
     property_number = models.CharField(verbose_name=_(u"asset number"), max_length=48)
@@ -56,6 +71,9 @@ class Item(models.Model):
     serial_number = models.CharField(verbose_name=_(u"serial number"), max_length=48, null=True, blank=True)
     location = models.ForeignKey(Location, verbose_name=_(u"location"), null=True, blank=True)
     active = models.BooleanField(default=True)
+    #Text of the asset, its template, location and owners, searched
+    #instead of joining those tables
+    search_document = SearchDocumentField(editable=False, blank=True, default=u'')
 
     class Meta:
         ordering = ['property_number']
@@ -67,10 +85,34 @@ class Item(models.Model):
         return ('item_view', [str(self.id)])
 
     def __unicode__(self):
-        states = ', '.join([itemstate.state.name for itemstate in ItemState.objects.states_for_item(self)])
+        states = ', '.join(self.get_state_names())
 
         return "#%s, '%s' %s" % (self.property_number, self.item_template.description, states and "(%s)" % states)
 
+    def get_state_names(self):
+        if hasattr(self, '_state_names_cache'):
+            return self._state_names_cache
+        return ItemState.objects.states_for_item(self).order_by('pk').values_list('state__name', flat=True)
+
+    def get_search_document(self):
+        """
+        Uses the template and location already loaded (by a form, the
+        importer or select_related) and the owner names set by
+        update_search_documents, if any
+        """
+        owners = getattr(self, '_search_document_owners', None)
+        if owners is None:
+            owners = self.pk and self.person_set.values_list(*OWNER_NAME_FIELDS) or []
+
+        values = [self.property_number, self.serial_number, self.notes]
+        if self.item_template_id:
+            values.append(self.item_template.description)
+        if self.location_id:
+            values.append(self.location.name)
+        for owner in owners:
+            values.extend(owner)
+        return u' '.join([unicode(value) for value in values if value])
+
     def is_orphan(self):
         if self.person_set.all():
             return False
@@ -147,7 +189,96 @@ class Person(models.Model):
         return "%s%s, %s%s" % (self.last_name, second_last_name and second_last_name, self.first_name, second_name)
 
 
+OWNER_NAME_FIELDS = ['first_name', 'second_name', 'last_name', 'second_last_name']
+#Keep the IN clauses below the SQLite bound parameters limit
+SEARCH_DOCUMENT_CHUNK_SIZE = 500
+
+
+def update_search_documents(pks):
+    """
+    Rebuilds the search document of the given assets after a change of
+    their owners, template or location
+    """
+    pks = list(pks)
+    for start in range(0, len(pks), SEARCH_DOCUMENT_CHUNK_SIZE):
+        chunk = pks[start:start + SEARCH_DOCUMENT_CHUNK_SIZE]
+        owners = {}
+        for row in Person.inventory.through.objects.filter(item__in=chunk).values_list('item', *['person__%s' % name for name in OWNER_NAME_FIELDS]):
+            owners.setdefault(row[0], []).append(row[1:])
+
+        changed = []
+        for item in Item.objects.filter(pk__in=chunk).select_related('item_template', 'location'):
+            item._search_document_owners = owners.get(item.pk, [])
+            if item.get_search_document() != item.search_document:
+                changed.append(item)
+        bulk_update(Item, changed, ['search_document'])
+
+    if pks:
+        objects_changed(Item, pks)
+
+
+def prefetch_item_states(items):
+    """
+    Fetches the state names shown by the text of a page of assets with
+    a single query
+    """
+    names = dict([(item.pk, []) for item in items])
+    for item_id, name in ItemState.objects.filter(item__in=names.keys()).order_by('pk').values_list('item', 'state__name'):
+        names[item_id].append(name)
+    for item in items:
+        item._state_names_cache = names[item.pk]
+
+
+def prefetch_item_state_items(item_states):
+    prefetch_item_states([item_state.item for item_state in item_states])
+
+
+def person_saved(sender, instance, created, **kwargs):
+    if not created:
+        update_search_documents(instance.inventory.values_list('pk', flat=True))
+
+
+def person_pre_delete(sender, instance, **kwargs):
+    instance._search_document_items = list(instance.inventory.values_list('pk', flat=True))
+
+
+def person_deleted(sender, instance, **kwargs):
+    update_search_documents(getattr(instance, '_search_document_items', []))
+
+
+def owners_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if reverse:
+        # Changed from the asset's side, ie: item.person_set.add(person)
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            update_search_documents([instance.pk])
+    elif action == 'pre_clear':
+        instance._search_document_items = list(instance.inventory.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        update_search_documents(getattr(instance, '_search_document_items', []))
+    elif action in ('post_add', 'post_remove'):
+        update_search_documents(pk_set)
+
+
+def template_saved(sender, instance, created, **kwargs):
+    if not created:
+        update_search_documents(Item.objects.filter(item_template=instance).values_list('pk', flat=True))
+
+
+def location_saved(sender, instance, created, **kwargs):
+    if not created:
+        update_search_documents(Item.objects.filter(location=instance).values_list('pk', flat=True))
+
+post_save.connect(person_saved, sender=Person)
+pre_delete.connect(person_pre_delete, sender=Person)
+post_delete.connect(person_deleted, sender=Person)
+m2m_changed.connect(owners_changed, sender=Person.inventory.through)
+post_save.connect(template_saved, sender=ItemTemplate)
+post_save.connect(location_saved, sender=Location)
+
 register(ItemState, _(u'states'), ['state__name'])
-register(Item, _(u'assets'), ['property_number', 'notes', 'serial_number', 'person__first_name', 'person__last_name', 'person__second_last_name', 'person__second_name'])
+register(Item, _(u'assets'), [('property_number', 10), ('serial_number', 10), 'search_document'])
 register(ItemGroup, _(u'asset groups'), ['name'])
 register(Person, _(u'people'), ['last_name', 'second_last_name', 'first_name', 'second_name', 'location__name'])
+
+register_list_relations(Item, ['item_template'], prefetch_item_states)
+register_list_relations(ItemState, ['item__item_template', 'state'], prefetch_item_state_items)
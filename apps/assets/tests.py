@@ -5,7 +5,20 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from common.db import bulk_insert
+from dynamic_search.api import get_backend
+from importer.api import has_save_hooks
+from inventory.models import ItemTemplate, Location
+
+from assets.models import Item, Person
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +27,71 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class SearchDocumentTestMixin(object):
+    def setUp(self):
+        self.template = ItemTemplate.objects.create(description=u'Laptop')
+        self.location = Location.objects.create(name=u'Depot')
+        self.item = Item.objects.create(item_template=self.template, property_number=u'A1', serial_number=u'S9', location=self.location)
+
+    def get_document(self, item=None):
+        return Item.objects.get(pk=(item or self.item).pk).search_document
+
+    def count_queries(self, function, *args):
+        debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            function(*args)
+            return len(connection.queries)
+        finally:
+            settings.DEBUG = debug
+
+
+class SearchDocumentTest(SearchDocumentTestMixin, TestCase):
+    def test_follows_the_related_objects(self):
+        self.assertEqual(self.get_document(), u'A1 S9 Laptop Depot')
+        person = Person.objects.create(first_name=u'Ann', last_name=u'Lee')
+        person.inventory.add(self.item)
+        self.assertEqual(self.get_document(), u'A1 S9 Laptop Depot Ann Lee')
+
+        person.first_name = u'Anna'
+        person.save()
+        self.template.description = u'Notebook'
+        self.template.save()
+        self.location.name = u'Store'
+        self.location.save()
+        self.assertEqual(self.get_document(), u'A1 S9 Notebook Store Anna Lee')
+
+        person.delete()
+        self.assertEqual(self.get_document(), u'A1 S9 Notebook Store')
+
+    def test_bulk_inserts_fill_it_in(self):
+        if not get_backend().indexed:
+            self.assertFalse(has_save_hooks(Item))
+        bulk_insert(Item, [Item(item_template=self.template, property_number=u'B%d' % number) for number in range(3)])
+        self.assertEqual(list(Item.objects.filter(property_number__startswith=u'B').values_list('search_document', flat=True)), [u'B0 Laptop', u'B1 Laptop', u'B2 Laptop'])
+
+    def test_loaded_relations_are_not_fetched_again(self):
+        # Only the INSERT
+        self.assertEqual(self.count_queries(Item(item_template=self.template, location=self.location, property_number=u'C1').save), 1)
+
+
+class RebuildSearchDocumentsTest(SearchDocumentTestMixin, TransactionTestCase):
+    """
+    SQLite commits the open transaction before altering a table
+    """
+    def test_rebuild_adds_the_missing_column(self):
+        connection.cursor().execute('ALTER TABLE %s DROP COLUMN search_document' % Item._meta.db_table)
+        stdout = StringIO()
+        call_command('rebuild_search_documents', stdout=stdout)
+        self.assertTrue('Added the search_document column' in stdout.getvalue())
+        self.assertEqual(self.get_document(), u'A1 S9 Laptop Depot')
+
+        call_command('rebuild_search_documents', stdout=stdout)
+        self.assertEqual(stdout.getvalue().count('Added'), 1)
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
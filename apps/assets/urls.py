@@ -30,7 +30,7 @@ urlpatterns = patterns('assets.views',
     url(r'^asset/(?P<object_id>\d+)/delete/$', generic_delete, dict({'model':Item}, post_delete_redirect="item_list", extra_context=dict(object_name=_(u'asset'))), 'item_delete'),
     url(r'^asset/(?P<object_id>\d+)/assign/$', 'item_assign_remove_person', (), name='item_assign_person'),
     url(r'^asset/orphans/$', generic_list, dict({'queryset':Item.objects.filter(person=None)}, list_filters=[location_filter], extra_context=dict(title=_(u'orphan assets'))), 'item_orphans_list'),
-    url(r'^asset/list/$', generic_list, dict({'queryset':Item.objects.all()}, list_filters=[location_filter, state_filter], extra_context=dict(title=_(u'assets'))), 'item_list'),
+    url(r'^asset/list/$', generic_list, dict({'queryset':Item.objects.all()}, list_filters=[location_filter, state_filter], keyset=True, extra_context=dict(title=_(u'assets'))), 'item_list'),
     url(r'^asset/(?P<object_id>\d+)/$', generic_detail, dict(form_class=ItemForm_view, queryset=Item.objects.all(), extra_context={'object_name':_(u'asset'), 'sidebar_subtemplates':['generic_photos_subtemplate.html', 'state_subtemplate.html']}, extra_fields=[{'field':'get_owners', 'label':_(u'Assigned to:')}]), 'item_view'),
     url(r'^asset/(?P<object_id>\d+)/photos/$', generic_photos, {'model':Item, 'max_photos':asset_settings.MAX_ASSET_PHOTOS, 'extra_context':{'object_name':_(u'asset')}}, 'item_photos'),
     url(r'^asset/(?P<object_id>\d+)/state/(?P<state_id>\d+)/set/$', 'item_setstate', (), 'item_setstate'),
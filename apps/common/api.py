@@ -30,3 +30,14 @@ def register_menu(links):
         menu_links.append(link)
 
     menu_links.sort(lambda x,y: 1 if x>y else -1, lambda x:x['position'] if 'position' in x else 1)
+
+
+list_relations = {}
+
+def register_list_relations(model, select_related=None, prefetch=None):
+    """
+    Registers the foreign keys followed by the text of a model's
+    instances, joined by the generic lists, and a function fetching
+    the rest for a page of instances at once
+    """
+    list_relations[model] = {'select_related':select_related or [], 'prefetch':prefetch}
@@ -0,0 +1,269 @@
+import datetime
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import AutoField, ForeignKey, Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.utils.simplejson import dumps, loads
+
+from common.api import list_relations
+
+
+def bulk_insert(model, instances):
+    """
+    Inserts the given model instances using a single executemany call.
+    Unlike save() no signals are sent and the primary keys of the
+    instances are not filled in, so callers that need them must fetch
+    the new rows back
+    """
+    if not instances:
+        return
+
+    opts = model._meta
+    fields = [field for field in opts.local_fields if not isinstance(field, AutoField)]
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(opts.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields))
+    )
+    rows = [[field.get_db_prep_save(field.pre_save(instance, True), connection=connection) for field in fields] for instance in instances]
+
+    # Marked dirty first so a failed insert is rolled back too
+    if transaction.is_managed():
+        transaction.set_dirty()
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
+def bulk_update(model, instances, field_names):
+    """
+    Writes the given fields of model instances already in the database
+    using a single executemany call, without sending signals
+    """
+    if not instances:
+        return
+
+    opts = model._meta
+    fields = [opts.get_field(field_name) for field_name in field_names]
+    qn = connection.ops.quote_name
+    sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+        qn(opts.db_table),
+        ', '.join(['%s = %%s' % qn(field.column) for field in fields]),
+        qn(opts.pk.column)
+    )
+    rows = [[field.get_db_prep_save(field.pre_save(instance, False), connection=connection) for field in fields] + [instance.pk] for instance in instances]
+
+    if transaction.is_managed():
+        transaction.set_dirty()
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+
+def get_list_relations(model, attributes=None):
+    """
+    Returns the foreign key paths to select_related for a list of model
+    instances showing the given dotted attributes: the foreign keys the
+    attributes follow and those registered for the models reached
+    """
+    def get_registered(model, prefix):
+        return [prefix + path for path in list_relations.get(model, {}).get('select_related', [])]
+
+    paths = get_registered(model, '')
+    for attribute in attributes or []:
+        if not isinstance(attribute, basestring):
+            continue
+        current = model
+        prefix = ''
+        for name in attribute.split('.'):
+            try:
+                field = current._meta.get_field(name)
+            except FieldDoesNotExist:
+                break
+            if not isinstance(field, ForeignKey):
+                break
+            prefix += name
+            paths.append(prefix)
+            current = field.rel.to
+            prefix += '__'
+            paths.extend(get_registered(current, prefix))
+    return sorted(set(paths))
+
+
+def get_select_related_paths(field_dict, prefix=''):
+    """
+    Returns the relation paths of the nested select_related dictionary
+    of a query, the argument list select_related() would rebuild it from
+    """
+    paths = []
+    for name, children in field_dict.items():
+        if children:
+            paths.extend(get_select_related_paths(children, '%s%s__' % (prefix, name)))
+        else:
+            paths.append('%s%s' % (prefix, name))
+    return paths
+
+
+def plan_list_queryset(queryset, attributes=None):
+    """
+    Returns the queryset of a list joining the relations found by
+    get_list_relations, besides those it already selects
+    """
+    if not isinstance(queryset, QuerySet) or isinstance(queryset, ValuesQuerySet) or queryset.query.select_related is True:
+        return queryset
+
+    relations = get_list_relations(queryset.model, attributes)
+    if relations:
+        # select_related() replaces the relations given to an earlier call
+        if queryset.query.select_related:
+            relations = get_select_related_paths(queryset.query.select_related) + relations
+        return queryset.select_related(*relations)
+    return queryset
+
+
+def prefetch_list_relations(objects, attribute=None):
+    """
+    Runs the prefetch function registered for each model of a page of
+    objects, or of the objects reached by their attribute, on the objects
+    of that model only: search results mix several models.  Returns the
+    objects as a list
+    """
+    objects = list(objects)
+    targets = objects
+    if attribute:
+        targets = []
+        for obj in objects:
+            try:
+                targets.append(reduce(getattr, attribute.split('.'), obj))
+            except AttributeError:
+                continue
+
+    by_model = {}
+    for target in targets:
+        if target is not None:
+            by_model.setdefault(type(target), []).append(target)
+    for model, instances in by_model.items():
+        prefetch = list_relations.get(model, {}).get('prefetch')
+        if prefetch:
+            prefetch(instances)
+    return objects
+
+
+def get_keyset_ordering(queryset):
+    """
+    Returns the (field, descending) pairs ordering a queryset ending with
+    the primary key, so every row has a distinct position, or None if it
+    is ordered by something a page can't seek on: related, nullable or
+    extra fields
+    """
+    opts = queryset.model._meta
+    query = queryset.query
+    if query.extra_order_by:
+        return None
+
+    names = query.order_by or (query.default_ordering and opts.ordering) or []
+    ordering = []
+    for name in names:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+        if field.null or field.rel:
+            return None
+        ordering.append((field, descending))
+        if field.primary_key:
+            return ordering
+    ordering.append((opts.pk, ordering and ordering[-1][1] or False))
+    return ordering
+
+
+def encode_cursor(values, backwards=False):
+    """
+    Returns the opaque token of the position after the row with the given
+    ordering values, or before it when paging backwards
+    """
+    def get_text(value):
+        if isinstance(value, datetime.datetime):
+            # Keeps the microseconds
+            return value.isoformat(' ')
+        elif isinstance(value, datetime.date):
+            return value.isoformat()
+        return unicode(value)
+
+    return urlsafe_b64encode(dumps([backwards and 'p' or 'n', [get_text(value) for value in values]]))
+
+
+def decode_cursor(ordering, cursor):
+    """
+    Returns the values and the direction of a cursor token, raises
+    ValueError, TypeError or ValidationError for invalid ones
+    """
+    direction, values = loads(urlsafe_b64decode(str(cursor)))
+    if len(values) != len(ordering):
+        raise ValueError('The cursor does not match the ordering.')
+    return [field.to_python(value) for (field, descending), value in zip(ordering, values)], direction == 'p'
+
+
+def get_keyset_page(queryset, cursor=None, per_page=10):
+    """
+    Returns a page of a queryset seeking to the position of a cursor
+    token instead of counting rows with OFFSET, so every page costs the
+    same, as a dictionary of object_list and the next and previous
+    cursors, None at the ends.  Returns None for the querysets
+    get_keyset_ordering can't order
+    """
+    ordering = get_keyset_ordering(queryset)
+    if ordering is None:
+        return None
+
+    values = None
+    backwards = False
+    if cursor:
+        try:
+            values, backwards = decode_cursor(ordering, cursor)
+        except (ValueError, TypeError, ValidationError):
+            # A tampered or stale token shows the first page
+            values = None
+            backwards = False
+
+    page_queryset = queryset
+    if values is not None:
+        seek = None
+        for index, (field, descending) in enumerate(ordering):
+            condition = Q(**{'%s__%s' % (field.name, descending != backwards and 'lt' or 'gt'):values[index]})
+            for (previous_field, previous_descending), value in zip(ordering[:index], values):
+                condition &= Q(**{previous_field.name:value})
+            if seek is None:
+                seek = condition
+            else:
+                seek |= condition
+        page_queryset = page_queryset.filter(seek)
+
+    order = ['%s%s' % (descending != backwards and '-' or '', field.name) for field, descending in ordering]
+    rows = list(page_queryset.order_by(*order)[:per_page + 1])
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        if not more:
+            # Back to the start, shown as a full first page
+            return get_keyset_page(queryset, None, per_page)
+        rows.reverse()
+
+    get_values = lambda obj: [getattr(obj, field.attname) for field, descending in ordering]
+    next_cursor = None
+    previous_cursor = None
+    if rows:
+        if more or backwards:
+            next_cursor = encode_cursor(get_values(rows[-1]))
+        if backwards or values is not None:
+            previous_cursor = encode_cursor(get_values(rows[0]), backwards=True)
+    return {'object_list':rows, 'next_cursor':next_cursor, 'previous_cursor':previous_cursor}
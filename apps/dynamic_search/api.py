@@ -1,7 +1,395 @@
-search_list = {}
+import re
+import time
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, DatabaseError
+from django.db.models import Q, CharField, TextField
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
+from django.utils.datastructures import SortedDict
+from django.utils.hashcompat import md5_constructor
+from django.utils.importlib import import_module
+
+from conf import settings as search_settings
+
+#Keeps the registration order, results are shown in this order
+search_list = SortedDict()
+
+words_re = re.compile(r'\w+', re.UNICODE)
+
+_backend = None
+_dependencies = None
+
+#SQLite virtual machine instructions between deadline checks
+PROGRESS_STEPS = 10000
+
 
 def register(model, text, field_list):
-    if model in search_list:
-        search_list[model]['fields'].append(field_list)
+    """
+    Fields are given by name or as (name, weight) pairs, fields with a
+    higher weight rank their matches first, the default weight is 1
+    """
+    data = search_list.setdefault(model, {'fields':[], 'weights':{}, 'text':text})
+    for field in field_list:
+        if isinstance(field, (list, tuple)):
+            field_name, weight = field
+        else:
+            field_name, weight = field, 1
+        data['fields'].append(field_name)
+        data['weights'][field_name] = weight
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        module_name, class_name = search_settings.BACKEND.rsplit('.', 1)
+        _backend = getattr(import_module(module_name), class_name)()
+    return _backend
+
+
+#original code from:
+#http://www.julienphalip.com/blog/2008/08/16/adding-search-django-site-snap/
+
+def normalize_query(query_string,
+                    findterms=re.compile(r'"([^"]+)"|(\S+)').findall,
+                    normspace=re.compile(r'\s{2,}').sub):
+    ''' Splits the query string in invidual keywords, getting rid of unecessary spaces
+        and grouping quoted words together.
+        Example:
+
+        >>> normalize_query('  some random  words "with   quotes  " and   spaces')
+        ['some', 'random', 'words', 'with quotes', 'and', 'spaces']
+
+    '''
+    return [normspace(' ', (t[0] or t[1]).strip()) for t in findterms(query_string)]
+
+
+def clean_terms(terms):
+    """
+    Drops repeated terms, terms shorter than DYNAMIC_SEARCH_MIN_TERM_LENGTH
+    and those beyond DYNAMIC_SEARCH_MAX_TERMS, returns the list of terms
+    to search and the list of the ignored ones
+    """
+    cleaned_terms = []
+    ignored_terms = []
+    for term in terms:
+        if term.lower() in [cleaned_term.lower() for cleaned_term in cleaned_terms + ignored_terms]:
+            continue
+        if len(term) < search_settings.MIN_TERM_LENGTH or len(cleaned_terms) >= search_settings.MAX_TERMS:
+            ignored_terms.append(term)
+        else:
+            cleaned_terms.append(term)
+    return cleaned_terms, ignored_terms
+
+
+def call_before(deadline, function, *args):
+    """
+    Returns the result of function or None if the deadline (a time.time()
+    value) passes first.  Queries still running at the deadline are
+    interrupted on SQLite, other databases finish the running query
+    """
+    if deadline is None:
+        return function(*args)
+    if time.time() >= deadline:
+        return None
+    if not connection.settings_dict['ENGINE'].endswith('sqlite3'):
+        return function(*args)
+
+    # Opens the connection if needed
+    connection.cursor()
+    connection.connection.set_progress_handler(lambda:time.time() > deadline, PROGRESS_STEPS)
+    try:
+        return function(*args)
+    except DatabaseError:
+        if time.time() > deadline:
+            return None
+        raise
+    finally:
+        connection.connection.set_progress_handler(None, 0)
+
+
+def get_words(value):
+    return words_re.findall(unicode(value).lower())
+
+
+def get_query(terms, search_fields):
+    ''' Returns a query, that is a combination of Q objects. That combination
+        aims to search keywords within a model by testing the given search fields.
+
+    '''
+    query = None # Query to search for every search term
+    #terms = normalize_query(query_string)
+    for term in terms:
+        or_query = None # Query to search for a given term in each field
+        for field_name in search_fields:
+            q = Q(**{"%s__icontains" % field_name: term})
+            if or_query is None:
+                or_query = q
+            else:
+                or_query = or_query | q
+        if query is None:
+            query = or_query
+        else:
+            query = query & or_query
+    return query
+
+
+def get_score_select(model, terms):
+    """
+    Returns the SQL and parameters of the relevance score of the
+    registered model's own fields, for each term a field adds its weight
+    when it contains the term, times the prefix boost when it starts with
+    it and times the exact boost when it is equal to it.  Fields of
+    related models only filter the results
+    """
+    qn = connection.ops.quote_name
+    opts = model._meta
+    cases = []
+    params = []
+    for field_name in search_list[model]['fields']:
+        try:
+            field = opts.get_field(field_name)
+        except FieldDoesNotExist:
+            continue
+
+        weight = search_list[model]['weights'][field_name]
+        column = '%s.%s' % (qn(opts.db_table), qn(field.column))
+        for term in terms:
+            if isinstance(field, (CharField, TextField)):
+                cases.append('CASE WHEN %s %s THEN %%s WHEN %s %s THEN %%s WHEN %s %s THEN %%s ELSE 0 END' % (
+                    connection.ops.lookup_cast('iexact') % column, connection.operators['iexact'] % '%s',
+                    connection.ops.lookup_cast('istartswith') % column, connection.operators['istartswith'] % '%s',
+                    connection.ops.lookup_cast('icontains') % column, connection.operators['icontains'] % '%s',
+                ))
+                like_term = connection.ops.prep_for_like_query(term)
+                params.extend([
+                    connection.ops.prep_for_iexact_query(term), weight * search_settings.EXACT_MATCH_BOOST,
+                    u'%s%%' % like_term, weight * search_settings.PREFIX_MATCH_BOOST,
+                    u'%%%s%%' % like_term, weight,
+                ])
+            else:
+                # Numbers and dates only score when equal to the term
+                try:
+                    value = field.get_db_prep_value(field.to_python(term), connection=connection)
+                except (ValidationError, ValueError, TypeError):
+                    continue
+                cases.append('CASE WHEN %s = %%s THEN %%s ELSE 0 END' % column)
+                params.extend([value, weight * search_settings.EXACT_MATCH_BOOST])
+
+    if not cases:
+        return '0', []
+    return ' + '.join(cases), params
+
+
+def rank_results(model, results, terms):
+    """
+    Adds a search_score attribute to the results and orders them by it,
+    the backend's own ordering breaks the ties
+    """
+    sql, params = get_score_select(model, terms)
+    return results.extra(
+        select={'search_score':sql},
+        select_params=params,
+    ).order_by(*['-search_score'] + list(results.query.order_by))
+
+
+def get_related_model(model, name):
+    field, field_model, direct, m2m = model._meta.get_field_by_name(name)
+    if direct:
+        return field.rel.to
     else:
-        search_list[model] = {'fields':field_list, 'text':text}
+        return field.model
+
+
+def get_field_values(model, fields, pks):
+    """
+    Returns a dictionary of pk: list of the values of the given fields for
+    the objects with the given primary keys.  values_list can't follow
+    many to many or reverse relations (ie: person__first_name for Item),
+    those fields are fetched from the join table or the related model
+    """
+    values = dict([(pk, []) for pk in pks])
+    local_fields = []
+    related_fields = {}
+    for field_name in fields:
+        name = field_name.split('__', 1)[0]
+        field, field_model, direct, m2m = model._meta.get_field_by_name(name)
+        if direct and not m2m:
+            local_fields.append(field_name)
+        else:
+            related_fields.setdefault((field, direct, m2m), []).append(field_name.split('__', 1)[1])
+
+    if local_fields:
+        for row in model.objects.filter(pk__in=pks).values_list('pk', *local_fields):
+            values[row[0]].extend(row[1:])
+
+    for (field, direct, m2m), names in related_fields.items():
+        if direct:
+            queryset = field.rel.through.objects
+            lookup, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        elif m2m:
+            queryset = field.field.rel.through.objects
+            lookup, target = field.field.m2m_reverse_field_name(), field.field.m2m_field_name()
+        else:
+            queryset = field.model.objects
+            lookup, target = field.field.name, None
+
+        names = [target and '%s__%s' % (target, name) or name for name in names]
+        for row in queryset.filter(**{'%s__in' % lookup:pks}).values_list(lookup, *names):
+            values[row[0]].extend(row[1:])
+
+    return values
+
+
+def get_dependencies():
+    """
+    Returns a dictionary of the models reached through the related search
+    fields (ie: person__first_name), each with the list of
+    (registered model, lookup) pairs whose search data depends on them.
+    Computed on first use, once all the models are loaded
+    """
+    global _dependencies
+    if _dependencies is None:
+        _dependencies = {}
+        for model, data in search_list.items():
+            for field_name in data['fields']:
+                path = field_name.split('__')[:-1]
+                related = model
+                for position, name in enumerate(path):
+                    related = get_related_model(related, name)
+                    dependency = (model, '__'.join(path[:position + 1]))
+                    if dependency not in _dependencies.setdefault(related, []):
+                        _dependencies[related].append(dependency)
+    return _dependencies
+
+
+def get_dependents(instance):
+    return [(model, list(model.objects.filter(**{lookup:instance}).values_list('pk', flat=True))) for model, lookup in get_dependencies().get(instance.__class__, [])]
+
+
+def get_version_key(model):
+    return 'dynamic_search.version.%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def get_model_version(model):
+    key = get_version_key(model)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock so a version evicted from the cache is
+        # never reused by results cached before
+        cache.add(key, int(time.time() * 1000))
+        version = cache.get(key, int(time.time() * 1000))
+    return version
+
+
+def bump_model_version(model):
+    """
+    Invalidates the cached results of a registered model and of the
+    registered models that search through it
+    """
+    models = set([dependent for dependent, lookup in get_dependencies().get(model, [])])
+    if model in search_list:
+        models.add(model)
+
+    for model in models:
+        key = get_version_key(model)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, int(time.time() * 1000))
+
+
+def get_cached_search(model, terms, name, function):
+    """
+    Returns the value function calculates for the model and search terms
+    from the cache, until the model or one it depends on changes
+    """
+    if not search_settings.CACHE_TIMEOUT:
+        return function()
+
+    key = 'dynamic_search.results.%s.%s.%s.%s' % (model._meta.app_label, model._meta.module_name, get_model_version(model),
+        md5_constructor(repr((search_settings.BACKEND, name, terms, search_settings.RESULTS_PER_MODEL, search_settings.COUNT_LIMIT))).hexdigest())
+    value = cache.get(key)
+    if value is None:
+        value = function()
+        cache.set(key, value, search_settings.CACHE_TIMEOUT)
+    return value
+
+
+def objects_changed(model, pks):
+    """
+    Notifies the search backend and the results cache of changes made
+    without saving the objects, ie: with a queryset update
+    """
+    backend = get_backend()
+    if backend.indexed:
+        backend.update(model, pks)
+    bump_model_version(model)
+
+
+def model_changed(sender, **kwargs):
+    bump_model_version(sender)
+
+
+def relation_versions_changed(sender, instance, action, model, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_model_version(instance.__class__)
+        bump_model_version(model)
+
+
+def object_saved(sender, instance, **kwargs):
+    backend = get_backend()
+    if not backend.indexed:
+        return
+
+    if sender in search_list:
+        backend.update(sender, [instance.pk])
+    for model, pks in get_dependents(instance):
+        backend.update(model, pks)
+
+
+def object_pre_delete(sender, instance, **kwargs):
+    if get_backend().indexed and sender in get_dependencies():
+        instance._search_dependents = get_dependents(instance)
+
+
+def object_deleted(sender, instance, **kwargs):
+    backend = get_backend()
+    if not backend.indexed:
+        return
+
+    if sender in search_list:
+        backend.remove(sender, [instance.pk])
+    for model, pks in getattr(instance, '_search_dependents', []):
+        backend.update(model, pks)
+
+
+def relation_changed(sender, instance, action, model, pk_set, **kwargs):
+    backend = get_backend()
+    if not backend.indexed:
+        return
+
+    dependencies = get_dependencies()
+    # Registered models searched through the relation with instance's model
+    dependents = [(dependent, lookup) for dependent, lookup in dependencies.get(instance.__class__, []) if dependent == model]
+
+    if action == 'pre_clear':
+        instance._search_dependents = [(dependent, list(dependent.objects.filter(**{lookup:instance}).values_list('pk', flat=True))) for dependent, lookup in dependents]
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if action == 'post_clear':
+            for dependent, pks in getattr(instance, '_search_dependents', []):
+                backend.update(dependent, pks)
+        elif dependents:
+            backend.update(model, list(pk_set))
+
+        if instance.__class__ in search_list and instance.__class__ in [dependent for dependent, lookup in dependencies.get(model, [])]:
+            backend.update(instance.__class__, [instance.pk])
+
+post_save.connect(object_saved, dispatch_uid='dynamic_search_object_saved')
+pre_delete.connect(object_pre_delete, dispatch_uid='dynamic_search_object_pre_delete')
+post_delete.connect(object_deleted, dispatch_uid='dynamic_search_object_deleted')
+m2m_changed.connect(relation_changed, dispatch_uid='dynamic_search_relation_changed')
+post_save.connect(model_changed, dispatch_uid='dynamic_search_model_saved')
+post_delete.connect(model_changed, dispatch_uid='dynamic_search_model_deleted')
+m2m_changed.connect(relation_versions_changed, dispatch_uid='dynamic_search_relation_versions_changed')
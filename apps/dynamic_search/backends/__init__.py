@@ -0,0 +1,25 @@
+class BaseSearchBackend(object):
+    """
+    Backends return a queryset of the objects of a registered model that
+    match all the normalized search terms.  Backends that keep their own
+    index set indexed to True and get notified of the objects that need
+    to be reindexed or removed from it.  Backends that set snippets to
+    True return the matching text of each object with get_snippet
+    """
+    indexed = False
+    snippets = False
+
+    def search(self, model, terms):
+        raise NotImplementedError
+
+    def update(self, model, pks):
+        pass
+
+    def remove(self, model, pks):
+        pass
+
+    def rebuild(self, model):
+        pass
+
+    def get_snippet(self, obj):
+        return u''
@@ -0,0 +1,129 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction, DatabaseError
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from dynamic_search.api import search_list, get_field_values
+from dynamic_search.backends import BaseSearchBackend
+
+TABLE_NAME = 'dynamic_search_fts'
+#Keep the IN clauses below the SQLite bound parameters limit
+CHUNK_SIZE = 500
+#Control characters can't come from a form, the snippet markers are
+#replaced after the text has been escaped
+SNIPPET_START = u'\x02'
+SNIPPET_END = u'\x03'
+
+
+def get_match_expression(terms):
+    """
+    Converts the normalized terms to an FTS5 query, every word of a term
+    is a prefix match and quoted phrases must match as a whole
+    """
+    expressions = []
+    for term in terms:
+        expression = u'"%s"' % term.replace(u'"', u'""')
+        if u' ' not in term:
+            expression += u'*'
+        expressions.append(expression)
+    return u' '.join(expressions)
+
+
+def get_rowid(content_type_id, object_id):
+    """
+    Rows are stored under a rowid made of the content type and the object
+    id so they can be replaced without scanning the table
+    """
+    return (content_type_id << 32) + object_id
+
+
+class FTS5SearchBackend(BaseSearchBackend):
+    """
+    Keeps the text of the registered fields of every object in a single
+    SQLite FTS5 table keyed by content type and object id, results are
+    ranked with bm25 and carry a highlighted search_snippet attribute
+    """
+    indexed = True
+    snippets = True
+
+    def __init__(self):
+        if not settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+            raise ImproperlyConfigured('The FTS5 search backend requires the sqlite3 database engine.')
+
+        try:
+            cursor = connection.cursor()
+            cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(content_type_id UNINDEXED, object_id UNINDEXED, body)' % TABLE_NAME)
+            transaction.commit_unless_managed()
+        except DatabaseError, err:
+            raise ImproperlyConfigured('Could not create the FTS5 search table, the SQLite library may lack FTS5 support: %s' % err)
+
+    def search(self, model, terms):
+        qn = connection.ops.quote_name
+        content_type = ContentType.objects.get_for_model(model)
+        opts = model._meta
+        return model.objects.extra(
+            tables=[TABLE_NAME],
+            where=[
+                '%s.object_id = %s.%s' % (TABLE_NAME, qn(opts.db_table), qn(opts.pk.column)),
+                '%s.content_type_id = %%s' % TABLE_NAME,
+                '%s MATCH %%s' % TABLE_NAME,
+            ],
+            params=[content_type.pk, get_match_expression(terms)],
+            select={
+                'search_rank':'%s.rank' % TABLE_NAME,
+                'search_snippet':"snippet(%s, 2, '%s', '%s', '...', 12)" % (TABLE_NAME, SNIPPET_START, SNIPPET_END),
+            },
+        ).order_by('search_rank')
+
+    def get_rows(self, model, pks):
+        content_type = ContentType.objects.get_for_model(model)
+        rows = []
+        for pk, values in get_field_values(model, search_list[model]['fields'], pks).items():
+            rows.append((get_rowid(content_type.pk, pk), content_type.pk, pk, u' '.join([unicode(value) for value in values if value is not None])))
+        return rows
+
+    def execute(self, sql, params, many=False):
+        """
+        Writes to the table in the transaction of the caller, committing
+        right away outside of transaction management like Django does
+        """
+        if transaction.is_managed():
+            transaction.set_dirty()
+        cursor = connection.cursor()
+        if many:
+            cursor.executemany(sql, params)
+        else:
+            cursor.execute(sql, params)
+        transaction.commit_unless_managed()
+
+    def insert(self, rows):
+        self.execute('INSERT INTO %s (rowid, content_type_id, object_id, body) VALUES (%%s, %%s, %%s, %%s)' % TABLE_NAME, rows, many=True)
+
+    def update(self, model, pks):
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start:start + CHUNK_SIZE]
+            self.remove(model, chunk)
+            self.insert(self.get_rows(model, chunk))
+
+    def remove(self, model, pks):
+        if not pks:
+            return
+        content_type = ContentType.objects.get_for_model(model)
+        self.execute('DELETE FROM %s WHERE rowid IN (%s)' % (TABLE_NAME, ', '.join(['%s'] * len(pks))), [get_rowid(content_type.pk, pk) for pk in pks])
+
+    def get_snippet(self, obj):
+        return mark_safe(escape(getattr(obj, 'search_snippet', None) or u'').replace(SNIPPET_START, u'<strong>').replace(SNIPPET_END, u'</strong>'))
+
+    def rebuild(self, model):
+        content_type = ContentType.objects.get_for_model(model)
+        self.execute('DELETE FROM %s WHERE rowid BETWEEN %%s AND %%s' % TABLE_NAME, [get_rowid(content_type.pk, 0), get_rowid(content_type.pk + 1, 0) - 1])
+
+        pks = []
+        for pk in model.objects.values_list('pk', flat=True).order_by('pk').iterator():
+            pks.append(pk)
+            if len(pks) == CHUNK_SIZE:
+                self.insert(self.get_rows(model, pks))
+                pks = []
+        self.insert(self.get_rows(model, pks))
@@ -0,0 +1,77 @@
+from django.contrib.contenttypes.models import ContentType
+
+from common.db import bulk_insert
+
+from dynamic_search.api import search_list, get_query, get_field_values, \
+                               get_words
+from dynamic_search.backends import BaseSearchBackend
+from dynamic_search.models import SearchToken
+
+TOKEN_MAX_LENGTH = SearchToken._meta.get_field('token').max_length
+#Keep the IN clauses below the SQLite bound parameters limit
+CHUNK_SIZE = 500
+
+
+def tokenize(value):
+    return [word[:TOKEN_MAX_LENGTH] for word in get_words(value)]
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    """
+    Keeps the words of the registered fields of every object in the
+    SearchToken table and matches the terms as word prefixes with index
+    range lookups.  Terms made of several words, like quoted phrases, are
+    then checked with icontains on the already narrowed down objects.
+    The index is written in the transaction of the caller
+    """
+    indexed = True
+
+    def search(self, model, terms):
+        content_type = ContentType.objects.get_for_model(model)
+        fields = search_list[model]['fields']
+        queryset = model.objects.all()
+        phrases = []
+        for term in terms:
+            tokens = tokenize(term)
+            for token in tokens:
+                queryset = queryset.filter(pk__in=SearchToken.objects.filter(content_type=content_type, token__gte=token, token__lt=token + u'\uffff').values('object_id'))
+            if len(tokens) != 1:
+                phrases.append(term)
+
+        if phrases:
+            queryset = queryset.filter(get_query(phrases, fields))
+            if [field for field in fields if '__' in field]:
+                queryset = queryset.distinct()
+
+        return queryset
+
+    def get_tokens(self, model, pks):
+        content_type = ContentType.objects.get_for_model(model)
+        tokens = []
+        for pk, values in get_field_values(model, search_list[model]['fields'], pks).items():
+            words = set()
+            for value in values:
+                if value is not None:
+                    words.update(tokenize(value))
+            tokens.extend([SearchToken(content_type=content_type, object_id=pk, token=word) for word in words])
+        return tokens
+
+    def update(self, model, pks):
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start:start + CHUNK_SIZE]
+            self.remove(model, chunk)
+            bulk_insert(SearchToken, self.get_tokens(model, chunk))
+
+    def remove(self, model, pks):
+        SearchToken.objects.filter(content_type=ContentType.objects.get_for_model(model), object_id__in=pks).delete()
+
+    def rebuild(self, model):
+        SearchToken.objects.filter(content_type=ContentType.objects.get_for_model(model)).delete()
+
+        pks = []
+        for pk in model.objects.values_list('pk', flat=True).order_by('pk').iterator():
+            pks.append(pk)
+            if len(pks) == CHUNK_SIZE:
+                bulk_insert(SearchToken, self.get_tokens(model, pks))
+                pks = []
+        bulk_insert(SearchToken, self.get_tokens(model, pks))
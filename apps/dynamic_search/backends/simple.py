@@ -0,0 +1,11 @@
+from dynamic_search.api import search_list, get_query
+from dynamic_search.backends import BaseSearchBackend
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    Matches every term with icontains lookups on the registered fields,
+    needs no index but scans the whole tables
+    """
+    def search(self, model, terms):
+        return model.objects.filter(get_query(terms, search_list[model]['fields']))
@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+#Backend options are:
+#dynamic_search.backends.simple.SimpleSearchBackend - icontains lookups
+#dynamic_search.backends.index.InvertedIndexBackend - token index tables
+#dynamic_search.backends.fts.FTS5SearchBackend - SQLite FTS5 table, sqlite3 engine only
+
+BACKEND = getattr(settings, 'DYNAMIC_SEARCH_BACKEND', 'dynamic_search.backends.simple.SimpleSearchBackend')
+
+SUGGEST_LIMIT = getattr(settings, 'DYNAMIC_SEARCH_SUGGEST_LIMIT', 5)
+#Seconds before a suggestion index is rebuilt, bounds how long changes
+#made by other server processes take to show up
+SUGGEST_INDEX_TIMEOUT = getattr(settings, 'DYNAMIC_SEARCH_SUGGEST_INDEX_TIMEOUT', 300)
+
+#Objects of each model shown on the main results page, the rest can be
+#paged through from the model's own results page
+RESULTS_PER_MODEL = getattr(settings, 'DYNAMIC_SEARCH_RESULTS_PER_MODEL', 10)
+#Matches counted per model before showing 'more than' instead
+COUNT_LIMIT = getattr(settings, 'DYNAMIC_SEARCH_COUNT_LIMIT', 1000)
+
+#Run the query of each model in a thread of its own, off by default for
+#SQLite where parallel readers don't help
+CONCURRENT = getattr(settings, 'DYNAMIC_SEARCH_CONCURRENT', not settings.DATABASES['default']['ENGINE'].endswith('sqlite3'))
+MAX_WORKERS = getattr(settings, 'DYNAMIC_SEARCH_MAX_WORKERS', 4)
+
+#Multipliers of a field's weight when it is equal to or starts with a
+#search term instead of just containing it
+EXACT_MATCH_BOOST = getattr(settings, 'DYNAMIC_SEARCH_EXACT_MATCH_BOOST', 10)
+PREFIX_MATCH_BOOST = getattr(settings, 'DYNAMIC_SEARCH_PREFIX_MATCH_BOOST', 3)
+
+#Seconds the results of a search are cached, they are also dropped as
+#soon as the searched model or one it depends on changes, 0 disables it.
+#The model versions that drop them are kept in the cache too, so it must
+#be shared by all the server processes (ie: memcached, db): with a per
+#process cache (locmem, the default) the changes made by one process
+#would not be seen by the others, caching is off then
+SHARED_CACHE = settings.CACHE_BACKEND.split(':', 1)[0] not in ('locmem', 'dummy')
+CACHE_TIMEOUT = getattr(settings, 'DYNAMIC_SEARCH_CACHE_TIMEOUT', SHARED_CACHE and 300 or 0)
+if CACHE_TIMEOUT and not SHARED_CACHE:
+    raise ImproperlyConfigured('DYNAMIC_SEARCH_CACHE_TIMEOUT requires a CACHE_BACKEND shared by the server processes, not %s.' % settings.CACHE_BACKEND)
+
+#Guards against searches that would keep the database busy, shorter
+#and repeated terms are ignored as well as those beyond MAX_TERMS
+MIN_TERM_LENGTH = getattr(settings, 'DYNAMIC_SEARCH_MIN_TERM_LENGTH', 2)
+MAX_TERMS = getattr(settings, 'DYNAMIC_SEARCH_MAX_TERMS', 6)
+#Seconds a search request may spend querying, partial results are shown
+#once it runs out, None disables it
+TIME_BUDGET = getattr(settings, 'DYNAMIC_SEARCH_TIME_BUDGET', 3)
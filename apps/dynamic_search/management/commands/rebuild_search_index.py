@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import get_model
+
+from dynamic_search.api import search_list, get_backend, bump_model_version
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the search backend index of all the registered models or of the given app_label.model ones.'
+    args = '[app_label.model ...]'
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        if not backend.indexed:
+            raise CommandError('The configured search backend does not use an index.')
+
+        if args:
+            models = []
+            for name in args:
+                model = get_model(*name.split('.', 1))
+                if model not in search_list:
+                    raise CommandError('%s is not registered for search.' % name)
+                models.append(model)
+        else:
+            models = search_list.keys()
+
+        for model in models:
+            self.rebuild(backend, model)
+            bump_model_version(model)
+            self.stdout.write('Rebuilt the search index of %s.\n' % model._meta.object_name)
+
+    @transaction.commit_on_success
+    def rebuild(self, backend, model):
+        backend.rebuild(model)
@@ -1,3 +1,12 @@
 from django.db import models
+from django.contrib.contenttypes.models import ContentType
 
-# Create your models here.
+
+class SearchToken(models.Model):
+    """
+    Inverted index entry used by the InvertedIndexBackend, one row for
+    every distinct word of the registered fields of an object
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField(db_index=True)
+    token = models.CharField(max_length=64, db_index=True)
@@ -0,0 +1,76 @@
+import time
+from bisect import bisect_left
+
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+
+from api import search_list, get_words
+from conf import settings as search_settings
+
+#model: PrefixIndex, rebuilt on the first lookup after a change
+indexes = {}
+
+
+class PrefixIndex(object):
+    """
+    Sorted lowercase values and words of the local, non text fields
+    registered for a model (asset and serial numbers, names), prefix
+    lookups are a bisection followed by a short scan
+    """
+    def __init__(self, model):
+        fields = [field_name for field_name in search_list[model]['fields'] if '__' not in field_name and not isinstance(model._meta.get_field(field_name), models.TextField)]
+        entries = set()
+        for row in model.objects.values_list('pk', *fields).iterator():
+            for value in row[1:]:
+                if value is not None:
+                    value = unicode(value).lower()
+                    entries.add((value, row[0]))
+                    entries.update([(word, row[0]) for word in get_words(value)])
+
+        entries = sorted(entries)
+        self.keys = [key for key, pk in entries]
+        self.pks = [pk for key, pk in entries]
+        self.created = time.time()
+
+    def is_expired(self):
+        return time.time() - self.created > search_settings.SUGGEST_INDEX_TIMEOUT
+
+    def lookup(self, prefix, limit):
+        pks = []
+        for position in xrange(bisect_left(self.keys, prefix), len(self.keys)):
+            if not self.keys[position].startswith(prefix):
+                break
+            if self.pks[position] not in pks:
+                pks.append(self.pks[position])
+                if len(pks) == limit:
+                    break
+        return pks
+
+
+def get_index(model):
+    index = indexes.get(model)
+    if index is None or index.is_expired():
+        index = indexes[model] = PrefixIndex(model)
+    return index
+
+
+def suggest(prefix, limit):
+    """
+    Returns a list of (model, objects) with up to limit objects of every
+    registered model that have a value or word starting with prefix
+    """
+    prefix = prefix.strip().lower()
+    results = []
+    for model in search_list.keys():
+        pks = get_index(model).lookup(prefix, limit)
+        if pks:
+            objects = model.objects.in_bulk(pks)
+            results.append((model, [objects[pk] for pk in pks if pk in objects]))
+    return results
+
+
+def invalidate_index(sender, **kwargs):
+    indexes.pop(sender, None)
+
+post_save.connect(invalidate_index, dispatch_uid='dynamic_search_suggest_saved')
+post_delete.connect(invalidate_index, dispatch_uid='dynamic_search_suggest_deleted')
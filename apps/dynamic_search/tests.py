@@ -1,11 +1,30 @@
 """
-This file demonstrates two different styles of tests (one doctest and one
-unittest). These will both pass when you run "manage.py test".
-
-Replace these with more appropriate tests for your application.
+Tests of the search backends, the search and suggestion views and the
+results cache
 """
 
-from django.test import TestCase
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils.simplejson import loads
+
+from assets.models import Item, ItemState, Person, State
+from inventory.models import ItemTemplate, Inventory, Location, Supplier
+from movements.models import PurchaseRequest, PurchaseRequestItem
+
+import dynamic_search.api as api
+from dynamic_search import suggest, views
+from dynamic_search.backends.fts import FTS5SearchBackend, TABLE_NAME
+from dynamic_search.backends.index import InvertedIndexBackend
+from dynamic_search.conf import settings as search_settings
+from dynamic_search.models import SearchToken
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +40,324 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+class InvertedIndexBackendTest(TransactionTestCase):
+    def setUp(self):
+        self.backend = api._backend
+        api._backend = InvertedIndexBackend()
+        self.template = ItemTemplate.objects.create(description=u'Laptop Dell')
+        self.item = Item.objects.create(item_template=self.template, property_number=u'ABC-123', notes=u'with quotes here')
+        Item.objects.create(item_template=self.template, property_number=u'XYZ-9')
+
+    def tearDown(self):
+        api._backend = self.backend
+
+    def search(self, query, model=Item):
+        return sorted(api.get_backend().search(model, api.normalize_query(query)).values_list('pk', flat=True))
+
+    def test_matches_word_prefixes_and_phrases(self):
+        self.assertEqual(self.search(u'abc'), [self.item.pk])
+        self.assertEqual(self.search(u'abc-123'), [self.item.pk])
+        self.assertEqual(self.search(u'"with quotes"'), [self.item.pk])
+        self.assertEqual(self.search(u'"quotes with"'), [])
+
+    def test_follows_related_changes(self):
+        person = Person.objects.create(first_name=u'John', last_name=u'Smith')
+        person.inventory.add(self.item)
+        self.assertEqual(self.search(u'smith'), [self.item.pk])
+        person.inventory.clear()
+        self.assertEqual(self.search(u'smith'), [])
+
+    def test_rebuild(self):
+        SearchToken.objects.all().delete()
+        call_command('rebuild_search_index', 'assets.item', stdout=StringIO())
+        self.assertEqual(self.search(u'laptop'), sorted(Item.objects.values_list('pk', flat=True)))
+
+    def test_update_joins_the_transaction_of_the_caller(self):
+        @transaction.commit_on_success
+        def create():
+            Location.objects.create(name=u'Depot')
+            raise ValueError
+
+        self.assertRaises(ValueError, create)
+        self.assertEqual(Location.objects.count(), 0)
+        self.assertEqual(SearchToken.objects.filter(token=u'depot').count(), 0)
+
+
+class FTS5SearchBackendTest(TransactionTestCase):
+    def setUp(self):
+        self.backend = api._backend
+        try:
+            api._backend = FTS5SearchBackend()
+        except ImproperlyConfigured:
+            api._backend = self.backend
+            self.skipTest('SQLite lacks FTS5 support')
+        connection.cursor().execute('DELETE FROM %s' % TABLE_NAME)
+        transaction.commit_unless_managed()
+        self.template = ItemTemplate.objects.create(description=u'Laptop Dell')
+        self.item = Item.objects.create(item_template=self.template, property_number=u'ABC-123', notes=u'with quotes here')
+
+    def tearDown(self):
+        api._backend = self.backend
+
+    def search(self, query, model=Item):
+        return list(api.get_backend().search(model, api.normalize_query(query)))
+
+    def test_matches_prefixes_and_phrases_with_snippets(self):
+        results = self.search(u'quot')
+        self.assertEqual(results, [self.item])
+        self.assertTrue(u'<strong>quotes</strong>' in api.get_backend().get_snippet(results[0]))
+        self.assertEqual(self.search(u'"with quotes"'), [self.item])
+        self.assertEqual(self.search(u'"quotes with"'), [])
+
+    def test_update_joins_the_transaction_of_the_caller(self):
+        @transaction.commit_on_success
+        def create():
+            Location.objects.create(name=u'Depot')
+            raise ValueError
+
+        self.assertRaises(ValueError, create)
+        self.assertEqual(Location.objects.count(), 0)
+        self.assertEqual(self.search(u'depot', Location), [])
+
+
+class SearchViewTestCase(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        self.saved_settings = {}
+        # Rolled back objects don't invalidate the cached results
+        self.set_search_settings(CACHE_TIMEOUT=0)
+
+    def tearDown(self):
+        for name, value in self.saved_settings.items():
+            setattr(search_settings, name, value)
+
+    def set_search_settings(self, **values):
+        for name, value in values.items():
+            self.saved_settings.setdefault(name, getattr(search_settings, name))
+            setattr(search_settings, name, value)
+
+    def search(self, **params):
+        return self.client.get(reverse('search'), params)
+
+
+class SuggestTest(SearchViewTestCase):
+    def setUp(self):
+        super(SuggestTest, self).setUp()
+        suggest.indexes.clear()
+        for number in range(30):
+            Supplier.objects.create(name=u'Acme %02d' % number)
+        Supplier.objects.create(name=u'Other Acme')
+
+    def get_results(self, **params):
+        response = self.client.get(reverse('search_suggest'), params)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return loads(response.content)
+
+    def test_matches_values_and_words(self):
+        results = self.get_results(q=u'acme 1', limit=20)
+        self.assertEqual([result['label'] for result in results[0]['results']], [u'Acme %02d' % number for number in range(10, 20)])
+        results = self.get_results(q=u'OTHER')
+        self.assertEqual([result['label'] for result in results[0]['results']], [u'Other Acme'])
+        self.assertEqual(self.get_results(q=u'zzz'), [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.get_results(q=u'acme')[0]['results']), search_settings.SUGGEST_LIMIT)
+        self.assertEqual(len(self.get_results(q=u'acme', limit=50)[0]['results']), 20)
+        self.assertEqual(len(self.get_results(q=u'acme', limit=0)[0]['results']), 1)
+        self.assertEqual(len(self.get_results(q=u'acme', limit=u'x')[0]['results']), search_settings.SUGGEST_LIMIT)
+
+    def test_follows_changes(self):
+        self.assertEqual(self.get_results(q=u'newco'), [])
+        Supplier.objects.create(name=u'Newco')
+        self.assertEqual(len(self.get_results(q=u'newco')[0]['results']), 1)
+
+
+class SearchResultsTest(SearchViewTestCase):
+    def setUp(self):
+        super(SearchResultsTest, self).setUp()
+        self.set_search_settings(RESULTS_PER_MODEL=3, COUNT_LIMIT=20)
+        template = ItemTemplate.objects.create(description=u'Alpha')
+        for number in range(30):
+            Item.objects.create(item_template=template, property_number=u'A%03d' % number, notes=u'alpha')
+
+    def test_every_model_shows_its_first_results(self):
+        response = self.search(q=u'alpha')
+        entries = dict([(unicode(entry['text']), entry) for entry in response.context['found_entries']])
+        self.assertEqual((entries[u'assets']['count'], entries[u'assets']['more'], entries[u'assets']['show_more']), (20, True, True))
+        self.assertEqual((entries[u'templates']['count'], entries[u'templates']['more'], entries[u'templates']['show_more']), (1, False, False))
+        self.assertEqual(len(response.context['object_list']), 4)
+
+    def test_model_results_are_paginated(self):
+        response = self.search(q=u'alpha', model=u'assets.item', page=2)
+        self.assertEqual(len(response.context['object_list']), 20)
+        self.assertEqual(len(response.context['object_list'][10:20]), 10)
+        self.assertTrue(u'(11 - 20 out of 20)' in response.content)
+
+
+class MixedResultsTest(SearchViewTestCase):
+    def setUp(self):
+        super(MixedResultsTest, self).setUp()
+        self.set_search_settings(RESULTS_PER_MODEL=20)
+        template = ItemTemplate.objects.create(description=u'Printer')
+        spare_template = ItemTemplate.objects.create(description=u'Broken printer parts')
+        state = State.objects.create(name=u'Broken')
+        for number in range(12):
+            item = Item.objects.create(item_template=template, property_number=u'P%03d' % number)
+            ItemState.objects.create(item=item, state=state)
+        purchase_request = PurchaseRequest.objects.create()
+        for number in range(3):
+            PurchaseRequestItem.objects.create(purchase_request=purchase_request, item_template=spare_template, qty=1)
+
+    def test_page_of_several_models(self):
+        # The second page starts with states and ends with purchase
+        # request items, the prefetch of states only runs on the states
+        response = self.search(q=u'broken', page=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([type(obj) for obj in response.context['object_list'][10:16]], [ItemState] * 3 + [PurchaseRequestItem] * 3)
+
+
+class ConcurrentSearchTest(TestCase):
+    def setUp(self):
+        self.search_model = views.search_model
+        self.concurrent = search_settings.CONCURRENT
+        search_settings.CONCURRENT = True
+
+    def tearDown(self):
+        views.search_model = self.search_model
+        search_settings.CONCURRENT = self.concurrent
+
+    def test_keeps_the_model_order(self):
+        # The test database is only reachable from this thread
+        def search_model(backend, model, terms, deadline=None):
+            time.sleep(model is Item and 0.05 or 0)
+            return 1, [model]
+        views.search_model = search_model
+        self.assertEqual(views.search_models(None, [Item, Location, Supplier], [u'term']), [(1, [Item]), (1, [Location]), (1, [Supplier])])
+
+    def test_models_past_the_deadline_are_left_out(self):
+        def search_model(backend, model, terms, deadline=None):
+            time.sleep(model is Item and 0.5 or 0)
+            return 1, [model]
+        views.search_model = search_model
+        self.assertEqual(views.search_models(None, [Item, Location], [u'term'], time.time() + 0.2), [None, (1, [Location])])
+
+
+class RankingTest(SearchViewTestCase):
+    def setUp(self):
+        super(RankingTest, self).setUp()
+        self.in_notes = ItemTemplate.objects.create(description=u'Laptop', notes=u'sold by dell')
+        self.prefix = ItemTemplate.objects.create(description=u'Dell laptop')
+        self.exact = ItemTemplate.objects.create(description=u'DELL')
+        self.part_number = ItemTemplate.objects.create(description=u'Cable', part_number=u'dell')
+
+    def test_weights_and_boosts(self):
+        results = list(api.rank_results(ItemTemplate, api.get_backend().search(ItemTemplate, [u'dell']), [u'dell']))
+        self.assertEqual(results, [self.part_number, self.exact, self.prefix, self.in_notes])
+        self.assertEqual([result.search_score for result in results], [100, 30, 9, 1])
+
+    def test_results_of_every_model_are_merged_by_score(self):
+        Supplier.objects.create(name=u'Dell')
+        response = self.search(q=u'dell')
+        self.assertEqual([(obj.__class__, obj.search_score) for obj in response.context['object_list']], [
+            (ItemTemplate, 100), (ItemTemplate, 30), (Supplier, 10), (ItemTemplate, 9), (ItemTemplate, 1)])
+
+
+class ResultsCacheTest(SearchViewTestCase):
+    def setUp(self):
+        super(ResultsCacheTest, self).setUp()
+        # The test cache is only used by this process
+        self.set_search_settings(CACHE_TIMEOUT=300)
+        self.location = Location.objects.create(name=u'Depot')
+        self.calls = []
+
+    def get_cached(self, model, terms):
+        def function():
+            self.calls.append(model)
+            return len(self.calls)
+        return api.get_cached_search(model, terms, 'test', function)
+
+    def test_cached_until_the_model_changes(self):
+        terms = [u'cached', unicode(time.time())]
+        self.assertEqual(self.get_cached(Supplier, terms), 1)
+        self.assertEqual(self.get_cached(Supplier, terms), 1)
+        Supplier.objects.create(name=u'Acme')
+        self.assertEqual(self.get_cached(Supplier, terms), 2)
+
+    def test_cached_until_a_model_searched_through_changes(self):
+        terms = [u'related', unicode(time.time())]
+        self.assertEqual(self.get_cached(Inventory, terms), 1)
+        self.location.name = u'Store'
+        self.location.save()
+        self.assertEqual(self.get_cached(Inventory, terms), 2)
+
+    def test_queryset_updates_are_notified(self):
+        terms = [u'updated', unicode(time.time())]
+        self.assertEqual(self.get_cached(Location, terms), 1)
+        Location.objects.filter(pk=self.location.pk).update(name=u'Store')
+        api.objects_changed(Location, [self.location.pk])
+        self.assertEqual(self.get_cached(Location, terms), 2)
+
+
+class ResultsCacheSettingsTest(TestCase):
+    def load_settings(self, **values):
+        """
+        Returns the cache timeout the search settings get from the given
+        project settings
+        """
+        saved = dict([(name, getattr(settings._wrapped, name)) for name in values if hasattr(settings._wrapped, name)])
+        for name, value in values.items():
+            setattr(settings._wrapped, name, value)
+        try:
+            return reload(search_settings).CACHE_TIMEOUT
+        finally:
+            for name in values:
+                if name in saved:
+                    setattr(settings._wrapped, name, saved[name])
+                else:
+                    delattr(settings._wrapped, name)
+            reload(search_settings)
+
+    def test_only_on_with_a_shared_cache(self):
+        self.assertEqual(self.load_settings(CACHE_BACKEND='locmem://'), 0)
+        self.assertEqual(self.load_settings(CACHE_BACKEND='memcached://127.0.0.1:11211/'), 300)
+        self.assertEqual(self.load_settings(CACHE_BACKEND='memcached://127.0.0.1:11211/', DYNAMIC_SEARCH_CACHE_TIMEOUT=60), 60)
+        self.assertRaises(ImproperlyConfigured, self.load_settings, CACHE_BACKEND='locmem://', DYNAMIC_SEARCH_CACHE_TIMEOUT=60)
+
+
+class QueryGuardTest(SearchViewTestCase):
+    def setUp(self):
+        super(QueryGuardTest, self).setUp()
+        self.set_search_settings(MIN_TERM_LENGTH=2, MAX_TERMS=3, TIME_BUDGET=None)
+        Supplier.objects.create(name=u'Supplier one')
+
+    def get_messages(self, response):
+        return [message.message for message in response.context['messages']]
+
+    def test_clean_terms(self):
+        self.assertEqual(api.clean_terms([u'ab', u'a', u'AB', u'cd', u'ef', u'gh']), ([u'ab', u'cd', u'ef'], [u'a', u'gh']))
+
+    def test_ignored_terms_are_reported(self):
+        response = self.search(q=u'sup a')
+        self.assertEqual(len(response.context['object_list']), 1)
+        self.assertTrue([message for message in self.get_messages(response) if u'are ignored: a' in message])
+
+    def test_only_short_terms_search_nothing(self):
+        response = self.search(q=u'a')
+        self.assertEqual(response.context['found_entries'], [])
+
+    def test_time_budget(self):
+        self.assertEqual(api.call_before(time.time() - 1, Supplier.objects.count), None)
+        self.assertEqual(api.call_before(time.time() + 5, Supplier.objects.count), 1)
+
+        self.set_search_settings(TIME_BUDGET=0.000001)
+        for params in ({'q':u'supplier'}, {'q':u'supplier', 'model':u'inventory.supplier'}):
+            response = self.search(**params)
+            self.assertEqual(response.context['found_entries'], [])
+            self.assertTrue([message for message in self.get_messages(response) if u'took too long' in message])
+
+    def test_model_page_within_the_time_budget(self):
+        self.set_search_settings(TIME_BUDGET=5)
+        response = self.search(q=u'supplier', model=u'inventory.supplier')
+        self.assertEqual(list(response.context['object_list'][0:10]), list(Supplier.objects.all()))
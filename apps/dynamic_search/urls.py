@@ -3,6 +3,7 @@ from django.conf.urls.defaults import *
 
 urlpatterns = patterns('dynamic_search.views',
     url(r'^search/$', 'search', (), 'search'),
+    url(r'^suggest/$', 'search_suggest', (), 'search_suggest'),
 )
 
 
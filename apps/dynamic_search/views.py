@@ -1,81 +1,200 @@
-import re
-
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib import messages
+from django.db import connection
+from django.http import HttpResponse
 from django.shortcuts import render_to_response
 from django.template import RequestContext
+from django.utils.http import urlencode
+from django.utils.simplejson import dumps
 from django.utils.translation import ugettext as _
-from django.db.models import Q
 
-from api import search_list
+from api import search_list, normalize_query, get_query, get_backend, rank_results, get_cached_search, \
+    clean_terms, call_before
+from conf import settings as search_settings
 from forms import SearchForm
-
-#original code from:
-#http://www.julienphalip.com/blog/2008/08/16/adding-search-django-site-snap/
-
-def normalize_query(query_string,
-                    findterms=re.compile(r'"([^"]+)"|(\S+)').findall,
-                    normspace=re.compile(r'\s{2,}').sub):
-    ''' Splits the query string in invidual keywords, getting rid of unecessary spaces
-        and grouping quoted words together.
-        Example:
-
-        >>> normalize_query('  some random  words "with   quotes  " and   spaces')
-        ['some', 'random', 'words', 'with quotes', 'and', 'spaces']
-
-    '''
-    return [normspace(' ', (t[0] or t[1]).strip()) for t in findterms(query_string)]
-
-
-def get_query(terms, search_fields):
-    ''' Returns a query, that is a combination of Q objects. That combination
-        aims to search keywords within a model by testing the given search fields.
-
-    '''
-    query = None # Query to search for every search term
-    #terms = normalize_query(query_string)
-    for term in terms:
-        or_query = None # Query to search for a given term in each field
-        for field_name in search_fields:
-            q = Q(**{"%s__icontains" % field_name: term})
-            if or_query is None:
-                or_query = q
-            else:
-                or_query = or_query | q
-        if query is None:
-            query = or_query
-        else:
-            query = query & or_query
-    return query
+from suggest import suggest
+
+_pool = None
+
+
+def get_model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.module_name)
+
+
+def count_results(results):
+    # Count with a bounded query instead of loading every match
+    return len(results.order_by().values_list('pk', flat=True)[:search_settings.COUNT_LIMIT + 1])
+
+
+def get_results(backend, model, terms):
+    return rank_results(model, backend.search(model, terms), terms)
+
+
+def search_model(backend, model, terms, deadline=None):
+    def get_first_results():
+        results = get_results(backend, model, terms)
+        return count_results(results), list(results[:search_settings.RESULTS_PER_MODEL])
+    return call_before(deadline, get_cached_search, model, terms, 'first', get_first_results)
+
+
+def threaded_search_model(arguments):
+    # Each thread has a database connection of its own, close it
+    # when done instead of leaving it open in an idle pool thread
+    try:
+        return search_model(*arguments)
+    finally:
+        connection.close()
+
+
+class SearchResultsPage(object):
+    """
+    Stands for the results of a model to the paginator, with only the
+    objects of the requested page already fetched
+    """
+    def __init__(self, count, offset, objects):
+        self.length = count
+        self.offset = offset
+        self.objects = objects
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.objects[max((index.start or 0) - self.offset, 0):max((index.stop or self.length) - self.offset, 0)]
+        return self.objects[index - self.offset]
+
+
+def search_page(backend, model, terms, page, deadline=None):
+    """
+    Returns the (count, page offset, page objects) of a model or None if
+    the deadline passes first, the count is bounded by COUNT_LIMIT
+    """
+    per_page = getattr(settings, 'PAGINATION_DEFAULT_PAGINATION', 20)
+    results = get_results(backend, model, terms)
+    count = call_before(deadline, get_cached_search, model, terms, 'count', lambda:count_results(results))
+    if count is None:
+        return None
+    offset = (max(page, 1) - 1) * per_page
+    objects = call_before(deadline, get_cached_search, model, terms, 'page.%d.%d' % (offset, per_page),
+        lambda:list(results[offset:offset + per_page]))
+    if objects is None:
+        return None
+    return count, offset, objects
+
+
+def search_models(backend, models, terms, deadline=None):
+    """
+    Returns the (count, first objects) of every model in the same order
+    as the given models list, None for the models not searched before
+    the deadline
+    """
+    global _pool
+    if search_settings.CONCURRENT and len(models) > 1:
+        if _pool is None:
+            _pool = ThreadPool(search_settings.MAX_WORKERS)
+        tasks = [_pool.apply_async(threaded_search_model, [(backend, model, terms, deadline)]) for model in models]
+        model_results = []
+        for task in tasks:
+            try:
+                model_results.append(task.get(deadline and max(deadline - time.time(), 0)))
+            except TimeoutError:
+                model_results.append(None)
+        return model_results
+    else:
+        return [search_model(backend, model, terms, deadline) for model in models]
 
 
 def search(request):
     query_string = ''
-    found_entries = {}
+    model_label = request.GET.get('model', None)
+    found_entries = []
     object_list = []
+    backend = get_backend()
 
     if ('q' in request.GET) and request.GET['q'].strip():
         query_string = request.GET['q']
         form = SearchForm(initial={'q':query_string})
 
-        terms = normalize_query(query_string)
+        terms, ignored_terms = clean_terms(normalize_query(query_string))
+        if ignored_terms:
+            messages.warning(request, _(u'Terms shorter than %(length)d characters or beyond the first %(count)d are ignored: %(terms)s') % {
+                'length':search_settings.MIN_TERM_LENGTH, 'count':search_settings.MAX_TERMS, 'terms':u', '.join(ignored_terms)})
 
-        for model, data in search_list.items():
-            query = get_query(terms, data['fields'])
+        models = [model for model in search_list.keys() if terms and (not model_label or get_model_label(model) == model_label)]
+        deadline = search_settings.TIME_BUDGET and time.time() + search_settings.TIME_BUDGET or None
 
-            results = model.objects.filter(query)
-            if results:
-                found_entries[data['text']] = results
-                for result in results:
-                    object_list.append(result)
+        if model_label:
+            model_results = []
+            if models:
+                # Only the requested page is fetched, within the time budget
+                page = search_page(backend, models[0], terms, request.page, deadline)
+                model_results.append(page and (page[0], []))
+        else:
+            model_results = search_models(backend, models, terms, deadline)
+
+        if None in model_results:
+            messages.warning(request, _(u'The search took too long, only part of the results are shown.'))
+
+        for model, model_result in zip(models, model_results):
+            if not model_result or not model_result[0]:
+                continue
+            count, objects = model_result
+
+            found_entries.append({
+                'text':search_list[model]['text'],
+                'count':min(count, search_settings.COUNT_LIMIT),
+                'more':count > search_settings.COUNT_LIMIT,
+                'url_query':urlencode({'q':query_string.encode('utf-8'), 'model':get_model_label(model)}),
+                'show_more':not model_label and count > search_settings.RESULTS_PER_MODEL,
+            })
+            object_list.extend(objects)
+
+        if model_label and found_entries:
+            count, offset, objects = page
+            object_list = SearchResultsPage(min(count, search_settings.COUNT_LIMIT), offset, objects)
+        else:
+            # Most relevant first across all the models, ties keep the
+            # registration order
+            object_list.sort(key=lambda obj:obj.search_score, reverse=True)
     else:
         form = SearchForm()
 
+    extra_columns = [{'name':_(u'type'), 'attribute':lambda x:x._meta.verbose_name[0].upper() + x._meta.verbose_name[1:]}]
+    if backend.snippets:
+        extra_columns.append({'name':_(u'match'), 'attribute':lambda x:backend.get_snippet(x)})
+
     return render_to_response('search_results.html', {
                             'query_string':query_string,
+                            'all_results_query':urlencode({'q':query_string.encode('utf-8')}),
+                            'model_label':model_label,
                             'found_entries':found_entries,
                             'form':form,
                             'object_list':object_list,
                             'form_title':_(u'Search'),
-                            'extra_columns':[{'name':_(u'type'), 'attribute':lambda x:x._meta.verbose_name[0].upper() + x._meta.verbose_name[1:]}],
+                            'extra_columns':extra_columns,
                             'title':_(u'results with: %s') % query_string
                             },
                           context_instance=RequestContext(request))
+
+
+def search_suggest(request):
+    try:
+        limit = max(1, min(int(request.GET.get('limit', search_settings.SUGGEST_LIMIT)), 20))
+    except ValueError:
+        limit = search_settings.SUGGEST_LIMIT
+
+    results = []
+    query_string = request.GET.get('q', '').strip()
+    if query_string:
+        for model, objects in suggest(query_string, limit):
+            results.append({
+                'text':unicode(search_list[model]['text']),
+                'results':[{'id':obj.pk, 'label':unicode(obj), 'url':obj.get_absolute_url()} for obj in objects],
+            })
+
+    return HttpResponse(dumps(results), mimetype='application/json')
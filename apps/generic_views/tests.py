@@ -5,8 +5,18 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+import datetime
+import re
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
 from django.test import TestCase
 
+from assets.models import Item, ItemState, State
+from common.db import prefetch_list_relations, get_keyset_ordering, encode_cursor, decode_cursor, get_keyset_page
+from inventory.models import ItemTemplate, Inventory, InventoryTransaction, Location
+from movements.models import PurchaseRequest, PurchaseRequestItem
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -14,6 +24,109 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+
+class PrefetchListRelationsTest(TestCase):
+    def setUp(self):
+        template = ItemTemplate.objects.create(description=u'Printer')
+        state = State.objects.create(name=u'Broken')
+        self.item = Item.objects.create(item_template=template, property_number=u'P001')
+        self.item_state = ItemState.objects.create(item=Item.objects.create(item_template=template, property_number=u'P002'), state=state)
+        self.purchase_request_item = PurchaseRequestItem.objects.create(purchase_request=PurchaseRequest.objects.create(), item_template=template, qty=1)
+
+    def test_runs_each_models_prefetch_on_its_objects(self):
+        objects = [self.item_state, self.purchase_request_item, self.item]
+        self.assertEqual(prefetch_list_relations(iter(objects)), objects)
+        self.assertEqual(self.item_state.item._state_names_cache, [u'Broken'])
+        self.assertEqual(self.item._state_names_cache, [])
+        self.assertFalse(hasattr(self.purchase_request_item, '_state_names_cache'))
+
+    def test_attribute_skips_the_objects_without_it(self):
+        location = Location.objects.create(name=u'Depot')
+        prefetch_list_relations([location, self.item_state], 'item')
+        self.assertEqual(self.item_state.item._state_names_cache, [u'Broken'])
+
+
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        self.templates = [ItemTemplate.objects.create(description=u'Template %02d' % number) for number in range(25)]
+
+    def get_pages(self, queryset, per_page=10):
+        pages = []
+        cursor = None
+        while True:
+            page = get_keyset_page(queryset, cursor, per_page)
+            pages.append(page['object_list'])
+            cursor = page['next_cursor']
+            if not cursor:
+                return pages
+
+    def test_ordering_ends_with_the_primary_key(self):
+        opts = ItemTemplate._meta
+        self.assertEqual(get_keyset_ordering(ItemTemplate.objects.all()), [(opts.get_field('description'), False), (opts.pk, False)])
+        self.assertEqual(get_keyset_ordering(ItemTemplate.objects.order_by('-pk', 'description')), [(opts.pk, True)])
+        opts = InventoryTransaction._meta
+        self.assertEqual(get_keyset_ordering(InventoryTransaction.objects.all()), [(opts.get_field('date'), True), (opts.pk, True)])
+
+    def test_unsupported_orderings(self):
+        self.assertEqual(get_keyset_ordering(Item.objects.order_by('item_template__description')), None)
+        self.assertEqual(get_keyset_ordering(Item.objects.order_by('item_template')), None)
+        self.assertEqual(get_keyset_ordering(ItemTemplate.objects.extra(select={'x':'1'}, order_by=['x'])), None)
+        self.assertEqual(get_keyset_page(Item.objects.order_by('item_template')), None)
+
+    def test_cursor_round_trip(self):
+        ordering = get_keyset_ordering(InventoryTransaction.objects.all())
+        date = datetime.date(2010, 12, 31)
+        self.assertEqual(decode_cursor(ordering, encode_cursor([date, 7])), ([date, 7], False))
+        self.assertEqual(decode_cursor(ordering, encode_cursor([date, 7], backwards=True)), ([date, 7], True))
+        self.assertRaises(ValueError, decode_cursor, ordering, encode_cursor([7]))
+
+    def test_next_pages_cover_every_row_once(self):
+        pages = self.get_pages(ItemTemplate.objects.all())
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), self.templates)
+
+    def test_ties_are_broken_by_the_primary_key(self):
+        location = Location.objects.create(name=u'Depot')
+        inventory = Inventory.objects.create(name=u'Main', location=location)
+        transactions = [InventoryTransaction.objects.create(inventory=inventory, supply=self.templates[0], quantity=1,
+            date=datetime.date(2010, 1, 1 + number % 3)) for number in range(9)]
+        pages = self.get_pages(InventoryTransaction.objects.all(), 4)
+        self.assertEqual(sum(pages, []), list(InventoryTransaction.objects.order_by('-date', '-id')))
+        self.assertEqual(len(set(sum(pages, []))), len(transactions))
+
+    def test_previous_pages(self):
+        first = get_keyset_page(ItemTemplate.objects.all())
+        self.assertEqual(first['previous_cursor'], None)
+        second = get_keyset_page(ItemTemplate.objects.all(), first['next_cursor'])
+        third = get_keyset_page(ItemTemplate.objects.all(), second['next_cursor'])
+        self.assertEqual(third['next_cursor'], None)
+
+        back = get_keyset_page(ItemTemplate.objects.all(), third['previous_cursor'])
+        self.assertEqual(back['object_list'], second['object_list'])
+        self.assertTrue(back['next_cursor'] and back['previous_cursor'])
+        self.assertEqual(get_keyset_page(ItemTemplate.objects.all(), back['previous_cursor']), first)
+
+    def test_invalid_cursors_show_the_first_page(self):
+        first = get_keyset_page(ItemTemplate.objects.all())
+        for cursor in [u'garbage', encode_cursor([u'x']), encode_cursor([u'Template 05', u'x'])]:
+            self.assertEqual(get_keyset_page(ItemTemplate.objects.all(), cursor), first)
+
+    def test_list_view_follows_the_cursor(self):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        for number in range(15):
+            Item.objects.create(item_template=self.templates[0], property_number=u'P%03d' % number)
+
+        response = self.client.get(reverse('item_list'))
+        self.assertTrue(u'P009' in response.content and u'P010' not in response.content)
+        self.assertFalse('class="prev_page"' in response.content)
+        next_url = re.search(r'<a class="next_page" href="([^"]+)"', response.content).group(1)
+
+        response = self.client.get(reverse('item_list') + next_url.replace('&amp;', '&'))
+        self.assertTrue(u'P009' not in response.content and u'P014' in response.content)
+        self.assertTrue('class="prev_page"' in response.content)
+        self.assertFalse('class="next_page"' in response.content)
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
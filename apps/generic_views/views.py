@@ -3,7 +3,7 @@ import urllib
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.contrib import messages
 from django.db.models import Q
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
@@ -29,7 +29,16 @@ def add_filter(request, list_filters):
 
     return filter_form, filters
 
-def generic_list(request, list_filters=[], queryset_filter=None, *args, **kwargs):
+def generic_list(request, list_filters=[], queryset_filter=None, select_related=None, keyset=False, *args, **kwargs):
+    #The template joins the relations it finds, these are declared by the url
+    if select_related:
+        kwargs['queryset'] = kwargs['queryset'].select_related(*select_related)
+
+    #Pages seeking to a cursor instead of counting rows with OFFSET, for
+    #big tables
+    if keyset:
+        kwargs.setdefault('extra_context', {})['keyset_pagination'] = True
+
     if list_filters:
         filter_form, filters = add_filter(request, list_filters)
         if filters:
@@ -50,7 +59,13 @@ def generic_delete(*args, **kwargs):
     else:
         kwargs['extra_context'] = {'delete_view':True}
 
-    return delete_object(template_name='generic_confirm.html', *args, **kwargs)
+    try:
+        return delete_object(template_name='generic_confirm.html', *args, **kwargs)
+    except ValidationError, err:
+        # Objects that refuse to be deleted
+        request = args[0]
+        messages.error(request, u' '.join(err.messages))
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER', kwargs['post_delete_redirect']))
 
 def generic_confirm(request, _view, _title=None, _model=None, _object_id=None, _message='', *args, **kwargs):
     if request.method == 'POST':
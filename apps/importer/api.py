@@ -1,10 +1,214 @@
+import bz2
+import cPickle
 import csv
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+import traceback
+import zlib
+import zipfile
+from collections import deque
+from cStringIO import StringIO
+from itertools import islice
+from multiprocessing import Pool
 
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import EMPTY_VALUES
+from django.db import models, transaction
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import pre_save, post_save
+from django.utils.datastructures import SortedDict
 from django.utils.translation import ugettext_lazy as _
-from django.utils.encoding import smart_unicode
+from django.utils.encoding import smart_unicode, smart_str, force_unicode
+from django.utils.hashcompat import md5_constructor
+from django.utils.simplejson import dumps, loads
 
-def perform_import(csvfilename, model, mappings, dialect_settings=None, start_row=1, dryrun=True):
-    csvfile = open(csvfilename, 'rb')
+from common.db import bulk_insert, bulk_update
+from dynamic_search.api import search_list, get_backend, bump_model_version
+from dynamic_search.suggest import invalidate_index
+
+from conf import settings as importer_settings
+from models import ImportJob, JOB_STATE_PENDING, JOB_STATE_RUNNING, JOB_STATE_DONE, JOB_STATE_FAILED
+
+#Keep the IN clauses below the SQLite bound parameters limit
+LOOKUP_CHUNK_SIZE = 500
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_BZ2 = 'bz2'
+
+COMPRESSED_EXTENSIONS = {
+    '.gz':COMPRESSION_GZIP,
+    '.bz2':COMPRESSION_BZ2,
+}
+#Bytes of a compressed file read at a time
+COMPRESSED_READ_SIZE = 64 * 1024
+
+EXPORT_FORMAT_CSV = 'csv'
+EXPORT_FORMAT_JSON_LINES = 'jsonl'
+
+EXPORT_FORMAT_CHOICES = (
+    (EXPORT_FORMAT_CSV, _(u'CSV')),
+    (EXPORT_FORMAT_JSON_LINES, _(u'JSON lines')),
+)
+
+EXPORT_MIMETYPES = {
+    EXPORT_FORMAT_CSV:'text/csv',
+    EXPORT_FORMAT_JSON_LINES:'application/x-json-lines',
+}
+
+
+def get_compression(filename):
+    return COMPRESSED_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+
+def is_finished(decompressor):
+    """
+    Returns True if a gzip or bz2 decompressor reached the end of its
+    stream, neither of them tells
+    """
+    if isinstance(decompressor, bz2.BZ2Decompressor):
+        try:
+            decompressor.decompress('')
+        except EOFError:
+            return True
+        return False
+
+    # Data after the end of the stream is left unused
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return bool(probe.unused_data)
+
+
+def decompress_chunks(chunks, compression=None):
+    """
+    Yields the data of the chunks of a file compressed with gzip or bz2
+    as it is decompressed, or as is without compression.  Raises
+    zlib.error, IOError or EOFError for invalid data, EOFError for
+    truncated files
+    """
+    if not compression:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    decompressor = None
+    for chunk in chunks:
+        while chunk:
+            if decompressor is None:
+                if compression == COMPRESSION_GZIP:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    decompressor = bz2.BZ2Decompressor()
+            yield decompressor.decompress(chunk)
+            # Files concatenated into one have several streams
+            chunk = decompressor.unused_data
+            if chunk:
+                decompressor = None
+    if decompressor is None or not is_finished(decompressor):
+        raise EOFError(_(u'The compressed file ended before the end of its data.'))
+    if compression == COMPRESSION_GZIP:
+        yield decompressor.flush()
+
+
+class DecompressedFile(object):
+    """
+    Read only file of the data of a gzip or bz2 compressed file,
+    decompressed as it is read.  It can only be read forward or rewound
+    with seek(0), the errors of decompress_chunks are raised as IOError
+    once reached
+    """
+    def __init__(self, filename, compression):
+        self.name = filename
+        self.compression = compression
+        self.file = open(filename, 'rb')
+        self.seek(0)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def decompress(self):
+        """
+        Adds the next decompressed chunk to the buffer, returns False at
+        the end of the file
+        """
+        try:
+            self.buffer += self.chunks.next()
+        except StopIteration:
+            return False
+        except (zlib.error, EOFError), err:
+            raise IOError(_(u'Could not decompress %(file)s: %(err)s') % {'file':self.name, 'err':err})
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self.decompress():
+            pass
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        searched = 0
+        end = self.buffer.find('\n')
+        while end < 0:
+            searched = len(self.buffer)
+            if not self.decompress():
+                end = len(self.buffer) - 1
+                break
+            end = self.buffer.find('\n', searched)
+        data, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset or whence != os.SEEK_SET:
+            raise IOError(_(u'Compressed files can only be read again from the start.'))
+        self.file.seek(0)
+        self.chunks = decompress_chunks(iter(lambda: self.file.read(COMPRESSED_READ_SIZE), ''), self.compression)
+        self.buffer = ''
+
+    def close(self):
+        self.file.close()
+
+
+def open_csv_file(filename):
+    """
+    Opens a stored CSV file for reading, decompressed as it is read if
+    its name ends in .gz or .bz2.  The wizard preview, test runs and
+    imports all read the files through it
+    """
+    compression = get_compression(filename)
+    if compression:
+        return DecompressedFile(filename, compression)
+    return open(filename, 'rb')
+
+
+def get_preview(csvfile, lines=10):
+    """
+    Returns the dialect sniffed from the start of an open file and its
+    first lines
+    """
+    dialect = csv.Sniffer().sniff(csvfile.read(1024))
+    csvfile.seek(0)
+    preview = ''.join([csvfile.readline() for i in range(lines)])
+    csvfile.seek(0)
+    return dialect, preview
+
+
+def get_dialect(csvfile, dialect_settings=None):
     dialect = csv.Sniffer().sniff(csvfile.read(1024))
     if dialect_settings:
         dialect.delimiter = str(dialect_settings['dialect_delimiter'])
@@ -14,61 +218,1012 @@ def perform_import(csvfilename, model, mappings, dialect_settings=None, start_ro
         dialect.skipinitialspace = dialect_settings['dialect_skipinitialspace']
 
     csvfile.seek(0)
+    return dialect
+
+
+def read_rows(csvfile, dialect, start_row=1):
+    """
+    Yields the line number and the unicode columns of every row from
+    start_row on, reading the file as it goes
+    """
+    for line, row in enumerate(islice(csv.reader(csvfile, dialect=dialect), start_row - 1, None), start_row):
+        yield line, [smart_unicode(c) for c in row]
+
+
+def sample_rows(csvfile, dialect, start_row=1, head_size=0, sample_size=0, seed=None):
+    """
+    Returns the number of rows from start_row on and the (line, columns)
+    of the first head_size ones plus sample_size more picked at random
+    from the rest, in file order
+    """
+    generator = random.Random(seed)
+    head = []
+    reservoir = []
+    count = 0
+    for line, column in read_rows(csvfile, dialect, start_row):
+        count += 1
+        if count <= head_size:
+            head.append((line, column))
+        elif len(reservoir) < sample_size:
+            reservoir.append((line, column))
+        else:
+            index = generator.randint(0, count - head_size - 1)
+            if index < sample_size:
+                reservoir[index] = (line, column)
+    return count, head + sorted(reservoir)
 
+
+def get_parsed_filename(csvfilename, mappings, dialect_settings):
+    """
+    Returns the name of the file keeping the rows parsed by a test run,
+    next to the stored file so the final import finds it whichever worker
+    runs it.  It ends with a hash of the path, size and modification time
+    of the stored file and of the settings parsing it, without reading
+    the file
+    """
+    stat = os.stat(csvfilename)
+    key = md5_constructor(dumps([os.path.abspath(csvfilename), stat.st_size, stat.st_mtime, mappings, dialect_settings], sort_keys=True)).hexdigest()
+    return '%s.%s.parsed' % (csvfilename, key)
+
+
+def save_parsed_rows(filename, parsed):
+    # Renamed once written, a worker reading it never finds half of it
+    destination, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    destination = os.fdopen(destination, 'wb')
     try:
-        csvfd = file(csvfilename, 'r')
-    except IOError:
-        self.error(_(u'Could not open specified csv file, %s, or it does not exist') % datafile, 0)
+        cPickle.dump(parsed, destination, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        destination.close()
+    os.rename(temporary, filename)
+
+
+def load_parsed_rows(filename):
+    """
+    Returns the rows saved by save_parsed_rows, none if the file is
+    missing, unreadable or older than IMPORTER_PARSED_CACHE_TIMEOUT
+    """
+    try:
+        if time.time() - os.path.getmtime(filename) > importer_settings.PARSED_CACHE_TIMEOUT:
+            return {}
+        parsedfile = open(filename, 'rb')
+        try:
+            return cPickle.load(parsedfile)
+        finally:
+            parsedfile.close()
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return {}
+
+
+def remove_parsed_rows(csvfilename):
+    """
+    Deletes the files of rows parsed by the test runs of a stored file
+    """
+    directory, name = os.path.split(os.path.abspath(csvfilename))
+    for filename in os.listdir(directory):
+        if filename.startswith('%s.' % name) and filename.endswith('.parsed'):
+            os.unlink(os.path.join(directory, filename))
+
+
+def has_save_hooks(model):
+    """
+    Returns True if saving an instance of model runs more than the
+    INSERT: an overridden save method, save signal receivers connected
+    for the model or a search index to update.  Those models can't be
+    written with bulk_insert
+    """
+    if model.save.im_func is not models.Model.save.im_func:
+        return True
+
+    for signal in (pre_save, post_save):
+        if [key for key, receiver in signal.receivers if key[1] == id(model)]:
+            return True
+
+    return model in search_list and get_backend().indexed
+
+
+@transaction.commit_on_success
+def save_chunk(model, chunk, bulk=False, updates=None, saved=None):
+    """
+    Saves the (line, instance) pairs of a chunk and the (line, instance,
+    changed field names) of the updated existing rows in a single
+    transaction, returns the (line, error) pairs of the instances that
+    failed.  saved, if given, is called with those in the same
+    transaction, before it is committed
+    """
+    updates = updates or []
+    failed = []
+    if bulk:
+        bulk_insert(model, [instance for line, instance in chunk])
+        # One statement per set of changed fields
+        changes = {}
+        for line, instance, field_names in updates:
+            changes.setdefault(tuple(field_names), []).append(instance)
+        for field_names, instances in changes.items():
+            bulk_update(model, instances, field_names)
     else:
-        # CSV Reader returns an iterable, but as we possibly need to
-        # perform list commands and since list is an acceptable iterable,
-        # we'll just transform it.
-        csvfile = list(csv.reader(csvfd, dialect=dialect))
+        for line, instance in chunk + [(line, instance) for line, instance, field_names in updates]:
+            sid = transaction.savepoint()
+            try:
+                instance.save()
+                transaction.savepoint_commit(sid)
+            except Exception, err:
+                transaction.savepoint_rollback(sid)
+                failed.append((line, err))
+
+    if saved:
+        saved(failed)
+        transaction.set_dirty()
+    return failed
 
+
+def write_chunk(model, chunk, bulk=False, updates=None, saved=None):
+    if bulk:
+        try:
+            return save_chunk(model, chunk, bulk=True, updates=updates, saved=saved)
+        except Exception:
+            # Saved again one by one to find the failing lines
+            pass
+    return save_chunk(model, chunk, updates=updates, saved=saved)
+
+
+def get_default_mappings(model):
+    """
+    Returns a mapping for every exported field, each reading the CSV
+    column in the same position as the field
+    """
+    mappings = []
+    for num, field in enumerate(get_export_fields(model)):
+        mapping = {
+            'model_field':field.name,
+            'expression':'"%%s" %% csv_column[%s]' % num,
+            'enabled':True,
+            }
+        if field.null:
+            # Exported as empty values
+            mapping['expression'] = 'csv_column[%s] or None' % num
+        if field.rel:
+            mapping['arguments'] = 'pk'
+        mappings.append(mapping)
+    return mappings
+
+
+def get_export_fields(model):
+    """
+    Returns the fields written by an export and read by the default
+    mappings, in the same order: all but the id and the fields filled
+    in by the model itself
+    """
+    return [field for field in model._meta.fields if field.name != 'id' and field.editable]
+
+
+def export_rows(model, format=EXPORT_FORMAT_CSV, queryset=None):
+    """
+    Yields the rows of the queryset, all the rows of the model by
+    default, as CSV or JSON lines.  The rows are fetched in chunks of
+    IMPORTER_EXPORT_CHUNK_SIZE after the primary key of the previous
+    chunk, each chunk is yielded once written, foreign keys are written
+    as the primary key of the related object
+    """
+    names = [field.name for field in get_export_fields(model)]
+    if queryset is None:
+        queryset = model.objects.all()
+    queryset = queryset.order_by('pk')
+
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        output = StringIO()
+        writer = csv.writer(output)
+        count = 0
+        for row in chunk.values_list('pk', *names)[:importer_settings.EXPORT_CHUNK_SIZE].iterator():
+            count += 1
+            last_pk = row[0]
+            if format == EXPORT_FORMAT_JSON_LINES:
+                output.write(dumps(dict(zip(names, row[1:])), cls=DjangoJSONEncoder))
+                output.write('\n')
+            else:
+                writer.writerow([value is not None and smart_str(value) or '' for value in row[1:]])
+        if count:
+            yield output.getvalue()
+        if count < importer_settings.EXPORT_CHUNK_SIZE:
+            break
+
+
+def compile_mappings(model, mappings):
+    """
+    Returns the enabled mappings as (field name, field, related model,
+    code, arguments, expression) tuples with every expression compiled
+    once for the whole import, related model is None for fields that
+    aren't foreign keys.  Raises KeyError for unknown fields and
+    SyntaxError for invalid expressions
+    """
     model_fields = model._meta.init_name_map()
-    imported_lines = 0
-    errors = 0
-    results = []
-    for line, column in enumerate(csvfile[start_row-1:], start_row):
-        column = [smart_unicode(c) for c in column]
-        model_line = {}
-        line_error = False
-        for field_exp in mappings:
-            if field_exp['enabled']:
-                expression = None
+    compiled = []
+    for field_exp in mappings:
+        if field_exp['enabled']:
+            field = model_fields[field_exp['model_field']][0]
+            related_model = hasattr(field, 'related') and field.related.parent_model or None
+            code = compile(field_exp['expression'], '<%s expression>' % field_exp['model_field'], 'eval')
+            compiled.append((field_exp['model_field'], field, related_model, code, field_exp.get('arguments'), field_exp['expression']))
+    return compiled
+
+
+def parse_row(compiled, column):
+    """
+    Evaluates the expressions of a row and converts the values of the
+    fields that aren't foreign keys, those are resolved later in chunks.
+    Returns the values and a list of (value, error message) of the
+    fields that failed
+    """
+    values = {}
+    errors = []
+    namespace = {'csv_column':column}
+    for field_name, field, related_model, code, arguments, expression in compiled:
+        value = None
+        try:
+            value = eval(code, namespace)
+            if not related_model:
+                value = field.to_python(value)
+            values[field_name] = value
+        except Exception, err:
+            errors.append((value, force_unicode(err)))
+    return values, errors
+
+
+def get_shards(csvfile, start_row=1, shard_size=None):
+    """
+    Returns the (start, end) byte offsets of pieces of about shard_size
+    bytes of the file from the line start_row on, ending at line
+    boundaries.  Quoted values spanning several lines are not supported
+    """
+    csvfile.seek(0)
+    for line in range(start_row - 1):
+        csvfile.readline()
+    start = csvfile.tell()
+    csvfile.seek(0, os.SEEK_END)
+    size = csvfile.tell()
+
+    shards = []
+    while start < size:
+        csvfile.seek(min(start + (shard_size or importer_settings.SHARD_SIZE), size))
+        csvfile.readline()
+        end = csvfile.tell()
+        shards.append((start, end))
+        start = end
+    return shards
+
+
+def parse_shard(arguments):
+    """
+    Runs in the worker processes of a parallel import, parses the rows
+    of a shard without touching the database.  Returns the number of
+    lines and the (line in the shard, values, errors) of every row
+    """
+    csvfilename, start, end, dialect_settings, model, mappings = arguments
+    csvfile = open(csvfilename, 'rb')
+    dialect = get_dialect(csvfile, dialect_settings)
+    csvfile.seek(start)
+    shard = StringIO(csvfile.read(end - start))
+    csvfile.close()
+
+    compiled = compile_mappings(model, mappings)
+    rows = []
+    for line, column in read_rows(shard, dialect):
+        values, errors = parse_row(compiled, column)
+        rows.append((line, values, errors))
+    return len(rows), rows
+
+
+def parse_rows(csvfile, dialect, compiled, start_row=1, processes=1, shard_arguments=None, parsed=None):
+    """
+    Yields the line number, values and errors of every row, parsed here
+    or with processes > 1 by a pool of worker processes each parsing a
+    shard of the file while the rows of the finished shards are yielded
+    in order.  Parsed here, the lines in the parsed map of line: (values,
+    errors) are taken from it
+    """
+    if processes <= 1:
+        parsed = parsed or {}
+        for line, column in read_rows(csvfile, dialect, start_row):
+            if line in parsed:
+                values, errors = parsed[line]
+                yield line, dict(values), errors
+            else:
+                values, errors = parse_row(compiled, column)
+                yield line, values, errors
+        return
+
+    csvfilename, dialect_settings, model, mappings = shard_arguments
+    shards = iter([(csvfilename, start, end, dialect_settings, model, mappings) for start, end in get_shards(csvfile, start_row)])
+    pool = Pool(processes)
+    # Only IMPORTER_PENDING_SHARDS per process are submitted ahead of the
+    # shard being saved, the parsed rows would pile up in memory otherwise
+    pending = deque([pool.apply_async(parse_shard, (shard,)) for shard in islice(shards, processes * importer_settings.PENDING_SHARDS)])
+    try:
+        first_line = start_row
+        while pending:
+            line_count, rows = pending.popleft().get()
+            for shard in islice(shards, 1):
+                pending.append(pool.apply_async(parse_shard, (shard,)))
+            for line, values, errors in rows:
+                yield first_line + line - 1, values, errors
+            first_line += line_count
+    finally:
+        pool.terminate()
+
+
+class LRUCache(object):
+    """
+    Map keeping the size entries used last, reading an entry refreshes
+    it.  Every use is appended to a queue and counted, the entries are
+    evicted from the front of the queue once their last use is reached,
+    older uses of an entry are skipped.  The queue is compacted when the
+    skipped uses outgrow the entries
+    """
+    def __init__(self, size):
+        self.size = size
+        self.data = {}
+        self.order = deque()
+        #key: uses of the key in the queue
+        self.uses = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        self.touch(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.touch(key)
+        while len(self.data) > self.size:
+            key = self.order.popleft()
+            self.uses[key] -= 1
+            if not self.uses[key]:
+                del self.uses[key]
+                self.data.pop(key, None)
+
+    def pop(self, key, default=None):
+        # Its uses left in the queue are skipped once reached
+        return self.data.pop(key, default)
+
+    def touch(self, key):
+        self.order.append(key)
+        self.uses[key] = self.uses.get(key, 0) + 1
+        if len(self.order) > 2 * max(self.size, 1):
+            self.compact()
+
+    def compact(self):
+        # Only the last use of the entries left is kept
+        order = deque()
+        seen = set()
+        for key in reversed(self.order):
+            if key not in seen:
+                seen.add(key)
+                if key in self.data:
+                    order.appendleft(key)
+        self.order = order
+        self.uses = dict([(key, 1) for key in order])
+
+
+class ForeignKeyResolver(object):
+    """
+    Resolves the foreign key values of an import to the related objects.
+    The distinct values of a chunk are fetched with one __in query per
+    related field and kept in a map of the last
+    IMPORTER_RESOLVER_CACHE_SIZE entries used.  Lookups that can't be batched
+    (spanning relations or with a lookup type) are fetched one value at a
+    time, memoized as well.  With create_missing the related objects not
+    found are created, in bulk when their model has no save hooks, dry
+    runs only build them
+    """
+    def __init__(self, create_missing=False, dryrun=True, key_fields=None):
+        self.create_missing = create_missing
+        self.dryrun = dryrun
+        #(model, arguments, value): related object or the exception to raise
+        self.cache = LRUCache(importer_settings.RESOLVER_CACHE_SIZE)
+        #model: lookup arguments of the foreign keys of the later imports
+        #of a bundle referencing it, see remember
+        self.key_fields = key_fields or {}
+
+    def get_lookup_field(self, model, arguments):
+        if arguments == 'pk':
+            return model._meta.pk
+        try:
+            field = model._meta.get_field(arguments)
+        except FieldDoesNotExist:
+            return None
+        if field.rel:
+            return None
+        return field
+
+    def store(self, key, result):
+        self.cache[key] = result
+
+    def prefetch(self, model, arguments, values):
+        field = self.get_lookup_field(model, arguments)
+        if field is None:
+            return
+
+        keys = set()
+        for value in values:
+            try:
+                key = field.to_python(value)
+            except ValidationError:
+                continue
+            if (model, arguments, key) not in self.cache:
+                keys.add(key)
+        if not keys:
+            return
+
+        keys = list(keys)
+        found = {}
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            for obj in model.objects.filter(**{'%s__in' % arguments:keys[start:start + LOOKUP_CHUNK_SIZE]}):
+                found.setdefault(getattr(obj, field.attname), []).append(obj)
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.create_missing and not field.primary_key:
+            found.update(self.create(model, field, missing))
+
+        for key in keys:
+            result = found.get(key)
+            if not result:
+                result = model.DoesNotExist('%s matching query does not exist.' % model._meta.object_name)
+            elif isinstance(result, list) and len(result) > 1:
+                result = model.MultipleObjectsReturned('get() returned more than one %s -- it returned %s! Lookup parameters were %s' % (model._meta.object_name, len(result), {arguments:key}))
+            elif isinstance(result, list):
+                result = result[0]
+            self.store((model, arguments, key), result)
+
+    def create(self, model, field, keys):
+        """
+        Creates a related object for each of the keys, returns a
+        dictionary of key: list of objects or the creation error
+        """
+        instances = [(key, model(**{field.name:key})) for key in keys]
+        if self.dryrun:
+            return dict([(key, [instance]) for key, instance in instances])
+
+        bulk = not has_save_hooks(model)
+        created = dict([(key, err) for key, err in write_chunk(model, instances, bulk)])
+        if bulk:
+            bump_model_version(model)
+            invalidate_index(model)
+
+        keys = [key for key in keys if key not in created]
+        for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+            for obj in model.objects.filter(**{'%s__in' % field.name:keys[start:start + LOOKUP_CHUNK_SIZE]}):
+                created.setdefault(getattr(obj, field.attname), []).append(obj)
+        return created
+
+    def remember(self, model, instances):
+        """
+        Keeps the imported instances of a model referenced by the later
+        imports of a bundle by their lookup values, the unsaved ones of
+        a test run included.  Rows written in bulk have no primary key
+        yet and are fetched back with one __in query per lookup
+        """
+        for arguments in self.key_fields.get(model, []):
+            field = self.get_lookup_field(model, arguments)
+            if field is None:
+                continue
+            written = []
+            for instance in instances:
+                if instance.pk is None and not self.dryrun:
+                    written.append(getattr(instance, field.attname))
+                elif instance.pk is not None or not field.primary_key:
+                    self.store((model, arguments, getattr(instance, field.attname)), instance)
+            if written:
+                # Looked up again if cached as missing
+                for value in written:
+                    self.cache.pop((model, arguments, field.to_python(value)), None)
+                self.prefetch(model, arguments, written)
+
+    def resolve(self, model, arguments, value):
+        field = self.get_lookup_field(model, arguments)
+        if field is None:
+            key = (model, arguments, value)
+            if key not in self.cache:
                 try:
-                    field = model_fields[field_exp['model_field']][0]
-
-                    expression = eval(field_exp['expression'], {'csv_column':column})
-                    if hasattr(field, 'related'):
-                        arguments = {field_exp['arguments']:expression}
-                        value = field.related.parent_model.objects.get(**arguments)
-                    else:
-                        value = expression
-
-                    model_line[field_exp['model_field']] = value
-
-                except Exception, err:
-                    value = None
-                    line_error = True
-                    errors += 1
-                    results.append(_(u'Foreign key fetch error, line: %(line)s, expression: %(exp)s, error: %(err)s') % {'line':line, 'exp':expression, 'err':err})
+                    self.store(key, model.objects.get(**{arguments:value}))
+                except (model.DoesNotExist, model.MultipleObjectsReturned), err:
+                    self.store(key, err)
+        else:
+            key = (model, arguments, field.to_python(value))
+            if key not in self.cache:
+                self.prefetch(model, arguments, [value])
+
+        result = self.cache[key]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def remove_duplicates(model, field_name, rows, seen=None):
+    """
+    Returns the (line, field values) rows whose field_name value is not
+    in the database yet nor repeats the value of an earlier row of the
+    chunk or of the set of already seen values, if given.  Rows without
+    a value are kept, empty values are not duplicates of each other
+    """
+    keys = list(set([values[field_name] for line, values in rows if values[field_name] not in EMPTY_VALUES]))
+    existing = set()
+    for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        existing.update(model.objects.filter(**{'%s__in' % field_name:keys[start:start + LOOKUP_CHUNK_SIZE]}).values_list(field_name, flat=True))
+    if seen is None:
+        seen = set()
+
+    unique_rows = []
+    for line, values in rows:
+        key = values[field_name]
+        if key in EMPTY_VALUES:
+            unique_rows.append((line, values))
+        elif key not in existing and key not in seen:
+            seen.add(key)
+            unique_rows.append((line, values))
+    return unique_rows
+
+
+def split_upserts(model, field_name, chunk, mapped_field_names):
+    """
+    Splits the (line, instance) pairs of a chunk by their field_name
+    value, fetched with one __in query per LOOKUP_CHUNK_SIZE values, into
+    the new instances, the (line, existing instance, changed field names)
+    of the existing rows whose mapped fields differ, already given the
+    new values, and the number of lines left out: unchanged rows and
+    earlier lines repeating a value of the chunk, the last one wins.
+    Instances without a value are always new
+    """
+    attname = model._meta.get_field(field_name).attname
+    new = []
+    last_rows = SortedDict()
+    for line, instance in chunk:
+        key = getattr(instance, attname)
+        if key in EMPTY_VALUES:
+            new.append((line, instance))
+        else:
+            last_rows[key] = (line, instance)
+
+    keys = last_rows.keys()
+    existing = {}
+    for start in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        for instance in model.objects.filter(**{'%s__in' % field_name:keys[start:start + LOOKUP_CHUNK_SIZE]}):
+            existing[getattr(instance, attname)] = instance
+
+    fields = [model._meta.get_field(name) for name in mapped_field_names]
+    updates = []
+    for key, (line, instance) in last_rows.items():
+        if key not in existing:
+            new.append((line, instance))
+            continue
+        current = existing[key]
+        changed = [field for field in fields if getattr(instance, field.attname) != getattr(current, field.attname)]
+        if changed:
+            for field in changed:
+                setattr(current, field.attname, getattr(instance, field.attname))
+            updates.append((line, current, [field.name for field in changed]))
+    new.sort()
+    return new, updates, len(chunk) - len(new) - len(updates)
+
+
+def import_chunk(model, compiled, rows, resolver, dryrun=True, bulk=False, dedupe_field=None, seen=None, upsert_field=None, saved=None):
+    """
+    Resolves the foreign keys of a chunk of (line, field values) rows,
+    builds the instances and saves them unless dryrun.  With upsert_field
+    the rows already in the database are updated instead.  Returns the
+    number of inserted lines, of updated lines, of lines skipped as
+    duplicates of dedupe_field values or as unchanged and the error
+    messages.  saved, if given, is called with the same values in the
+    transaction of the chunk, before it is committed
+    """
+    skipped = 0
+    if dedupe_field:
+        unique_rows = remove_duplicates(model, dedupe_field, rows, seen)
+        skipped = len(rows) - len(unique_rows)
+        rows = unique_rows
+
+    related_fields = [(field_name, related_model, arguments) for field_name, field, related_model, code, arguments, expression in compiled if related_model]
+    for field_name, related_model, arguments in related_fields:
+        resolver.prefetch(related_model, arguments, [values[field_name] for line, values in rows if values[field_name] is not None])
+
+    messages = []
+    chunk = []
+    for line, values in rows:
         try:
-            if not line_error:
-                if dryrun:
-                    entry = model(**model_line)
-                else:
-                    entry = model.objects.create(**model_line)
+            for field_name, related_model, arguments in related_fields:
+                value = values[field_name]
+                if value is not None:
+                    values[field_name] = resolver.resolve(related_model, arguments, value)
+        except Exception, err:
+            messages.append(_(u'Foreign key fetch error, line: %(line)s, expression: %(exp)s, error: %(err)s') % {'line':line, 'exp':value, 'err':err})
+            continue
 
-                imported_lines += 1
+        try:
+            chunk.append((line, model(**values)))
         except Exception, err:
+            messages.append(_(u'Import error, line: %(line)s, error: %(err)s') % {'line':line, 'err':err})
+
+    updates = []
+    if upsert_field:
+        chunk, updates, unchanged = split_upserts(model, upsert_field, chunk, [field_name for field_name, field, related_model, code, arguments, expression in compiled])
+        skipped += unchanged
+
+    if dryrun:
+        resolver.remember(model, [instance for line, instance in chunk])
+        if saved:
+            saved(len(chunk), len(updates), skipped, messages)
+        return len(chunk), len(updates), skipped, messages
+
+    def flushed(imported, updated, failed_messages):
+        saved(imported, updated, skipped, messages + failed_messages)
+
+    imported, updated, failed_messages = flush_chunk(model, chunk, bulk, updates, saved and flushed)
+    resolver.remember(model, [instance for line, instance in chunk])
+    return imported, updated, skipped, messages + failed_messages
+
+
+def flush_chunk(model, chunk, bulk=False, updates=None, saved=None):
+    """
+    Writes a chunk and its updates, returns the number of inserted and
+    of updated lines and the error messages of the failed ones.  saved,
+    if given, is called with the same values in the transaction of the
+    chunk, before it is committed
+    """
+    updates = updates or []
+
+    def count(failed):
+        failed_lines = set([line for line, err in failed])
+        updated = len([line for line, instance, field_names in updates if line not in failed_lines])
+        return len(chunk) + len(updates) - len(failed) - updated, updated, [_(u'Import error, line: %(line)s, error: %(err)s') % {'line':line, 'err':err} for line, err in failed]
+
+    def written(failed):
+        saved(*count(failed))
+
+    if not chunk and not updates:
+        if saved:
+            saved(0, 0, [])
+        return 0, 0, []
+    return count(write_chunk(model, chunk, bulk, updates, saved and written))
+
+
+def perform_import(csvfilename, model, mappings, dialect_settings=None, start_row=1, dryrun=True, progress=None, create_missing=False, processes=1, dedupe_field=None, upsert_field=None, sample=False, resolver=None):
+    """
+    Imports the rows of a CSV file as model instances, the file is read
+    lazily and the instances saved in chunks of IMPORTER_CHUNK_SIZE rows,
+    each in a transaction of its own.  progress, if given, is called
+    after every chunk with the processed lines, imported lines and errors.
+    With create_missing, related objects not found are created.  With
+    processes > 1 the rows are parsed by that many worker processes and
+    saved by this one.  With dedupe_field, rows whose value of that field
+    is already in the database or repeats an earlier row are skipped,
+    with upsert_field those rows update the existing ones, only writing
+    the fields that changed.
+    progress is called in the transaction of every chunk, before it is
+    committed, so the processed lines it records are always those of the
+    committed chunks and an import that failed can be resumed from the
+    line after them.
+    A test run with sample only validates the rows picked by sample_rows,
+    their parsed values are saved next to the file and reused by the
+    final import, see get_parsed_filename.  The
+    imports of a bundle share their foreign key resolver
+    """
+    try:
+        csvfile = open_csv_file(csvfilename)
+    except IOError:
+        return [_(u'Could not open specified csv file, %s, or it does not exist') % csvfilename]
+    if get_compression(csvfilename):
+        # The shards are offsets in the plain file
+        processes = 1
+
+    dialect = get_dialect(csvfile, dialect_settings)
+    bulk = not dryrun and not has_save_hooks(model)
+
+    try:
+        compiled = compile_mappings(model, mappings)
+    except (KeyError, SyntaxError), err:
+        csvfile.close()
+        return [_(u'Expression error: %s') % err]
+
+    key_fields = [field_name for field_name, field, related_model, code, arguments, expression in compiled if not related_model]
+    if dedupe_field and dedupe_field not in key_fields:
+        csvfile.close()
+        return [_(u'The deduplication field %s must be one of the mapped fields that are not foreign keys.') % dedupe_field]
+    if upsert_field and upsert_field not in key_fields:
+        csvfile.close()
+        return [_(u'The update key field %s must be one of the mapped fields that are not foreign keys.') % upsert_field]
+    if dedupe_field and upsert_field:
+        csvfile.close()
+        return [_(u'Duplicate lines can either be skipped or update the existing rows, not both.')]
+    # Rows of a test run are not saved, the values seen are kept instead
+    seen = None
+    if dryrun:
+        seen = set()
+
+    sampling = importer_settings.DRYRUN_HEAD_ROWS or importer_settings.DRYRUN_SAMPLE_ROWS
+    sampled = dryrun and sample and sampling
+    parsed = {}
+    if sampled:
+        parsed_filename = get_parsed_filename(csvfilename, mappings, dialect_settings)
+        total_lines, sample_lines = sample_rows(csvfile, dialect, start_row, importer_settings.DRYRUN_HEAD_ROWS,
+            importer_settings.DRYRUN_SAMPLE_ROWS, seed=parsed_filename)
+        source = [(line,) + parse_row(compiled, column) for line, column in sample_lines]
+        # Copied, import_chunk replaces the foreign key values
+        parsed = dict([(line, (dict(values), errors)) for line, values, errors in source])
+        save_parsed_rows(parsed_filename, parsed)
+    else:
+        if not dryrun and sampling:
+            parsed = load_parsed_rows(get_parsed_filename(csvfilename, mappings, dialect_settings))
+        source = parse_rows(csvfile, dialect, compiled, start_row, processes, (csvfilename, dialect_settings, model, mappings), parsed)
+
+    if resolver is None:
+        resolver = ForeignKeyResolver(create_missing=create_missing, dryrun=dryrun)
+
+    def saved(imported, updated, skipped, messages):
+        progress(processed_lines, imported_lines + imported, errors + len(messages))
+
+    processed_lines = 0
+    imported_lines = 0
+    updated_lines = 0
+    skipped_lines = 0
+    errors = 0
+    results = []
+    rows = []
+    for line, values, line_errors in source:
+        processed_lines += 1
+        for value, err in line_errors:
             errors += 1
-            results.append(_(u'Import error, line: %(line)s, error: %(err)s') % {'line':line, 'err':err})
+            if errors <= importer_settings.MAX_ERROR_MESSAGES:
+                results.append(_(u'Foreign key fetch error, line: %(line)s, expression: %(exp)s, error: %(err)s') % {'line':line, 'exp':value, 'err':err})
+        if not line_errors:
+            rows.append((line, values))
 
+        if processed_lines % importer_settings.CHUNK_SIZE == 0:
+            imported, updated, skipped, messages = import_chunk(model, compiled, rows, resolver, dryrun, bulk, dedupe_field, seen, upsert_field, progress and saved)
+            imported_lines += imported
+            updated_lines += updated
+            skipped_lines += skipped
+            errors += len(messages)
+            results.extend(messages[:importer_settings.MAX_ERROR_MESSAGES - len(results)])
+            rows = []
 
-    results.append(_(u'Processed %s lines.') % len(csvfile[start_row-1:]))
+    imported, updated, skipped, messages = import_chunk(model, compiled, rows, resolver, dryrun, bulk, dedupe_field, seen, upsert_field, progress and saved)
+    imported_lines += imported
+    updated_lines += updated
+    skipped_lines += skipped
+    errors += len(messages)
+    results.extend(messages[:importer_settings.MAX_ERROR_MESSAGES - len(results)])
+
+    if bulk and (imported_lines or updated_lines):
+        # No save signals were sent for the written rows
+        bump_model_version(model)
+        invalidate_index(model)
+
+    if errors > importer_settings.MAX_ERROR_MESSAGES:
+        results.append(_(u'%s more errors not shown.') % (errors - importer_settings.MAX_ERROR_MESSAGES))
+    if sampled:
+        results.append(_(u'Validated a sample of %(sample)s of %(total)s lines.') % {'sample':processed_lines, 'total':total_lines})
+    results.append(_(u'Processed %s lines.') % processed_lines)
     results.append(_(u'Imported %s lines.') % imported_lines)
+    if dedupe_field:
+        results.append(_(u'Skipped %s duplicate lines.') % skipped_lines)
+    if upsert_field:
+        results.append(_(u'Updated %s lines.') % updated_lines)
+        results.append(_(u'Skipped %s unchanged lines.') % skipped_lines)
     results.append(_(u'There were %s errors.') % errors)
 
-    csvfd.close()
+    csvfile.close()
     return results
+
+
+def get_bundle_entries(bundle):
+    """
+    Returns a dictionary of model: (CSV member name, import settings) of
+    the members of an open bundle zip file named app_label.model.csv.
+    The import settings are read from the app_label.model.json member
+    downloaded from the wizard if there is one, the default mappings are
+    used otherwise.  Raises ValueError for members of unknown models
+    """
+    names = bundle.namelist()
+    entries = {}
+    for name in names:
+        base, ext = os.path.splitext(os.path.basename(name))
+        if ext.lower() != '.csv':
+            continue
+        model = '.' in base and get_model(*base.split('.', 1)) or None
+        if model is None:
+            raise ValueError(_(u'The bundle member %s is not named after a model, as in app_label.model.csv.') % name)
+
+        settings_name = '%s.json' % os.path.splitext(name)[0]
+        if settings_name in names:
+            import_settings = loads(bundle.read(settings_name))
+        else:
+            import_settings = {'expressions':get_default_mappings(model)}
+        entries[model] = (name, import_settings)
+    return entries
+
+
+def get_import_order(dependencies):
+    """
+    Returns the models of a dictionary of model: models it references
+    ordered so every model comes after the ones it references, raises
+    ValueError if they reference each other
+    """
+    pending = dict([(model, set(references)) for model, references in dependencies.items()])
+    order = []
+    while pending:
+        ready = sorted([model for model, references in pending.items() if not references], key=lambda model: model._meta.db_table)
+        if not ready:
+            raise ValueError(_(u'The models %s reference each other.') % u', '.join(sorted([unicode(model._meta.verbose_name) for model in pending])))
+        for model in ready:
+            order.append(model)
+            del pending[model]
+        for references in pending.values():
+            references.difference_update(ready)
+    return order
+
+
+def perform_bundle_import(bundlefilename, dryrun=True, create_missing=False, progress=None):
+    """
+    Imports the CSV files of a bundle zip file, see get_bundle_entries,
+    each model after the ones it references.  The imports share a
+    foreign key resolver that keeps the rows imported for the models
+    referenced by later files, so those are resolved without querying
+    again, in test runs too.  The primary keys of the exported rows are
+    not kept, so the foreign keys to models of the bundle must be looked
+    up by another field.  progress, if given, is called like the one of
+    perform_import with the totals of the bundle
+    """
+    try:
+        bundle = zipfile.ZipFile(bundlefilename)
+    except (IOError, zipfile.BadZipfile), err:
+        return [_(u'Could not open the bundle %(file)s: %(err)s') % {'file':bundlefilename, 'err':err}]
+
+    try:
+        entries = get_bundle_entries(bundle)
+        dependencies = {}
+        key_fields = {}
+        for model, (name, import_settings) in entries.items():
+            compiled = compile_mappings(model, import_settings['expressions'])
+            dependencies[model] = set()
+            for field_name, field, related_model, code, arguments, expression in compiled:
+                if related_model in entries and related_model is not model:
+                    if not arguments or arguments.split('__')[0] in ('pk', related_model._meta.pk.name):
+                        raise ValueError(_(u'%(member)s looks %(field)s up by primary key, map it by a field of %(model)s such as its name instead.') % {
+                            'member':name, 'field':field_name, 'model':related_model._meta.verbose_name})
+                    dependencies[model].add(related_model)
+                    key_fields.setdefault(related_model, set()).add(arguments)
+        order = get_import_order(dependencies)
+    except (ValueError, KeyError, SyntaxError), err:
+        bundle.close()
+        return [_(u'Bundle error: %s') % err]
+
+    resolver = ForeignKeyResolver(create_missing=create_missing, dryrun=dryrun, key_fields=key_fields)
+    #Processed lines, imported lines and errors of the finished files
+    totals = [0, 0, 0]
+    results = []
+    for model in order:
+        name, import_settings = entries[model]
+        # Extracted, the importer seeks and reopens the file
+        destination, filename = tempfile.mkstemp()
+        destination = os.fdopen(destination, 'wb')
+        member = bundle.open(name)
+        shutil.copyfileobj(member, destination)
+        member.close()
+        destination.close()
+
+        counters = {}
+        def count(processed_lines, imported_lines, errors):
+            counters.update({'processed':processed_lines, 'imported':imported_lines, 'errors':errors})
+            if progress:
+                progress(totals[0] + processed_lines, totals[1] + imported_lines, totals[2] + errors)
+
+        try:
+            results.append(u'%s:' % name)
+            results.extend(perform_import(filename, model, import_settings['expressions'],
+                dialect_settings=import_settings.get('dialect_settings'), start_row=import_settings.get('start_row', 1),
+                dryrun=dryrun, progress=count, dedupe_field=import_settings.get('dedupe_field'),
+                upsert_field=import_settings.get('upsert_field'), resolver=resolver))
+        finally:
+            os.unlink(filename)
+        totals[0] += counters.get('processed', 0)
+        totals[1] += counters.get('imported', 0)
+        totals[2] += counters.get('errors', 0)
+
+    bundle.close()
+    return results
+
+
+def get_import_job(filename, model_name, import_settings, dryrun=True):
+    """
+    Returns the job importing the file with the given settings (start
+    row, create missing, expressions and dialect settings), creating it
+    the first time
+    """
+    serialized_settings = dumps(import_settings, sort_keys=True)
+    key = md5_constructor(dumps([filename, model_name, serialized_settings, dryrun])).hexdigest()
+    job, created = ImportJob.objects.get_or_create(key=key, defaults={
+        'filename':filename,
+        'model_name':model_name,
+        'import_settings':serialized_settings,
+        'dryrun':dryrun,
+    })
+    return job
+
+
+def get_job_status(job):
+    if job.is_finished():
+        return job.results
+
+    return _(u'Import %(state)s, processed %(processed)s lines, imported %(imported)s lines, %(errors)s errors, %(rate)d lines per second.') % {
+        'state':job.get_state_display(), 'processed':job.processed_lines, 'imported':job.imported_lines,
+        'errors':job.errors, 'rate':job.get_rows_per_second()}
+
+
+def claim_import_job():
+    """
+    Marks the oldest pending job as running and returns it, None if there
+    are no pending jobs.  Jobs claimed meanwhile by another worker are
+    skipped
+    """
+    for job in ImportJob.objects.filter(state=JOB_STATE_PENDING).order_by('created'):
+        started = datetime.datetime.now()
+        if ImportJob.objects.filter(pk=job.pk, state=JOB_STATE_PENDING).update(state=JOB_STATE_RUNNING, started=started):
+            job.state = JOB_STATE_RUNNING
+            job.started = started
+            return job
+    return None
+
+
+def resume_import_job(job):
+    """
+    Queues again a job that failed or whose worker died while running
+    it, it continues after the lines of the chunks already committed
+    """
+    return ImportJob.objects.filter(pk=job.pk, state__in=[JOB_STATE_FAILED, JOB_STATE_RUNNING]).update(state=JOB_STATE_PENDING, finished=None)
+
+
+def run_import_job(job):
+    """
+    Runs a job already marked as running by the caller, the file of a
+    successful final import is deleted along with the rows parsed by its
+    test runs.  The counters of the job are
+    those of its committed chunks, a resumed job starts after the lines
+    already processed
+    """
+    # Counted on from the lines committed by the previous runs, even if
+    # the job was loaded before those finished
+    job = ImportJob.objects.get(pk=job.pk)
+
+    def progress(processed_lines, imported_lines, errors):
+        # Run in the transaction of the chunk, a resumed job starts after
+        # the committed lines only
+        ImportJob.objects.filter(pk=job.pk).update(processed_lines=job.processed_lines + processed_lines,
+            imported_lines=job.imported_lines + imported_lines, errors=job.errors + errors)
+
+    import_settings = loads(job.import_settings)
+    results = []
+    if job.processed_lines:
+        results.append(_(u'Resumed after %s lines already processed.') % job.processed_lines)
+    try:
+        results.extend(perform_import(job.filename, get_model(*job.model_name.split('.', 1)), import_settings['expressions'],
+            dialect_settings=import_settings['dialect_settings'], start_row=import_settings['start_row'] + job.processed_lines,
+            dryrun=job.dryrun, progress=progress, create_missing=import_settings.get('create_missing', False),
+            processes=importer_settings.PROCESSES, dedupe_field=import_settings.get('dedupe_field'),
+            upsert_field=import_settings.get('upsert_field'), sample=job.dryrun))
+        state = JOB_STATE_DONE
+    except Exception:
+        results.append(traceback.format_exc())
+        state = JOB_STATE_FAILED
+
+    ImportJob.objects.filter(pk=job.pk).update(state=state, results=u'\n'.join([unicode(result) for result in results]), finished=datetime.datetime.now())
+    if state == JOB_STATE_DONE and not job.dryrun and os.path.exists(job.filename):
+        os.unlink(job.filename)
+        remove_parsed_rows(job.filename)
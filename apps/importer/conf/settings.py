@@ -0,0 +1,27 @@
+from django.conf import settings
+
+#Rows saved per transaction, models without save hooks are written with
+#a single multi row insert per chunk
+CHUNK_SIZE = getattr(settings, 'IMPORTER_CHUNK_SIZE', 500)
+#Line errors listed in the results, the rest are only counted
+MAX_ERROR_MESSAGES = getattr(settings, 'IMPORTER_MAX_ERROR_MESSAGES', 100)
+#Related objects kept by the foreign key resolver of an import, the ones
+#used last
+RESOLVER_CACHE_SIZE = getattr(settings, 'IMPORTER_RESOLVER_CACHE_SIZE', 10000)
+#Worker processes parsing the rows of the import jobs, with more than
+#one the file is split in shards of SHARD_SIZE bytes at line boundaries,
+#don't use them for files with quoted values spanning several lines
+PROCESSES = getattr(settings, 'IMPORTER_PROCESSES', 1)
+SHARD_SIZE = getattr(settings, 'IMPORTER_SHARD_SIZE', 4 * 1024 * 1024)
+#Shards submitted per worker process ahead of the one being saved
+PENDING_SHARDS = getattr(settings, 'IMPORTER_PENDING_SHARDS', 2)
+#Rows validated by the test run of an import job: the first
+#DRYRUN_HEAD_ROWS plus DRYRUN_SAMPLE_ROWS picked at random from the rest,
+#the whole file when both are 0.  The parsed rows are kept for the final
+#import during PARSED_CACHE_TIMEOUT seconds, in a file next to the
+#uploaded one
+DRYRUN_HEAD_ROWS = getattr(settings, 'IMPORTER_DRYRUN_HEAD_ROWS', 1000)
+DRYRUN_SAMPLE_ROWS = getattr(settings, 'IMPORTER_DRYRUN_SAMPLE_ROWS', 1000)
+PARSED_CACHE_TIMEOUT = getattr(settings, 'IMPORTER_PARSED_CACHE_TIMEOUT', 3600)
+#Rows fetched per query by the exporter
+EXPORT_CHUNK_SIZE = getattr(settings, 'IMPORTER_EXPORT_CHUNK_SIZE', 1000)
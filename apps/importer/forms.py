@@ -1,5 +1,4 @@
 import os
-import csv
 
 from django import forms
 from django.utils.translation import ugettext_lazy as _
@@ -11,7 +10,7 @@ from django.contrib.formtools.wizard import FormWizard
 from django.template import RequestContext
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 
-from api import perform_import
+from api import get_default_mappings, get_import_job, get_job_status, get_preview, get_compression, open_csv_file, EXPORT_FORMAT_CHOICES
 from wizard import BoundFormWizard
 
 #TODO: Allow row 0 to be used as column names
@@ -25,7 +24,7 @@ def reduce_dict(d, l):
 
 class DocumentValidationError(forms.ValidationError):
     def __init__(self):
-        msg = _(u'Only CSV files are valid uploads.')
+        msg = _(u'Only CSV files, optionally compressed with gzip or bz2, are valid uploads.')
         super(DocumentValidationError, self).__init__(msg)
 
 
@@ -34,13 +33,29 @@ class DocumentField(forms.FileField):
 
     def clean(self, data, initial=None):
         f = super(DocumentField, self).clean(data, initial)
-        ext = os.path.splitext(f.name)[1][1:].lower()
-
-        if ext == 'csv' and f.content_type == 'text/csv':
+        name = f.name
+        if get_compression(name):
+            # The content type is the one of the compression
+            name = os.path.splitext(name)[0]
+        elif f.content_type != 'text/csv':
+            raise DocumentValidationError()
+        ext = os.path.splitext(name)[1][1:].lower()
+
+        if ext == 'csv':
             return f
         raise DocumentValidationError()
 
 
+def get_model_choices(models):
+    capfirst = lambda x: x[0].upper() + x[1:]
+
+    get_verbose_name = lambda x: getattr(x._meta, 'verbose_name', x) if hasattr(x, '_meta') else x
+
+    names = [capfirst(get_verbose_name(ContentType.objects.get(app_label=model.split('.')[0], model=model.split('.')[1]).model_class())) for model in models]
+
+    return sorted(zip(models, names), lambda x,y: 1 if x[1]>y[1] else -1)
+
+
 class DocumentForm(forms.Form):
     def __init__(self, *args, **kwargs):
         models = kwargs.pop('models', [])
@@ -56,13 +71,7 @@ class DocumentForm(forms.Form):
 
         super(DocumentForm, self).__init__(*args, **kwargs)
 
-        capfirst = lambda x: x[0].upper() + x[1:]
-
-        get_verbose_name = lambda x: getattr(x._meta, 'verbose_name', x) if hasattr(x, '_meta') else x
-
-        names = [capfirst(get_verbose_name(ContentType.objects.get(app_label=model.split('.')[0], model=model.split('.')[1]).model_class())) for model in choices]
-
-        self.fields['model_name'].choices=sorted(zip(choices, names), lambda x,y: 1 if x[1]>y[1] else -1)
+        self.fields['model_name'].choices = get_model_choices(choices)
 
     local_document = DocumentField(label=_(u'Local document'))
     model_name = forms.ChoiceField(label=_(u'Model'), help_text=_(u'Model that will receive the data.'))
@@ -70,6 +79,16 @@ class DocumentForm(forms.Form):
 
 
 
+class ExportForm(forms.Form):
+    def __init__(self, *args, **kwargs):
+        models = kwargs.pop('models', [])
+        super(ExportForm, self).__init__(*args, **kwargs)
+        self.fields['model_name'].choices = get_model_choices(models)
+
+    model_name = forms.ChoiceField(label=_(u'Model'), help_text=_(u'Model whose rows will be exported.'))
+    format = forms.ChoiceField(label=_(u'Format'), choices=EXPORT_FORMAT_CHOICES, help_text=_(u'CSV files can be imported back with the default expressions of the model.'))
+
+
 class PreviewForm(forms.Form):
     preview_area = forms.CharField(label=_(u'Preview'), required=False, widget=forms.widgets.Textarea(attrs={'cols':80, 'rows':10}))
     start_row = forms.IntegerField(label=_(u'Start row'), initial=1)
@@ -78,6 +97,9 @@ class PreviewForm(forms.Form):
     dialect_doublequote = forms.BooleanField(label=_('Doublequote'), required=False, help_text=_(u'Controls how instances of the quote character appearing inside a field should be themselves be quoted. When True, the character is doubled. When False, the escape character is used as a prefix to the quote character. It defaults to True.'))
     dialect_escapechar = forms.CharField(label=_('Escape character'), max_length=1, required=False, help_text=_(u'The escape character removes any special meaning from the following character. It defaults to None, which disables escaping.'))
     dialect_skipinitialspace = forms.BooleanField(label=_('Skip initial space'), required=False, help_text=_(u'When True, whitespace immediately following the delimiter is ignored. The default is False.'))
+    create_missing = forms.BooleanField(label=_(u'Create missing related objects'), required=False, help_text=_(u'When True, the related objects that are not found by the foreign key expressions and arguments are created.'))
+    dedupe_field = forms.CharField(label=_(u'Skip duplicates of field'), max_length=50, required=False, help_text=_(u'Name of a mapped model field, the lines whose value of this field already exists or repeats an earlier line are skipped.'))
+    upsert_field = forms.CharField(label=_(u'Update existing rows by field'), max_length=50, required=False, help_text=_(u'Name of a mapped model field identifying the rows, the lines whose value of this field already exists update that row instead of creating a new one.'))
 
 
 class ExpressionForm(forms.Form):
@@ -104,22 +126,36 @@ class ImportWizard(BoundFormWizard):
     def store_settings(self, request, settings_list):
         request.session['last_import_settings'] = reduce_dict(self.settings, settings_list)
 
-    def sniff_file(self):
-        csvfile = open(self.settings['filename'], 'rb')
-        dialect = csv.Sniffer().sniff(csvfile.read(1024))
-        csvfile.seek(0)
-        self.initial = {0:{
-                'preview_area':''.join([csvfile.readline() for i in range(10)]),
+    def sniff_file(self, request):
+        """
+        Sets the initial preview and dialect of the first step, read once
+        and kept in the session for the following requests of the wizard
+        """
+        if not os.path.exists(self.settings['filename']):
+            raise IOError(_(u'The file %s does not exist.') % self.settings['filename'])
+
+        previews = request.session.get('import_previews', {})
+        if self.settings['filename'] not in previews:
+            csvfile = open_csv_file(self.settings['filename'])
+            dialect, preview = get_preview(csvfile)
+            csvfile.close()
+            # Only the file being imported is kept
+            previews = {self.settings['filename']:{
+                'preview_area':preview,
                 'dialect_delimiter':dialect.delimiter,
                 'dialect_doublequote':dialect.doublequote,
                 'dialect_escapechar':dialect.escapechar,
                 'dialect_quotechar':dialect.quotechar,
                 'dialect_skipinitialspace':dialect.skipinitialspace,
             }}
-        csvfile.close()
+            request.session['import_previews'] = previews
+        self.initial = {0:dict(previews[self.settings['filename']])}
+
+    def get_job(self, dryrun):
+        return get_import_job(self.settings['filename'], self.settings['model_name'], reduce_dict(self.settings, ['start_row', 'create_missing', 'dedupe_field', 'upsert_field', 'expressions', 'dialect_settings']), dryrun=dryrun)
 
     def render_template(self, request, form, previous_fields, step, context=None):
-        context = {'step_title':self.extra_context['step_titles'][step]}
+        context = {'step_title':self.extra_context['step_titles'][step], 'job':self.job}
         return super(ImportWizard, self).render_template(request, form, previous_fields, step, context)
 
     def parse_params(self, request, *args, **kwargs):
@@ -130,15 +166,19 @@ class ImportWizard(BoundFormWizard):
             _(u'step 4 of 4: Final import results'),
             ]}
         self.settings = {}
+        #Import job of the step being shown, its progress is polled
+        self.job = None
         self.settings['filename'] = request.GET.get('temp_file', None)
         self.settings['model_name'] = request.GET.get('model_name', None)
         if not self.settings['filename']:
             raise Http404
 
         try:
-            self.sniff_file()
+            self.sniff_file(request)
         except IOError, err:
-            raise Http404(err)
+            # The final import job deletes the file once done
+            if not self.determine_step(request, *args, **kwargs):
+                raise Http404(err)
 
     def get_template(self, step):
         return 'import_wizard.html'
@@ -148,38 +188,34 @@ class ImportWizard(BoundFormWizard):
         if step == 0:
             self.settings['dialect_settings'] = dict([(key, form.cleaned_data[key]) for key in form.cleaned_data if 'dialect' in key])
             self.settings['start_row'] = form.cleaned_data['start_row']
+            self.settings['create_missing'] = form.cleaned_data['create_missing']
+            self.settings['dedupe_field'] = form.cleaned_data['dedupe_field']
+            self.settings['upsert_field'] = form.cleaned_data['upsert_field']
             #app_label, name = self.settings['model_name'].split('.')
             app_label, model = self.settings['model_name'].split('.')
             #ct = ContentType.objects.get(app_label=app_label, name=name)
             ct = ContentType.objects.get(app_label=app_label, model=model)
             self.settings['model'] = ct.model_class()
-            initial=[]
-            for num, field in enumerate(self.settings['model']._meta.fields):
-                if field.name != 'id':
-                    initial.append({
-                        'model_field':field.name,
-                        'expression':'"%%s" %% csv_column[%s]' % str(num-1),
-                        'enabled':field.name != 'id' and True
-                        })
-            self.initial = {1:initial}
+            self.initial = {1:get_default_mappings(self.settings['model'])}
         elif step == 1:
             self.settings['expressions'] = form.cleaned_data
-            results = perform_import(self.settings['filename'], self.settings['model'], self.settings['expressions'], dialect_settings=self.settings['dialect_settings'], start_row=self.settings['start_row'], dryrun=True)
+            # Run by the run_import_jobs command, the wizard polls its progress
+            self.job = self.get_job(dryrun=True)
 
             self.initial = {2:
-                {'result_area':'\n'.join(results),
+                {'result_area':get_job_status(self.job),
                 'title':_(u'Import test run results')}
             }
         elif step == 2:
-            self.store_settings(request, ['model_name', 'start_row', 'expressions', 'dialect_settings'])
-            results = perform_import(self.settings['filename'], self.settings['model'], self.settings['expressions'], dialect_settings=self.settings['dialect_settings'], start_row=self.settings['start_row'], dryrun=False)
+            self.store_settings(request, ['model_name', 'start_row', 'create_missing', 'dedupe_field', 'upsert_field', 'expressions', 'dialect_settings'])
+            self.job = self.get_job(dryrun=False)
 
             self.initial = {3:
-                {'result_area':'\n'.join(results),
+                {'result_area':get_job_status(self.job),
                 'title':_(u'Final import results')}
             }
 
 
     def done(self, request, form_list):
-        os.unlink(self.settings['filename'])
+        # The file is deleted by the import job once it is done
         return HttpResponseRedirect('/')
@@ -0,0 +1,54 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from django.utils.simplejson import loads
+
+from importer.api import get_default_mappings, compile_mappings
+
+
+class Command(BaseCommand):
+    help = 'Times the per row cost of evaluating the import mapping expressions of a model, parsed on every cell and compiled once.'
+    args = '[app_label.model]'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', action='store', dest='rows', type='int', default=10000,
+            help='Number of generated rows to evaluate.'),
+        make_option('--mappings', action='store', dest='mappings', default=None,
+            help='JSON file with the import settings downloaded from the wizard, the default mappings of the model are used otherwise.'),
+    )
+
+    def handle(self, *args, **options):
+        mappings = None
+        model_name = args and args[0] or None
+        if options['mappings']:
+            import_settings = loads(open(options['mappings']).read())
+            mappings = import_settings['expressions']
+            model_name = model_name or import_settings.get('model_name')
+
+        if not model_name:
+            raise CommandError('Give the app_label.model to benchmark.')
+        model = get_model(*model_name.split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model %s.' % model_name)
+
+        compiled = compile_mappings(model, mappings or get_default_mappings(model))
+        rows = [[u'%s' % (row + column) for column in range(len(model._meta.fields))] for row in range(options['rows'])]
+
+        start = time.time()
+        for column in rows:
+            for field_name, field, related_model, code, arguments, expression in compiled:
+                eval(expression, {'csv_column':column})
+        parsed = (time.time() - start) / len(rows)
+
+        start = time.time()
+        for column in rows:
+            namespace = {'csv_column':column}
+            for field_name, field, related_model, code, arguments, expression in compiled:
+                eval(code, namespace)
+        precompiled = (time.time() - start) / len(rows)
+
+        self.stdout.write('%s expressions, %s rows.\n' % (len(compiled), len(rows)))
+        self.stdout.write('Parsed per cell: %.1f microseconds per row.\n' % (parsed * 1000000))
+        self.stdout.write('Compiled once: %.1f microseconds per row.\n' % (precompiled * 1000000))
+        self.stdout.write('Speedup: %.1fx\n' % (parsed / (precompiled or 1e-9)))
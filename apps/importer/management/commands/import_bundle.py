@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import smart_str
+
+from importer.api import perform_bundle_import
+
+
+class Command(BaseCommand):
+    help = 'Imports a zip file of app_label.model.csv files, each model after the ones it references, their foreign keys to each other looked up by a field other than the primary key. Only a test run unless --commit is given.'
+    args = '<bundle.zip>'
+    option_list = BaseCommand.option_list + (
+        make_option('--commit', action='store_true', dest='commit', default=False,
+            help='Save the imported rows instead of only validating them.'),
+        make_option('--create-missing', action='store_true', dest='create_missing', default=False,
+            help='Create the related objects not found by the foreign key expressions and arguments.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the bundle zip file to import.')
+
+        for result in perform_bundle_import(args[0], dryrun=not options['commit'], create_missing=options['create_missing']):
+            self.stdout.write(smart_str(u'%s\n' % result))
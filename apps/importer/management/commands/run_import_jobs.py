@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+
+from importer.api import claim_import_job, resume_import_job, run_import_job
+from importer.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = 'Runs the pending import jobs queued by the import wizard.'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help='Keep waiting for new jobs instead of exiting when there are none.'),
+        make_option('--sleep', action='store', dest='sleep', type='int', default=5,
+            help='Seconds to wait between checks for new jobs with --loop.'),
+        make_option('--resume', action='store', dest='resume', type='int', default=None,
+            help='Queue again the failed or interrupted job with this id, it continues after its last committed line.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                job = ImportJob.objects.get(pk=options['resume'])
+            except ImportJob.DoesNotExist:
+                raise CommandError('Unknown import job %s.' % options['resume'])
+            if not resume_import_job(job):
+                raise CommandError('Import job %s is not failed or running.' % job.pk)
+            self.stdout.write('Resuming import job %s after line %s.\n' % (job.pk, job.processed_lines))
+
+        while True:
+            job = claim_import_job()
+            if job:
+                self.stdout.write('Running import job %s.\n' % job.pk)
+                run_import_job(job)
+                # Keeps a long running worker from growing with DEBUG on
+                reset_queries()
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
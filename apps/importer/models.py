@@ -0,0 +1,64 @@
+import datetime
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+JOB_STATE_PENDING = 'pending'
+JOB_STATE_RUNNING = 'running'
+JOB_STATE_DONE = 'done'
+JOB_STATE_FAILED = 'failed'
+
+JOB_STATE_CHOICES = (
+    (JOB_STATE_PENDING, _(u'pending')),
+    (JOB_STATE_RUNNING, _(u'running')),
+    (JOB_STATE_DONE, _(u'done')),
+    (JOB_STATE_FAILED, _(u'failed')),
+)
+
+
+class ImportJob(models.Model):
+    """
+    An import of a CSV file run by the run_import_jobs worker command
+    instead of the web request, the counters are updated after every
+    chunk so its progress can be polled
+    """
+    #Hash of the file and import settings, the wizard processes the
+    #previous steps again on every request and must find the same job
+    key = models.CharField(max_length=32, unique=True)
+    filename = models.CharField(max_length=255, verbose_name=_(u'file name'))
+    model_name = models.CharField(max_length=100, verbose_name=_(u'model'))
+    #JSON of the mappings, dialect settings, start row and options
+    import_settings = models.TextField()
+    dryrun = models.BooleanField(default=True, verbose_name=_(u'test run'))
+    state = models.CharField(max_length=16, choices=JOB_STATE_CHOICES, default=JOB_STATE_PENDING, db_index=True, verbose_name=_(u'state'))
+    #Only counts the lines of committed chunks, a failed job is resumed
+    #after them
+    processed_lines = models.IntegerField(default=0, verbose_name=_(u'processed lines'))
+    imported_lines = models.IntegerField(default=0, verbose_name=_(u'imported lines'))
+    errors = models.IntegerField(default=0, verbose_name=_(u'errors'))
+    results = models.TextField(blank=True, verbose_name=_(u'results'))
+    created = models.DateTimeField(default=datetime.datetime.now, verbose_name=_(u'created'))
+    started = models.DateTimeField(null=True, blank=True, verbose_name=_(u'started'))
+    finished = models.DateTimeField(null=True, blank=True, verbose_name=_(u'finished'))
+
+    class Meta:
+        ordering = ['created']
+        verbose_name = _(u'import job')
+        verbose_name_plural = _(u'import jobs')
+
+    def __unicode__(self):
+        return u'%s: %s (%s)' % (self.model_name, self.filename, self.get_state_display())
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('import_job_progress', [str(self.id)])
+
+    def is_finished(self):
+        return self.state in (JOB_STATE_DONE, JOB_STATE_FAILED)
+
+    def get_rows_per_second(self):
+        if not self.started:
+            return 0
+        elapsed = (self.finished or datetime.datetime.now()) - self.started
+        seconds = elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1000000.0
+        return seconds and self.processed_lines / seconds or 0
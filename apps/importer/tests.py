@@ -0,0 +1,792 @@
+"""
+Tests of the CSV importer, its background jobs and the exporter
+"""
+
+import __builtin__
+import bz2
+import gzip
+import os
+import tempfile
+import zipfile
+from cStringIO import StringIO
+from urlparse import parse_qsl
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils.simplejson import dumps, loads
+
+from assets.models import Item, Person
+from inventory.models import Inventory, ItemTemplate, Location, Supplier
+
+import importer.api as api
+from importer.conf import settings as importer_settings
+from importer.models import ImportJob, JOB_STATE_PENDING, JOB_STATE_RUNNING, JOB_STATE_DONE, JOB_STATE_FAILED
+
+
+def mapping(model_field, expression, arguments=None, enabled=True):
+    return {'model_field':model_field, 'expression':expression, 'arguments':arguments, 'enabled':enabled}
+
+
+def capture_queries(function, *args, **kwargs):
+    """
+    Returns the result of the function and the SQL of the queries it ran
+    """
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    connection.queries = []
+    try:
+        return function(*args, **kwargs), [query['sql'] for query in connection.queries]
+    finally:
+        settings.DEBUG = debug
+
+
+def count_queries(function, *args, **kwargs):
+    result, queries = capture_queries(function, *args, **kwargs)
+    return result, len(queries)
+
+
+class ImporterTestMixin(object):
+    """
+    Writes the CSV files imported by a test and changes the importer
+    settings, both undone after the test
+    """
+    def setUp(self):
+        self.filenames = []
+        self.saved_settings = {}
+
+    def tearDown(self):
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.unlink(filename)
+            api.remove_parsed_rows(filename)
+        for name, value in self.saved_settings.items():
+            setattr(importer_settings, name, value)
+
+    def set_importer_settings(self, **values):
+        for name, value in values.items():
+            self.saved_settings.setdefault(name, getattr(importer_settings, name))
+            setattr(importer_settings, name, value)
+
+    def write_file(self, data, suffix):
+        destination, filename = tempfile.mkstemp(suffix=suffix)
+        destination = os.fdopen(destination, 'wb')
+        destination.write(data)
+        destination.close()
+        self.filenames.append(filename)
+        return filename
+
+    def write_csv(self, lines, suffix='.csv'):
+        return self.write_file(''.join(['%s\n' % line for line in lines]), suffix)
+
+    def get_job(self, lines, dryrun=True, model_name='inventory.supplier', **import_settings):
+        job_settings = {'start_row':1, 'dialect_settings':None, 'create_missing':False, 'dedupe_field':'', 'upsert_field':'',
+            'expressions':[mapping('name', 'csv_column[0]'), mapping('phone_number1', 'csv_column[1]')]}
+        job_settings.update(import_settings)
+        return api.get_import_job(self.write_csv(lines), model_name, job_settings, dryrun=dryrun)
+
+    def run_jobs(self):
+        stdout = StringIO()
+        call_command('run_import_jobs', stdout=stdout)
+        return stdout.getvalue()
+
+    def import_suppliers(self, lines, expression='csv_column[0]', **kwargs):
+        calls = []
+        def progress(*counters):
+            calls.append(counters)
+        results = api.perform_import(self.write_csv(lines), Supplier, [mapping('name', expression), mapping('phone_number1', 'csv_column[1]')],
+            progress=progress, **kwargs)
+        return results, calls
+
+
+class ChunkedImportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(ChunkedImportTest, self).setUp()
+        self.set_importer_settings(CHUNK_SIZE=2)
+
+    def test_reports_progress_after_every_chunk(self):
+        results, calls = self.import_suppliers(['Acme %s,555' % number for number in range(5)], dryrun=False)
+        self.assertEqual(calls, [(2, 2, 0), (4, 4, 0), (5, 5, 0)])
+        self.assertEqual(list(Supplier.objects.order_by('pk').values_list('name', flat=True)), [u'Acme %s' % number for number in range(5)])
+        self.assertTrue(u'Imported 5 lines.' in results)
+
+    def test_starts_at_start_row(self):
+        results, calls = self.import_suppliers(['name,phone', 'Acme,555', 'Other,556'], dryrun=False, start_row=2)
+        self.assertEqual(list(Supplier.objects.order_by('pk').values_list('name', 'phone_number1')), [(u'Acme', u'555'), (u'Other', u'556')])
+
+    def test_test_runs_save_nothing(self):
+        results, calls = self.import_suppliers(['Acme,555', 'Other,556', 'Third,557'])
+        self.assertEqual(calls[-1], (3, 3, 0))
+        self.assertFalse(Supplier.objects.exists())
+
+    def test_save_hooks(self):
+        self.assertFalse(api.has_save_hooks(Supplier))
+        # Its post_save receiver updates the search document of its assets
+        self.assertTrue(api.has_save_hooks(Person))
+
+    def test_saves_models_with_save_hooks_one_by_one(self):
+        results = api.perform_import(self.write_csv(['Ann,Lee', 'Bob,Ray', 'Cy,Doe']), Person,
+            [mapping('first_name', 'csv_column[0]'), mapping('last_name', 'csv_column[1]')], dryrun=False)
+        self.assertTrue(u'Imported 3 lines.' in results)
+        self.assertEqual(Person.objects.count(), 3)
+
+    def test_limits_the_error_messages(self):
+        self.set_importer_settings(MAX_ERROR_MESSAGES=2)
+        results, calls = self.import_suppliers(['Acme,555'] * 5, expression='csv_column[5]')
+        self.assertEqual(len([result for result in results if u'line:' in result]), 2)
+        self.assertTrue(u'3 more errors not shown.' in results)
+        self.assertTrue(u'There were 5 errors.' in results)
+
+    def test_reports_a_missing_file(self):
+        results = api.perform_import('/nonexistent/file.csv', Supplier, [mapping('name', 'csv_column[0]')])
+        self.assertEqual(len(results), 1)
+        self.assertTrue(u'does not exist' in results[0])
+
+
+class ChunkTransactionTest(ImporterTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(ChunkTransactionTest, self).setUp()
+        self.set_importer_settings(CHUNK_SIZE=2)
+
+    def test_failed_bulk_chunks_are_saved_one_by_one(self):
+        # An empty name is saved as NULL, which the column doesn't allow
+        results, calls = self.import_suppliers(['Acme,555', 'Other,556', ',557', 'Fourth,558', 'Fifth,559'],
+            expression='csv_column[0] or None', dryrun=False)
+        self.assertEqual(list(Supplier.objects.order_by('pk').values_list('name', flat=True)), [u'Acme', u'Other', u'Fourth', u'Fifth'])
+        self.assertEqual(calls[-1], (5, 4, 1))
+        self.assertTrue([result for result in results if u'Import error, line: 3' in result])
+
+
+class CompiledMappingsTest(ImporterTestMixin, TestCase):
+    def test_compiles_every_expression_once(self):
+        compiled = []
+        def counting_compile(*args):
+            compiled.append(args[0])
+            return original_compile(*args)
+        original_compile = __builtin__.compile
+        api.compile = counting_compile
+        try:
+            results, calls = self.import_suppliers(['Acme %s,555' % number for number in range(20)], dryrun=False)
+        finally:
+            del api.compile
+        self.assertEqual(compiled, [u'csv_column[0]', u'csv_column[1]'])
+        self.assertEqual(Supplier.objects.count(), 20)
+
+    def test_skips_disabled_mappings(self):
+        compiled = api.compile_mappings(Supplier, [mapping('name', 'csv_column[0]'), mapping('notes', 'csv_column[', enabled=False)])
+        self.assertEqual([field_name for field_name, field, related_model, code, arguments, expression in compiled], ['name'])
+
+    def test_reports_invalid_expressions(self):
+        results, calls = self.import_suppliers(['Acme,555'], expression='csv_column[')
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].startswith(u'Expression error'))
+        self.assertEqual(calls, [])
+
+    def test_parse_row(self):
+        compiled = api.compile_mappings(Supplier, [mapping('name', 'csv_column[0].upper()'), mapping('phone_number1', 'csv_column[3]')])
+        values, errors = api.parse_row(compiled, [u'acme', u'555'])
+        self.assertEqual(values, {'name':u'ACME'})
+        self.assertEqual(errors, [(None, u'list index out of range')])
+
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command('benchmark_import_expressions', 'inventory.supplier', rows=10, stdout=stdout)
+        self.assertTrue('10 rows' in stdout.getvalue())
+        self.assertTrue('Compiled once:' in stdout.getvalue())
+
+
+class LRUCacheTest(TestCase):
+    def test_evicts_the_entry_used_last(self):
+        cache = api.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache['a'], 1)
+        cache['c'] = 3
+        self.assertEqual(sorted(cache.data), ['a', 'c'])
+        cache['d'] = 4
+        self.assertEqual(sorted(cache.data), ['c', 'd'])
+
+    def test_compacts_the_queue(self):
+        cache = api.LRUCache(3)
+        for key in 'abc':
+            cache[key] = key
+        for number in range(100):
+            cache['a']
+            cache['b']
+        self.assertTrue(len(cache.order) <= 6)
+        cache['d'] = 'd'
+        self.assertEqual(sorted(cache.data), ['a', 'b', 'd'])
+
+    def test_pop(self):
+        cache = api.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertFalse('a' in cache)
+        cache['c'] = 3
+        cache['a'] = 4
+        self.assertEqual(sorted(cache.data), ['a', 'c'])
+        self.assertEqual(len(cache), 2)
+
+
+class ForeignKeyResolverTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(ForeignKeyResolverTest, self).setUp()
+        self.templates = [ItemTemplate.objects.create(description=u'Model %s' % number) for number in range(3)]
+
+    def import_items(self, lines, **kwargs):
+        return api.perform_import(self.write_csv(lines), Item, [mapping('property_number', 'csv_column[0]'),
+            mapping('item_template', 'csv_column[1]', 'description')], **kwargs)
+
+    def test_fetches_the_values_of_a_chunk_at_once(self):
+        self.set_importer_settings(CHUNK_SIZE=10)
+        resolver = api.ForeignKeyResolver(dryrun=False)
+        results, queries = count_queries(self.import_items, ['A%s,Model %s' % (number, number % 3) for number in range(10)], dryrun=False, resolver=resolver)
+        # The templates, the bulk insert and the suggestion index
+        self.assertTrue(queries <= 3)
+        self.assertTrue(u'Imported 10 lines.' in results)
+        self.assertEqual(Item.objects.filter(item_template=self.templates[1]).count(), 3)
+
+    def test_keeps_the_entries_used_last(self):
+        self.set_importer_settings(RESOLVER_CACHE_SIZE=2)
+        resolver = api.ForeignKeyResolver()
+        resolver.resolve(ItemTemplate, 'description', u'Model 0')
+        resolver.resolve(ItemTemplate, 'description', u'Model 1')
+        resolver.resolve(ItemTemplate, 'description', u'Model 0')
+        resolver.resolve(ItemTemplate, 'description', u'Model 2')
+
+        result, queries = count_queries(resolver.resolve, ItemTemplate, 'description', u'Model 0')
+        self.assertEqual((result, queries), (self.templates[0], 0))
+        result, queries = count_queries(resolver.resolve, ItemTemplate, 'description', u'Model 1')
+        self.assertEqual((result, queries), (self.templates[1], 1))
+
+    def test_reports_missing_values(self):
+        results = self.import_items(['A1,Model 0', 'A2,Unknown'], dryrun=False)
+        self.assertTrue([result for result in results if u'line: 2' in result and u'does not exist' in result])
+        self.assertEqual(list(Item.objects.filter(property_number__in=[u'A1', u'A2']).values_list('property_number', flat=True)), [u'A1'])
+
+    def test_creates_missing_values(self):
+        results = self.import_items(['A1,New', 'A2,New', 'A3,Model 0'], create_missing=True)
+        self.assertTrue(u'There were 0 errors.' in results)
+        self.assertFalse(ItemTemplate.objects.filter(description=u'New').exists())
+
+        results = self.import_items(['A1,New', 'A2,New', 'A3,Model 0'], dryrun=False, create_missing=True)
+        self.assertTrue(u'Imported 3 lines.' in results)
+        template = ItemTemplate.objects.get(description=u'New')
+        self.assertEqual(Item.objects.filter(item_template=template).count(), 2)
+
+
+class ImportJobTest(ImporterTestMixin, TestCase):
+    def test_finds_the_job_of_the_same_import(self):
+        job = self.get_job(['Acme,555'])
+        self.assertEqual(api.get_import_job(job.filename, job.model_name, loads(job.import_settings)), job)
+        self.assertNotEqual(api.get_import_job(job.filename, job.model_name, loads(job.import_settings), dryrun=False), job)
+
+    def test_claims_the_oldest_pending_job(self):
+        first = self.get_job(['Acme,555'])
+        second = self.get_job(['Other,556'])
+        self.assertEqual(api.claim_import_job(), first)
+        self.assertEqual(ImportJob.objects.get(pk=first.pk).state, JOB_STATE_RUNNING)
+        self.assertEqual(api.claim_import_job(), second)
+        self.assertEqual(api.claim_import_job(), None)
+
+    def test_worker_runs_the_pending_jobs(self):
+        dryrun_job = self.get_job(['Acme,555', 'Other,556'])
+        job = self.get_job(['Acme,555', 'Other,556'], dryrun=False)
+        output = self.run_jobs()
+        self.assertTrue('Running import job %s.' % job.pk in output)
+
+        dryrun_job = ImportJob.objects.get(pk=dryrun_job.pk)
+        self.assertEqual((dryrun_job.state, dryrun_job.processed_lines, dryrun_job.imported_lines), (JOB_STATE_DONE, 2, 2))
+        self.assertTrue(os.path.exists(dryrun_job.filename))
+
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual((job.state, job.processed_lines, job.imported_lines, job.errors), (JOB_STATE_DONE, 2, 2, 0))
+        self.assertTrue(u'Imported 2 lines.' in job.results)
+        self.assertEqual(api.get_job_status(job), job.results)
+        # The file of a final import is deleted
+        self.assertFalse(os.path.exists(job.filename))
+        self.assertEqual(Supplier.objects.filter(name__in=[u'Acme', u'Other']).count(), 2)
+
+    def test_records_the_failure(self):
+        job = self.get_job(['Acme,555'], model_name='inventory.unknown')
+        self.run_jobs()
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.state, JOB_STATE_FAILED)
+        self.assertTrue('Traceback' in job.results)
+
+    def test_progress_view(self):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        job = self.get_job(['Acme,555'])
+        url = reverse('import_job_progress', args=[job.pk])
+
+        progress = loads(self.client.get(url).content)
+        self.assertEqual((progress['state'], progress['finished'], progress['processed_lines']), (JOB_STATE_PENDING, False, 0))
+        self.assertTrue(u'processed 0 lines' in progress['text'])
+
+        self.run_jobs()
+        progress = loads(self.client.get(url).content)
+        self.assertEqual((progress['state'], progress['finished'], progress['processed_lines'], progress['imported_lines']), (JOB_STATE_DONE, True, 1, 1))
+        self.assertEqual(self.client.get(reverse('import_job_progress', args=[job.pk + 1])).status_code, 404)
+
+
+class FakePool(object):
+    """
+    Parses the shards when their result is read, counting the shards
+    submitted and not read yet
+    """
+    def __init__(self, processes):
+        self.pending = 0
+        self.max_pending = 0
+        FakePool.instance = self
+
+    def apply_async(self, function, args):
+        pool = self
+        pool.pending += 1
+        pool.max_pending = max(pool.max_pending, pool.pending)
+        class Result(object):
+            def get(self):
+                pool.pending -= 1
+                return function(*args)
+        return Result()
+
+    def terminate(self):
+        pass
+
+
+class ParallelParseTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(ParallelParseTest, self).setUp()
+        self.lines = ['Acme %02d,555' % number for number in range(40)]
+        self.filename = self.write_csv(self.lines)
+        self.mappings = [mapping('name', 'csv_column[0]'), mapping('phone_number1', 'csv_column[1]')]
+
+    def parse(self, processes, start_row=1):
+        csvfile = open(self.filename, 'rb')
+        try:
+            dialect = api.get_dialect(csvfile)
+            return list(api.parse_rows(csvfile, dialect, api.compile_mappings(Supplier, self.mappings), start_row, processes,
+                (self.filename, None, Supplier, self.mappings)))
+        finally:
+            csvfile.close()
+
+    def test_shards_end_at_line_boundaries(self):
+        csvfile = open(self.filename, 'rb')
+        shards = api.get_shards(csvfile, start_row=3, shard_size=50)
+        csvfile.seek(shards[0][0])
+        self.assertEqual(csvfile.readline(), 'Acme 02,555\n')
+        for start, end in shards:
+            csvfile.seek(end - 1)
+            self.assertEqual(csvfile.read(1), '\n')
+        csvfile.close()
+        self.assertEqual(shards[-1][1], os.path.getsize(self.filename))
+
+    def test_worker_processes_parse_in_order(self):
+        self.set_importer_settings(SHARD_SIZE=64)
+        self.assertEqual(self.parse(2, start_row=3), self.parse(1, start_row=3))
+        self.assertEqual(self.parse(2)[-1], (40, {'name':u'Acme 39', 'phone_number1':u'555'}, []))
+
+    def test_bounds_the_pending_shards(self):
+        self.set_importer_settings(SHARD_SIZE=24, PENDING_SHARDS=2)
+        pool = api.Pool
+        api.Pool = FakePool
+        try:
+            rows = self.parse(3)
+        finally:
+            api.Pool = pool
+        self.assertEqual(len(rows), 40)
+        self.assertEqual(FakePool.instance.max_pending, 6)
+
+
+class ResumeImportJobTest(ImporterTestMixin, TransactionTestCase):
+    def setUp(self):
+        super(ResumeImportJobTest, self).setUp()
+        self.set_importer_settings(CHUNK_SIZE=2)
+        self.job = self.get_job(['Acme %s,555' % number for number in range(5)], dryrun=False)
+        self.write_chunk = api.write_chunk
+
+    def tearDown(self):
+        api.write_chunk = self.write_chunk
+        super(ResumeImportJobTest, self).tearDown()
+
+    def crash_in_chunk(self, number, committed):
+        """
+        Stops the worker like a killed process in the given chunk, once
+        it is committed or before
+        """
+        calls = []
+        def write_chunk(model, chunk, bulk=False, updates=None, saved=None):
+            calls.append(chunk)
+            if len(calls) < number:
+                return self.write_chunk(model, chunk, bulk, updates, saved)
+            if committed:
+                self.write_chunk(model, chunk, bulk, updates, saved)
+                raise SystemExit
+            def crash(failed):
+                saved(failed)
+                raise SystemExit
+            return self.write_chunk(model, chunk, bulk, updates, crash)
+        api.write_chunk = write_chunk
+
+        self.assertRaises(SystemExit, api.run_import_job, api.claim_import_job())
+        api.write_chunk = self.write_chunk
+
+    def resume(self):
+        self.assertTrue(api.resume_import_job(self.job))
+        self.run_jobs()
+        job = ImportJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.processed_lines, job.imported_lines), (JOB_STATE_DONE, 5, 5))
+        self.assertEqual(list(Supplier.objects.order_by('pk').values_list('name', flat=True)), [u'Acme %s' % number for number in range(5)])
+        self.assertTrue(u'Resumed after' in job.results)
+
+    def test_resumes_after_a_committed_chunk(self):
+        self.crash_in_chunk(2, committed=True)
+        job = ImportJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.processed_lines), (JOB_STATE_RUNNING, 4))
+        self.assertEqual(Supplier.objects.count(), 4)
+        self.resume()
+
+    def test_resumes_after_a_rolled_back_chunk(self):
+        self.crash_in_chunk(2, committed=False)
+        job = ImportJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.state, job.processed_lines), (JOB_STATE_RUNNING, 2))
+        self.assertEqual(Supplier.objects.count(), 2)
+        self.resume()
+
+
+class DedupeImportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(DedupeImportTest, self).setUp()
+        self.set_importer_settings(CHUNK_SIZE=2)
+        Supplier.objects.create(name=u'Acme')
+
+    def test_skips_existing_and_repeated_values(self):
+        results, calls = self.import_suppliers(['Acme,555', 'Other,556', 'Third,557', 'Other,558', ',559', ',560'],
+            expression='csv_column[0] or None', dryrun=False, dedupe_field='name')
+        self.assertTrue(u'Skipped 2 duplicate lines.' in results)
+        self.assertEqual(sorted(Supplier.objects.filter(name__in=[u'Acme', u'Other', u'Third']).values_list('name', 'phone_number1')),
+            [(u'Acme', None), (u'Other', u'556'), (u'Third', u'557')])
+
+    def test_test_runs_skip_repeated_values(self):
+        results, calls = self.import_suppliers(['Acme,555', 'Other,556', 'Third,557', 'Other,558'], dedupe_field='name')
+        self.assertTrue(u'Skipped 2 duplicate lines.' in results)
+        self.assertTrue(u'Imported 2 lines.' in results)
+
+    def test_rejects_unmapped_fields(self):
+        results, calls = self.import_suppliers(['Acme,555'], dedupe_field='notes')
+        self.assertEqual(len(results), 1)
+        self.assertTrue(u'notes' in results[0])
+
+
+class UpsertImportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(UpsertImportTest, self).setUp()
+        self.set_importer_settings(CHUNK_SIZE=4)
+        self.acme = Supplier.objects.create(name=u'Acme', phone_number1=u'555', notes=u'Kept')
+        self.other = Supplier.objects.create(name=u'Other', phone_number1=u'556')
+
+    def get_suppliers(self):
+        return sorted(Supplier.objects.filter(name__in=[u'Acme', u'Other', u'New']).values_list('pk', 'name', 'phone_number1', 'notes'))
+
+    def test_updates_the_existing_rows(self):
+        results, calls = self.import_suppliers(['Acme,999', 'Other,556', 'New,557', 'New,558'], dryrun=False, upsert_field='name')
+        self.assertTrue(u'Imported 1 lines.' in results)
+        self.assertTrue(u'Updated 1 lines.' in results)
+        # The unchanged row and the earlier line repeating a value
+        self.assertTrue(u'Skipped 2 unchanged lines.' in results)
+        new = Supplier.objects.get(name=u'New')
+        self.assertEqual(self.get_suppliers(), [(self.acme.pk, u'Acme', u'999', u'Kept'), (self.other.pk, u'Other', u'556', None),
+            (new.pk, u'New', u'558', None)])
+
+    def test_only_writes_the_changed_fields(self):
+        results, calls = self.import_suppliers(['Acme,999'], dryrun=False, upsert_field='name')
+        results, queries = capture_queries(self.import_suppliers, ['Acme,998'], dryrun=False, upsert_field='name')
+        # Logged as 'N times: UPDATE ...', bulk_update runs executemany
+        updates = [sql for sql in queries if 'UPDATE' in sql]
+        self.assertEqual(len(updates), 1)
+        self.assertTrue('phone_number1' in updates[0])
+        self.assertFalse('notes' in updates[0])
+
+    def test_test_runs_save_nothing(self):
+        results, calls = self.import_suppliers(['Acme,999', 'New,557'], upsert_field='name')
+        self.assertTrue(u'Updated 1 lines.' in results)
+        self.assertEqual(Supplier.objects.get(pk=self.acme.pk).phone_number1, u'555')
+        self.assertFalse(Supplier.objects.filter(name=u'New').exists())
+
+    def test_rows_without_a_key_are_inserted(self):
+        results, calls = self.import_suppliers(['Acme,999', ',557'], expression='csv_column[0] or u""', dryrun=False, upsert_field='name')
+        self.assertTrue(u'Imported 1 lines.' in results)
+        self.assertTrue(Supplier.objects.filter(name=u'', phone_number1=u'557').exists())
+
+    def test_rejects_deduplicating_too(self):
+        results, calls = self.import_suppliers(['Acme,999'], upsert_field='name', dedupe_field='name')
+        self.assertEqual(len(results), 1)
+        self.assertEqual(Supplier.objects.get(pk=self.acme.pk).phone_number1, u'555')
+
+
+class SampledTestRunTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(SampledTestRunTest, self).setUp()
+        self.set_importer_settings(DRYRUN_HEAD_ROWS=2, DRYRUN_SAMPLE_ROWS=1)
+        self.mappings = [mapping('name', 'csv_column[0]'), mapping('phone_number1', 'csv_column[1]')]
+        self.filename = self.write_csv(['Acme %s,555' % number for number in range(6)])
+        self.parse_row = api.parse_row
+        self.parsed_lines = []
+        def parse_row(compiled, column):
+            self.parsed_lines.append(column[0])
+            return self.parse_row(compiled, column)
+        api.parse_row = parse_row
+
+    def tearDown(self):
+        api.parse_row = self.parse_row
+        super(SampledTestRunTest, self).tearDown()
+
+    def run_import(self, dryrun):
+        self.parsed_lines = []
+        return api.perform_import(self.filename, Supplier, self.mappings, dryrun=dryrun, sample=dryrun)
+
+    def test_samples_rows(self):
+        csvfile = open(self.filename, 'rb')
+        dialect = api.get_dialect(csvfile)
+        count, rows = api.sample_rows(csvfile, dialect, start_row=2, head_size=2, sample_size=2, seed='seed')
+        csvfile.seek(0)
+        self.assertEqual(api.sample_rows(csvfile, dialect, start_row=2, head_size=2, sample_size=2, seed='seed'), (count, rows))
+        csvfile.close()
+        self.assertEqual(count, 5)
+        lines = [line for line, column in rows]
+        self.assertEqual(lines[:2], [2, 3])
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(lines, sorted(set(lines)))
+
+    def test_final_import_reuses_the_parsed_rows(self):
+        results = self.run_import(dryrun=True)
+        self.assertTrue(u'Validated a sample of 3 of 6 lines.' in results)
+        self.assertEqual(len(self.parsed_lines), 3)
+        parsed_filename = api.get_parsed_filename(self.filename, self.mappings, None)
+        self.assertEqual(os.path.dirname(parsed_filename), os.path.dirname(self.filename))
+        self.assertEqual(sorted(api.load_parsed_rows(parsed_filename).keys())[:2], [1, 2])
+        sampled = self.parsed_lines
+
+        results = self.run_import(dryrun=False)
+        self.assertTrue(u'Imported 6 lines.' in results)
+        self.assertEqual(sorted(self.parsed_lines + sampled), [u'Acme %s' % number for number in range(6)])
+        self.assertEqual(Supplier.objects.filter(name__startswith=u'Acme ').count(), 6)
+
+    def test_changed_files_are_parsed_again(self):
+        self.run_import(dryrun=True)
+        csvfile = open(self.filename, 'ab')
+        csvfile.write('Acme 6,555\n')
+        csvfile.close()
+        self.run_import(dryrun=False)
+        self.assertEqual(len(self.parsed_lines), 7)
+
+    def test_expired_rows_are_parsed_again(self):
+        self.run_import(dryrun=True)
+        self.set_importer_settings(PARSED_CACHE_TIMEOUT=-1)
+        self.run_import(dryrun=False)
+        self.assertEqual(len(self.parsed_lines), 6)
+
+    def test_final_import_job_removes_the_parsed_rows(self):
+        self.filename = self.write_csv(['Acme,555'])
+        self.run_import(dryrun=True)
+        parsed_filename = api.get_parsed_filename(self.filename, self.mappings, None)
+        self.assertTrue(os.path.exists(parsed_filename))
+        job = api.get_import_job(self.filename, 'inventory.supplier', {'start_row':1, 'dialect_settings':None, 'expressions':self.mappings}, dryrun=False)
+        self.run_jobs()
+        self.assertEqual(ImportJob.objects.get(pk=job.pk).state, JOB_STATE_DONE)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(parsed_filename))
+
+
+class ExportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.set_importer_settings(EXPORT_CHUNK_SIZE=2)
+        self.location = Location.objects.create(name=u'Depot')
+        for number in range(5):
+            Supplier.objects.create(name=u'Acme, %s' % number, phone_number1=number % 2 and u'555' or None, notes=u'Line\nbreak')
+
+    def get_suppliers(self):
+        return list(Supplier.objects.order_by('name').values_list(*[field.name for field in api.get_export_fields(Supplier)]))
+
+    def test_exports_in_chunks(self):
+        chunks = list(api.export_rows(Supplier, queryset=Supplier.objects.filter(name__startswith=u'Acme')))
+        self.assertEqual([chunk.count('Acme') for chunk in chunks], [2, 2, 1])
+
+    def test_fetches_each_chunk_after_the_last_key(self):
+        chunks, queries = capture_queries(list, api.export_rows(Supplier))
+        self.assertTrue([sql for sql in queries if '"id" >' in sql])
+
+    def test_csv_imports_back(self):
+        suppliers = self.get_suppliers()
+        filename = self.write_csv([''.join(api.export_rows(Supplier)).rstrip('\r\n')])
+        Supplier.objects.all().delete()
+        results = api.perform_import(filename, Supplier, api.get_default_mappings(Supplier), dryrun=False,
+            dialect_settings={'dialect_delimiter':',', 'dialect_doublequote':True, 'dialect_escapechar':'', 'dialect_quotechar':'"', 'dialect_skipinitialspace':False})
+        self.assertTrue(u'There were 0 errors.' in results)
+        self.assertEqual(self.get_suppliers(), suppliers)
+
+    def test_json_lines(self):
+        inventory = Inventory.objects.create(name=u'Main', location=self.location)
+        rows = [loads(line) for line in ''.join(api.export_rows(Inventory, api.EXPORT_FORMAT_JSON_LINES)).splitlines()]
+        self.assertEqual(rows, [{'name':u'Main', 'location':self.location.pk}])
+
+    def test_view_streams_the_rows(self):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        response = self.client.post(reverse('export_file'), {'model_name':'inventory.supplier', 'format':api.EXPORT_FORMAT_CSV})
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=inventory.supplier.csv')
+        self.assertEqual(response.content.count('Acme'), 5)
+
+
+def gzip_data(data):
+    output = StringIO()
+    compressed = gzip.GzipFile(fileobj=output, mode='wb')
+    compressed.write(data)
+    compressed.close()
+    return output.getvalue()
+
+
+class CompressedImportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(CompressedImportTest, self).setUp()
+        self.data = ''.join(['Acme %s,555\n' % number for number in range(200)])
+        self.gzip_data = gzip_data(self.data)
+        self.mappings = [mapping('name', 'csv_column[0]'), mapping('phone_number1', 'csv_column[1]')]
+
+    def decompress(self, data, compression, size=7):
+        return ''.join(api.decompress_chunks([data[start:start + size] for start in range(0, len(data), size)], compression))
+
+    def test_decompresses_the_chunks(self):
+        self.assertEqual(self.decompress(self.gzip_data, api.COMPRESSION_GZIP), self.data)
+        self.assertEqual(self.decompress(bz2.compress(self.data), api.COMPRESSION_BZ2), self.data)
+        # Files concatenated into one
+        self.assertEqual(self.decompress(self.gzip_data * 2, api.COMPRESSION_GZIP), self.data * 2)
+
+    def test_rejects_truncated_streams(self):
+        self.assertRaises(EOFError, self.decompress, self.gzip_data[:-4], api.COMPRESSION_GZIP)
+        self.assertRaises(EOFError, self.decompress, self.gzip_data[:len(self.gzip_data) / 2], api.COMPRESSION_GZIP)
+        self.assertRaises(EOFError, self.decompress, bz2.compress(self.data)[:-4], api.COMPRESSION_BZ2)
+        self.assertRaises(EOFError, self.decompress, '', api.COMPRESSION_GZIP)
+
+    def test_reads_compressed_files(self):
+        csvfile = api.open_csv_file(self.write_file(self.gzip_data, '.gz'))
+        self.assertEqual(csvfile.read(6), 'Acme 0')
+        self.assertEqual(csvfile.readline(), ',555\n')
+        self.assertEqual(list(csvfile)[-1], 'Acme 199,555\n')
+        csvfile.seek(0)
+        self.assertEqual(csvfile.read(), self.data)
+        self.assertRaises(IOError, csvfile.seek, 10)
+        csvfile.close()
+
+    def test_imports_compressed_files(self):
+        for data, suffix in ((self.gzip_data, '.csv.gz'), (bz2.compress(self.data), '.csv.bz2')):
+            results = api.perform_import(self.write_file(data, suffix), Supplier, self.mappings, dryrun=False, processes=2)
+            self.assertTrue(u'Imported 200 lines.' in results)
+        self.assertEqual(Supplier.objects.filter(name=u'Acme 199').count(), 2)
+
+    def test_truncated_imports_fail(self):
+        job = api.get_import_job(self.write_file(self.gzip_data[:-4], '.gz'), 'inventory.supplier',
+            {'start_row':1, 'dialect_settings':None, 'expressions':self.mappings}, dryrun=False)
+        self.run_jobs()
+        job = ImportJob.objects.get(pk=job.pk)
+        self.assertEqual(job.state, JOB_STATE_FAILED)
+        self.assertTrue(u'The compressed file ended before the end of its data.' in job.results)
+
+    def upload(self, data, name):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        return self.client.post(reverse('import_wizard'), {'model_name':'inventory.supplier',
+            'local_document':SimpleUploadedFile(name, data, content_type='application/x-gzip')})
+
+    def test_upload_is_kept_compressed(self):
+        response = self.upload(self.gzip_data, 'suppliers.csv.gz')
+        self.assertEqual(response.status_code, 302)
+        filename = [value for key, value in parse_qsl(response['Location'].split('?', 1)[1]) if key == 'temp_file'][0]
+        self.filenames.append(filename)
+        self.assertTrue(filename.endswith('.gz'))
+        self.assertEqual(open(filename, 'rb').read(), self.gzip_data)
+
+        # The wizard previews the decompressed lines
+        response = self.client.get(response['Location'])
+        self.assertContains(response, 'Acme 9,555')
+
+    def test_rejects_invalid_uploads(self):
+        response = self.upload('not compressed', 'suppliers.csv.gz')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].endswith(reverse('import_wizard')))
+
+
+class BundleImportTest(ImporterTestMixin, TestCase):
+    def setUp(self):
+        super(BundleImportTest, self).setUp()
+        self.inventory_settings = {'expressions':[mapping('name', 'csv_column[0]'), mapping('location', 'csv_column[1]', 'name')]}
+
+    def write_bundle(self, members):
+        output = StringIO()
+        bundle = zipfile.ZipFile(output, 'w')
+        for name, data in members:
+            bundle.writestr(name, data)
+        bundle.close()
+        return self.write_file(output.getvalue(), '.zip')
+
+    def get_bundle(self, inventory_settings=None):
+        return self.write_bundle([
+            ('inventory.inventory.csv', 'Main,Depot\nSpare,Depot\nBranch,Office\n'),
+            ('inventory.inventory.json', dumps(inventory_settings or self.inventory_settings)),
+            # Without settings, read with the default mappings of an export
+            ('inventory.location.csv', 'Depot%s\nOffice%s\n' % ((',' * (len(api.get_export_fields(Location)) - 1),) * 2)),
+        ])
+
+    def get_inventories(self):
+        return sorted(Inventory.objects.filter(name__in=[u'Main', u'Spare', u'Branch']).values_list('name', 'location__name'))
+
+    def test_imports_the_referenced_models_first(self):
+        results = api.perform_bundle_import(self.get_bundle(), dryrun=False)
+        self.assertTrue(results.index(u'inventory.location.csv:') < results.index(u'inventory.inventory.csv:'))
+        self.assertEqual(self.get_inventories(), [(u'Branch', u'Office'), (u'Main', u'Depot'), (u'Spare', u'Depot')])
+
+    def test_resolves_the_imported_rows_without_querying(self):
+        lookups = []
+        resolver_class = api.ForeignKeyResolver
+        class CountingResolver(resolver_class):
+            def prefetch(self, model, arguments, values):
+                lookups.append([key for key in values if (model, arguments, key) not in self.cache])
+                return resolver_class.prefetch(self, model, arguments, values)
+        api.ForeignKeyResolver = CountingResolver
+        try:
+            api.perform_bundle_import(self.get_bundle(), dryrun=False)
+        finally:
+            api.ForeignKeyResolver = resolver_class
+        self.assertEqual(lookups, [[]])
+
+    def test_test_runs_resolve_the_unsaved_rows(self):
+        results = api.perform_bundle_import(self.get_bundle())
+        self.assertEqual(results.count(u'There were 0 errors.'), 2)
+        self.assertFalse(Location.objects.filter(name=u'Office').exists())
+
+    def test_rejects_primary_key_lookups(self):
+        results = api.perform_bundle_import(self.get_bundle({'expressions':[mapping('name', 'csv_column[0]'), mapping('location', 'csv_column[1]', 'pk')]}))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(results[0].startswith(u'Bundle error'))
+
+    def test_rejects_unknown_members(self):
+        results = api.perform_bundle_import(self.write_bundle([('suppliers.csv', 'Acme\n')]))
+        self.assertEqual(len(results), 1)
+        self.assertTrue(u'suppliers.csv' in results[0])
+
+    def test_import_order(self):
+        self.assertEqual(api.get_import_order({Inventory:set([Location]), Location:set(), Supplier:set()}), [Location, Supplier, Inventory])
+        self.assertRaises(ValueError, api.get_import_order, {Inventory:set([Location]), Location:set([Inventory])})
+
+    def test_command(self):
+        stdout = StringIO()
+        call_command('import_bundle', self.get_bundle(), commit=True, stdout=stdout)
+        self.assertTrue('inventory.inventory.csv:' in stdout.getvalue())
+        self.assertEqual(len(self.get_inventories()), 3)
@@ -3,8 +3,10 @@ from forms import PreviewForm, ExpressionForm, ImportWizard
 
 urlpatterns = patterns('importer.views',
     url(r'^upload/$', 'import_file', (), 'import_wizard'),
+    url(r'^export/$', 'export_file', (), 'export_file'),
     url(r'^wizard/$', 'import_wizard', (), 'import_next_steps'),
     url(r'^download_last_settings/$', 'download_last_settings', (), 'download_last_settings'),
+    url(r'^job/(?P<object_id>\d+)/progress/$', 'import_job_progress', (), 'import_job_progress'),
 )
 
 
@@ -4,6 +4,7 @@ import tempfile
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db.models import get_model
 from django.contrib import messages
 from django.contrib.contenttypes.models import ContentType
 from django.forms.formsets import formset_factory
@@ -15,15 +16,50 @@ from django.utils.simplejson import dumps, loads
 from django.utils.http import urlencode
 
 
-from forms import DocumentForm, PreviewForm, ExpressionForm, ImportResultForm, ImportWizard
+from api import get_job_status, export_rows, get_compression, open_csv_file, EXPORT_MIMETYPES
+from forms import DocumentForm, ExportForm, PreviewForm, ExpressionForm, ImportResultForm, ImportWizard
+from models import ImportJob
+
+IMPORT_MODELS = [
+    'inventory.inventory',
+    'inventory.inventorytransaction',
+    'assets.itemgroup',
+    'assets.itemstate',
+    'inventory.itemtemplate',
+    'inventory.location',
+    'assets.person',
+    'assets.state',
+    'inventory.supplier',
+    'assets.item',
+]
 
 def handle_uploaded_file(f):
-    destination, filepath = tempfile.mkstemp()
+    """
+    Writes an upload to a temporary file, gzip and bz2 compressed files
+    are kept compressed under their extension and decompressed as the
+    importer reads them, see api.open_csv_file.  Raises IOError if the
+    start of the file can't be read
+    """
+    suffix = ''
+    if get_compression(f.name):
+        suffix = os.path.splitext(f.name)[1].lower()
+    destination, filepath = tempfile.mkstemp(suffix=suffix)
 
     destination = open(filepath, 'wb')
     for chunk in f.chunks():
         destination.write(chunk)
     destination.close()
+
+    # Only the start read by the preview, a file truncated further on
+    # fails its import
+    csvfile = open_csv_file(filepath)
+    try:
+        csvfile.read(1024)
+    except IOError:
+        csvfile.close()
+        os.unlink(filepath)
+        raise
+    csvfile.close()
     return filepath
 
 
@@ -35,22 +71,14 @@ def import_wizard(request):
 
 
 def import_file(request):
-    models = [
-        'inventory.inventory',
-        'inventory.inventorytransaction',
-        'assets.itemgroup',
-        'assets.itemstate',
-        'inventory.itemtemplate',
-        'inventory.location',
-        'assets.person',
-        'assets.state',
-        'inventory.supplier',
-        'assets.item',
-    ]
     if request.method == 'POST':
-        form = DocumentForm(request.POST, request.FILES, models=models)
+        form = DocumentForm(request.POST, request.FILES, models=IMPORT_MODELS)
         if form.is_valid():
-            temp_file = handle_uploaded_file(form.cleaned_data['local_document'])
+            try:
+                temp_file = handle_uploaded_file(form.cleaned_data['local_document'])
+            except IOError, err:
+                messages.error(request, _(u'The compressed file could not be read: %s') % err)
+                return HttpResponseRedirect(reverse('import_wizard'))
             return HttpResponseRedirect(
                 '?'.join(
                     [reverse('import_next_steps'),
@@ -60,7 +88,7 @@ def import_file(request):
                     })]))
 
     else:
-        form = DocumentForm(models=models)
+        form = DocumentForm(models=IMPORT_MODELS)
 
 
     return render_to_response('generic_form.html', {
@@ -70,15 +98,49 @@ def import_file(request):
     context_instance=RequestContext(request))
 
 
+def export_file(request):
+    if request.method == 'POST':
+        form = ExportForm(request.POST, models=IMPORT_MODELS)
+        if form.is_valid():
+            model = get_model(*form.cleaned_data['model_name'].split('.', 1))
+            format = form.cleaned_data['format']
+            # Streamed, the rows are written as they are fetched
+            response = HttpResponse(export_rows(model, format), mimetype=EXPORT_MIMETYPES[format])
+            # Named like the members of an import bundle
+            response['Content-Disposition'] = 'attachment; filename=%s.%s.%s' % (model._meta.app_label, model._meta.module_name, format)
+            return response
+    else:
+        form = ExportForm(models=IMPORT_MODELS)
+
+    return render_to_response('generic_form.html', {
+        'form':form,
+        'title':_(u'Export the rows of a model'),
+    },
+    context_instance=RequestContext(request))
+
+
 def download_last_settings(request):
     settings = request.session.get('last_import_settings', None)
     if settings:
         content=dumps(settings)
         response = HttpResponse(content, content_type='text/plain', mimetype='application/json')
         response['Content-Length'] = len(content)
-        response['Content-Disposition'] = "attachment; filename=last_import_settings.json"
+        response['Content-Disposition'] = "attachment; filename=%s.json" % settings.get('model_name', 'last_import_settings')
         return response
 
 
     messages.error(request, _(u'There are no settings available to download.'))
     return HttpResponseRedirect('/')
+
+
+def import_job_progress(request, object_id):
+    job = get_object_or_404(ImportJob, pk=object_id)
+    return HttpResponse(dumps({
+        'state':job.state,
+        'finished':job.is_finished(),
+        'processed_lines':job.processed_lines,
+        'imported_lines':job.imported_lines,
+        'errors':job.errors,
+        'rows_per_second':job.get_rows_per_second(),
+        'text':unicode(get_job_status(job)),
+    }), mimetype='application/json')
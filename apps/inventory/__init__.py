@@ -15,6 +15,7 @@ inventory_delete = {'text':_(u'delete'), 'view':'inventory_delete', 'args':'obje
 inventory_create_transaction = {'text':_('add transaction'), 'view':'inventory_create_transaction', 'args':'object.id', 'famfam':'book_add'}
 inventory_view = {'text':_(u'details'), 'view':'inventory_view', 'args':'object.id', 'famfam':'package_go'}
 inventory_list_transactions = {'text':_(u'inventory transactions'), 'view':'inventory_list_transactions', 'args':'object.id', 'famfam':'book_go'}
+inventory_balances = {'text':_(u'balances as of date'), 'view':'inventory_balances', 'args':'object.id', 'famfam':'book_open'}
 
 inventory_transaction_list = {'text':_('view all transactions'), 'view':'inventory_transaction_list', 'famfam':'book_go'}
 inventory_transaction_create = {'text':_('create new transaction'), 'view':'inventory_transaction_create', 'famfam':'book_add'}
@@ -60,8 +61,8 @@ register_links(ItemTemplate, [template_update, template_delete, template_photos,
 register_links(['supplier_list', 'supplier_create', 'supplier_update', 'supplier_view', 'supplier_delete', 'supplier_assign_itemtemplates'], [supplier_create], menu_name='sidebar')
 register_links(Supplier, [supplier_update, supplier_delete, supplier_assign_itemtemplate, supplier_purchase_orders])
 
-register_links(['inventory_view', 'inventory_list', 'inventory_create', 'inventory_update', 'inventory_delete', 'inventory_transaction_list'], [inventory_create], menu_name='sidebar')
-register_links(Inventory, [inventory_update, inventory_delete, inventory_list_transactions, inventory_create_transaction])
+register_links(['inventory_view', 'inventory_list', 'inventory_create', 'inventory_update', 'inventory_delete', 'inventory_transaction_list', 'inventory_balances'], [inventory_create], menu_name='sidebar')
+register_links(Inventory, [inventory_update, inventory_delete, inventory_list_transactions, inventory_create_transaction, inventory_balances])
 register_links(Inventory, [inventory_view], menu_name='sidebar')
 
 register_links(['inventory_transaction_list', 'inventory_transaction_create', 'inventory_transaction_update', 'inventory_transaction_delete', 'inventory_transaction_view'], [inventory_create_transaction], menu_name='sidebar')
@@ -0,0 +1,60 @@
+import datetime
+
+from django.db.models import Sum
+
+from models import ItemTemplate, InventoryCheckPoint, InventoryTransaction, \
+                   InventoryTransactionArchive
+
+
+def get_check_point(inventory, date):
+    """
+    Returns the latest check point taken on or before the given date or
+    None if the inventory has no such check point
+    """
+    check_points = InventoryCheckPoint.objects.filter(inventory=inventory, datetime__lt=date + datetime.timedelta(days=1)).order_by('-datetime')[:1]
+    if check_points:
+        return check_points[0]
+
+
+def get_balances(inventory, date=None):
+    """
+    Returns a dictionary of supply id: quantity pairs for the inventory
+    at the end of the given date (today by default).  A check point holds
+    the quantities of every transaction dated on or before the check
+    point's date, so only the transactions after the latest one are
+    added up.  Archived transactions are always covered by the latest
+    check point, they are only looked up for dates before it
+    """
+    if date is None:
+        date = datetime.date.today()
+
+    quantities = {}
+    models = [InventoryTransaction]
+
+    check_point = get_check_point(inventory, date)
+    if check_point:
+        quantities = dict(check_point.inventorycpqty_set.values_list('supply', 'quantity'))
+        if InventoryCheckPoint.objects.filter(inventory=inventory, datetime__gt=check_point.datetime).exists():
+            models.append(InventoryTransactionArchive)
+    else:
+        models.append(InventoryTransactionArchive)
+
+    for model in models:
+        transactions = model.objects.filter(inventory=inventory, date__lte=date)
+        if check_point:
+            transactions = transactions.filter(date__gt=check_point.datetime.date())
+
+        for supply, total in transactions.values_list('supply').annotate(total=Sum('quantity')).order_by():
+            quantities[supply] = quantities.get(supply, 0) + total
+
+    return quantities
+
+
+def get_balances_list(inventory, date=None):
+    """
+    Same as get_balances but in the object list format used by
+    generic_list_subtemplate.html
+    """
+    quantities = get_balances(inventory, date)
+    templates = ItemTemplate.objects.in_bulk(quantities.keys())
+    return [{'item_template':templates[supply], 'qty':qty} for supply, qty in sorted(quantities.items(), key=lambda x:templates[x[0]].description)]
@@ -44,6 +44,10 @@ class InventoryTransactionForm(forms.ModelForm):
         model = InventoryTransaction
 
 
+class InventoryBalanceDateForm(forms.Form):
+    date = forms.DateField(label=_(u'Date'), required=False, help_text=_(u'Show the balances at the end of this date, leave blank for today.'))
+
+
 class SupplierForm(forms.ModelForm):
     class Meta:
         model = Supplier
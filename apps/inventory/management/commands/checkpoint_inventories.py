@@ -0,0 +1,116 @@
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max, Sum
+
+from common.db import bulk_insert
+
+from inventory.models import Inventory, InventoryCheckPoint, InventoryCPQty, \
+                             InventoryTransaction, InventoryTransactionArchive
+
+#Keep the IN clauses below the SQLite bound parameters limit
+IN_CHUNK_SIZE = 500
+
+
+def chunks(sequence, size=IN_CHUNK_SIZE):
+    for start in range(0, len(sequence), size):
+        yield sequence[start:start + size]
+
+
+class Command(BaseCommand):
+    help = 'Writes a new check point with the quantities of every inventory, optionally archiving the transactions it covers.'
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date', default=None,
+            help='Last day covered by the check point (YYYY-MM-DD), defaults to yesterday.'),
+        make_option('--archive', action='store_true', dest='archive', default=False,
+            help='Move the transactions covered by the check point to the archive table.'),
+        make_option('--every', dest='every', type='int', default=0,
+            help='Keep running and write a check point for the previous day every given number of hours.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['every']:
+            while True:
+                self.checkpoint(datetime.date.today() - datetime.timedelta(days=1), options['archive'])
+                time.sleep(options['every'] * 3600)
+
+        if options['date']:
+            try:
+                date = datetime.datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid date: %s' % options['date'])
+        else:
+            date = datetime.date.today() - datetime.timedelta(days=1)
+
+        if date >= datetime.date.today():
+            raise CommandError('Check points can only cover past days, new transactions may still be dated today.')
+
+        self.checkpoint(date, options['archive'])
+
+    @transaction.commit_on_success
+    def checkpoint(self, date, archive):
+        check_point_datetime = datetime.datetime.combine(date, datetime.time(23, 59, 59))
+
+        # Latest previous check point of every inventory
+        last_datetimes = dict(InventoryCheckPoint.objects.values_list('inventory').annotate(last=Max('datetime')).order_by())
+        inventories = [inventory for inventory in Inventory.objects.values_list('id', flat=True) if inventory not in last_datetimes or last_datetimes[inventory] < check_point_datetime]
+
+        anchors = {}
+        quantities = dict([(inventory, {}) for inventory in inventories])
+        for check_point in InventoryCheckPoint.objects.filter(datetime__in=set(last_datetimes.values())):
+            if check_point.inventory_id in quantities and last_datetimes[check_point.inventory_id] == check_point.datetime:
+                anchors[check_point.inventory_id] = check_point
+
+        for anchor_ids in chunks([check_point.id for check_point in anchors.values()]):
+            for inventory, supply, quantity in InventoryCPQty.objects.filter(check_point__in=anchor_ids).values_list('check_point__inventory', 'supply', 'quantity'):
+                quantities[inventory][supply] = quantity
+
+        # Inventories anchored on the same date share one grouped aggregate
+        groups = {}
+        for inventory in inventories:
+            anchor = anchors.get(inventory)
+            groups.setdefault(anchor and anchor.datetime.date(), []).append(inventory)
+
+        for anchor_date, group in groups.items():
+            for inventory_ids in chunks(group):
+                transactions = InventoryTransaction.objects.filter(inventory__in=inventory_ids, date__lte=date)
+                if anchor_date:
+                    transactions = transactions.filter(date__gt=anchor_date)
+
+                for inventory, supply, total in transactions.values_list('inventory', 'supply').annotate(total=Sum('quantity')).order_by():
+                    quantities[inventory][supply] = quantities[inventory].get(supply, 0) + total
+
+        check_point_quantities = []
+        for inventory in inventories:
+            check_point = InventoryCheckPoint.objects.create(inventory_id=inventory, datetime=check_point_datetime)
+            for supply, quantity in quantities[inventory].items():
+                check_point_quantities.append(InventoryCPQty(check_point=check_point, supply_id=supply, quantity=quantity))
+        bulk_insert(InventoryCPQty, check_point_quantities)
+
+        self.stdout.write('Wrote %s check points with %s quantities as of %s.\n' % (len(inventories), len(check_point_quantities), date))
+
+        if archive:
+            self.archive(date, inventories)
+
+    def archive(self, date, inventories):
+        """
+        Moves the transactions covered by the new check points with plain
+        SQL, so the StockBalance signal handlers do not subtract them
+        """
+        qn = connection.ops.quote_name
+        columns = ', '.join([qn(field.column) for field in InventoryTransactionArchive._meta.local_fields])
+        cursor = connection.cursor()
+        archived = 0
+        for inventory_ids in chunks(inventories):
+            where = '%s <= %%s AND %s IN (%s)' % (qn('date'), qn('inventory_id'), ', '.join(['%s'] * len(inventory_ids)))
+            params = [connection.ops.value_to_db_date(date)] + list(inventory_ids)
+            cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s' % (
+                qn(InventoryTransactionArchive._meta.db_table), columns, columns, qn(InventoryTransaction._meta.db_table), where), params)
+            cursor.execute('DELETE FROM %s WHERE %s' % (qn(InventoryTransaction._meta.db_table), where), params)
+            archived += cursor.rowcount
+        transaction.set_dirty()
+
+        self.stdout.write('Archived %s transactions.\n' % archived)
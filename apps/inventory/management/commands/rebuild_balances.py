@@ -0,0 +1,66 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from inventory.api import get_balances
+from inventory.models import Inventory, StockBalance
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the stock balance table from the inventory transactions ledger.'
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+            help='Only report the balances that drifted from the ledger, without fixing them.'),
+    )
+
+    def handle(self, *args, **options):
+        ledger = StockBalance.objects.ledger_totals()
+        balances = dict([((b.inventory_id, b.supply_id), b) for b in StockBalance.objects.all()])
+
+        drifted = []
+        for key, total in ledger.items():
+            balance = balances.get(key)
+            if balance is None or balance.qty != total:
+                drifted.append((key, balance and balance.qty, total))
+        for key, balance in balances.items():
+            if key not in ledger:
+                drifted.append((key, balance.qty, None))
+
+        for (inventory_id, supply_id), qty, total in drifted:
+            self.stdout.write('inventory: %s, supply: %s, balance: %s, ledger: %s\n' % (inventory_id, supply_id, qty, total))
+
+        # The check point quantities plus the later transactions, shown
+        # by the inventory views
+        mismatched = []
+        for inventory in Inventory.objects.all():
+            quantities = get_balances(inventory)
+            for supply_id in set(quantities.keys() + [key[1] for key in ledger if key[0] == inventory.pk]):
+                if quantities.get(supply_id, 0) != ledger.get((inventory.pk, supply_id), 0):
+                    mismatched.append((inventory.pk, supply_id, quantities.get(supply_id), ledger.get((inventory.pk, supply_id))))
+
+        for inventory_id, supply_id, quantity, total in mismatched:
+            self.stdout.write('inventory: %s, supply: %s, check point balance: %s, ledger: %s\n' % (inventory_id, supply_id, quantity, total))
+
+        if options['check']:
+            if drifted or mismatched:
+                raise CommandError('%s balances drifted from the ledger, %s check point balances differ from it.' % (len(drifted), len(mismatched)))
+            self.stdout.write('All balances match the ledger.\n')
+            return
+
+        self.rebuild(ledger, balances, drifted)
+        self.stdout.write('Fixed %s balances.\n' % len(drifted))
+        if mismatched:
+            raise CommandError('%s check point balances differ from the ledger, write a new check point with checkpoint_inventories.' % len(mismatched))
+
+    @transaction.commit_on_success
+    def rebuild(self, ledger, balances, drifted):
+        for (inventory_id, supply_id), qty, total in drifted:
+            balance = balances.get((inventory_id, supply_id))
+            if total is None:
+                balance.delete()
+            elif balance is None:
+                StockBalance.objects.create(inventory_id=inventory_id, supply_id=supply_id, qty=total)
+            else:
+                balance.qty = total
+                balance.save()
@@ -1,6 +1,9 @@
 import datetime
 
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models import Sum
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
@@ -9,6 +12,7 @@ from django.core.urlresolvers import reverse
 
 from photos.models import GenericPhoto
 
+from common.api import register_list_relations
 from dynamic_search.api import register
 
 
@@ -93,7 +97,7 @@ class Inventory(models.Model):
 
 class InventoryCheckPoint(models.Model):
     inventory = models.ForeignKey(Inventory)
-    datetime = models.DateTimeField(default=datetime.datetime.now())	
+    datetime = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     supplies = models.ManyToManyField(ItemTemplate, null=True, blank=True, through='InventoryCPQty')
 
 
@@ -107,7 +111,7 @@ class InventoryTransaction(models.Model):
     inventory = models.ForeignKey(Inventory)
     supply = models.ForeignKey(ItemTemplate)
     quantity = models.IntegerField()
-    date = models.DateField(default=datetime.date.today(), verbose_name=_(u"date"))
+    date = models.DateField(default=datetime.date.today, db_index=True, verbose_name=_(u"date"))
     notes = models.TextField(null=True, blank=True)
 
     class Meta:
@@ -119,10 +123,104 @@ class InventoryTransaction(models.Model):
     def get_absolute_url(self):
         return ('inventory_transaction_view', [str(self.id)])
 
+    def check_open(self, dates):
+        """
+        Raises ValidationError if one of the dates is already accounted
+        for by the latest check point of the inventory, the balances only
+        add up the transactions after it
+        """
+        check_points = InventoryCheckPoint.objects.filter(inventory=self.inventory_id).order_by('-datetime')[:1]
+        if not check_points:
+            return
+
+        closed = check_points[0].datetime.date()
+        if [date for date in dates if date and date <= closed]:
+            raise ValidationError(_(u'The quantities of this inventory up to %s are closed by a check point, use a later date.') % closed)
+
+    def clean(self):
+        """
+        Rejects the dates closed by a check point, transactions dated
+        before it can't be edited either
+        """
+        if not self.inventory_id:
+            return
+
+        dates = [self.date]
+        if self.pk:
+            dates.extend(InventoryTransaction.objects.filter(pk=self.pk).values_list('date', flat=True))
+        self.check_open(dates)
+
+    def delete(self, *args, **kwargs):
+        # Queryset deletes and the deletes cascading from the inventory,
+        # which takes its check points along, don't call this
+        self.check_open(InventoryTransaction.objects.filter(pk=self.pk).values_list('date', flat=True))
+        super(InventoryTransaction, self).delete(*args, **kwargs)
+
+    def __unicode__(self):
+        return "%s: '%s' qty=%s @ %s" % (self.inventory, self.supply, self.quantity, self.date)
+
+
+class InventoryTransactionArchive(models.Model):
+    """
+    Transactions moved out of the live ledger by the
+    checkpoint_inventories command, they are already accounted for in
+    a check point
+    """
+    id = models.IntegerField(primary_key=True)
+    inventory = models.ForeignKey(Inventory)
+    supply = models.ForeignKey(ItemTemplate)
+    quantity = models.IntegerField()
+    date = models.DateField(db_index=True, verbose_name=_(u"date"))
+    notes = models.TextField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _(u'archived inventory transaction')
+        verbose_name_plural = _(u'archived inventory transactions')
+        ordering = ['-date', '-id']
+
     def __unicode__(self):
         return "%s: '%s' qty=%s @ %s" % (self.inventory, self.supply, self.quantity, self.date)
 
 
+class StockBalanceManager(models.Manager):
+    def add_quantity(self, inventory_id, supply_id, quantity):
+        if not self.filter(inventory__pk=inventory_id, supply__pk=supply_id).update(qty=models.F('qty') + quantity):
+            self.create(inventory_id=inventory_id, supply_id=supply_id, qty=quantity)
+
+    def ledger_totals(self):
+        """
+        Returns the quantity of every (inventory id, supply id) pair as
+        computed from the transactions ledger
+        """
+        ledger = {}
+        for model in (InventoryTransaction, InventoryTransactionArchive):
+            for inventory, supply, total in model.objects.values_list('inventory', 'supply').annotate(total=Sum('quantity')).order_by():
+                ledger[(inventory, supply)] = ledger.get((inventory, supply), 0) + total
+        return ledger
+
+
+class StockBalance(models.Model):
+    """
+    Running quantity of a supply in an inventory, kept up to date by the
+    InventoryTransaction signal handlers below.  Changes made with
+    queryset.update() or raw SQL bypass the handlers, use the
+    rebuild_balances command to bring the table back in sync
+    """
+    inventory = models.ForeignKey(Inventory, verbose_name=_(u'inventory'))
+    supply = models.ForeignKey(ItemTemplate, verbose_name=_(u'supply'))
+    qty = models.IntegerField(default=0, verbose_name=_(u'quantity'))
+
+    objects = StockBalanceManager()
+
+    class Meta:
+        unique_together = ('inventory', 'supply')
+        verbose_name = _(u'stock balance')
+        verbose_name_plural = _(u'stock balances')
+
+    def __unicode__(self):
+        return "%s: '%s' qty=%s" % (self.inventory, self.supply, self.qty)
+
+
 class Supplier(models.Model):
     #TODO: Contact, extension
     name = models.CharField(max_length=32, verbose_name=_("name"))
@@ -146,7 +244,33 @@ class Supplier(models.Model):
     def get_absolute_url(self):
         return ('supplier_view', [str(self.id)])
 
-register(ItemTemplate, _(u'templates'), ['description', 'brand', 'model', 'part_number', 'notes'])
+register(ItemTemplate, _(u'templates'), [('description', 3), 'brand', 'model', ('part_number', 10), 'notes'])
 register(Location, _(u'locations'), ['name', 'address_line1', 'address_line2', 'address_line3', 'address_line4', 'phone_number1', 'phone_number2'])
 register(Inventory, _(u'inventory'), ['name', 'location__name'])
 register(Supplier, _(u'supplier'), ['name', 'address_line1', 'address_line2', 'address_line3', 'address_line4', 'phone_number1', 'phone_number2', 'notes'])
+
+
+def transaction_pre_save(sender, instance, **kwargs):
+    instance._balance_old = None
+    if instance.pk:
+        old = InventoryTransaction.objects.filter(pk=instance.pk).values('inventory', 'supply', 'quantity')
+        if old:
+            instance._balance_old = old[0]
+
+
+def transaction_post_save(sender, instance, **kwargs):
+    old = getattr(instance, '_balance_old', None)
+    if old:
+        StockBalance.objects.add_quantity(old['inventory'], old['supply'], -old['quantity'])
+    StockBalance.objects.add_quantity(instance.inventory_id, instance.supply_id, instance.quantity)
+
+
+def transaction_post_delete(sender, instance, **kwargs):
+    StockBalance.objects.add_quantity(instance.inventory_id, instance.supply_id, -instance.quantity)
+
+pre_save.connect(transaction_pre_save, sender=InventoryTransaction)
+post_save.connect(transaction_post_save, sender=InventoryTransaction)
+post_delete.connect(transaction_post_delete, sender=InventoryTransaction)
+
+register_list_relations(InventoryTransaction, ['inventory', 'supply'])
+register_list_relations(StockBalance, ['inventory', 'supply'])
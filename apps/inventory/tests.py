@@ -0,0 +1,164 @@
+import datetime
+from cStringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from inventory.api import get_balances
+from inventory.forms import InventoryTransactionForm
+from inventory.models import ItemTemplate, Location, Inventory, InventoryCheckPoint, \
+                             InventoryTransaction, InventoryTransactionArchive, StockBalance
+
+
+def run_command(name, *args, **options):
+    """
+    Returns the output of a management command and whether it failed,
+    commands report a CommandError by exiting
+    """
+    stdout = StringIO()
+    try:
+        call_command(name, stdout=stdout, stderr=stdout, *args, **options)
+    except SystemExit:
+        return stdout.getvalue(), True
+    return stdout.getvalue(), False
+
+
+class InventoryTestCase(TestCase):
+    def setUp(self):
+        self.location = Location.objects.create(name=u'Depot')
+        self.inventory = Inventory.objects.create(name=u'Main', location=self.location)
+        self.other_inventory = Inventory.objects.create(name=u'Spare', location=self.location)
+        self.supply = ItemTemplate.objects.create(description=u'Toner')
+        self.other_supply = ItemTemplate.objects.create(description=u'Paper')
+
+    def get_qty(self, inventory, supply):
+        return StockBalance.objects.get(inventory=inventory, supply=supply).qty
+
+    def add_transaction(self, quantity, supply=None, date=None, inventory=None):
+        return InventoryTransaction.objects.create(inventory=inventory or self.inventory, supply=supply or self.supply,
+            quantity=quantity, date=date or datetime.date.today())
+
+
+class StockBalanceTest(InventoryTestCase):
+    def test_follows_the_transactions(self):
+        transaction = self.add_transaction(10)
+        self.add_transaction(-3)
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 7)
+
+        transaction.quantity = 20
+        transaction.save()
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 17)
+
+        transaction.delete()
+        self.assertEqual(self.get_qty(self.inventory, self.supply), -3)
+
+    def test_moves_with_the_transaction(self):
+        transaction = self.add_transaction(5)
+        transaction.inventory = self.other_inventory
+        transaction.supply = self.other_supply
+        transaction.save()
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 0)
+        self.assertEqual(self.get_qty(self.other_inventory, self.other_supply), 5)
+
+    def test_rebuild_balances(self):
+        transaction = self.add_transaction(5)
+        self.assertEqual(run_command('rebuild_balances', check=True), ('All balances match the ledger.\n', False))
+
+        # Bypasses the signal handlers
+        InventoryTransaction.objects.filter(pk=transaction.pk).update(quantity=8)
+        output, failed = run_command('rebuild_balances', check=True)
+        self.assertTrue(failed)
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 5)
+
+        output, failed = run_command('rebuild_balances')
+        self.assertFalse(failed)
+        self.assertTrue('Fixed 1 balances.' in output)
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 8)
+
+
+class CheckPointTest(InventoryTestCase):
+    def setUp(self):
+        super(CheckPointTest, self).setUp()
+        self.old_date = datetime.date.today() - datetime.timedelta(days=5)
+        self.old_transaction = self.add_transaction(7, date=self.old_date)
+        run_command('checkpoint_inventories', date=str(datetime.date.today() - datetime.timedelta(days=2)))
+
+    def get_form(self, date, instance=None):
+        return InventoryTransactionForm({'inventory':self.inventory.pk, 'supply':self.supply.pk, 'quantity':3, 'date':str(date)}, instance=instance)
+
+    def test_balances_start_from_the_check_point(self):
+        self.add_transaction(3)
+        self.assertEqual(get_balances(self.inventory), {self.supply.pk:10})
+        self.assertEqual(get_balances(self.inventory, self.old_date - datetime.timedelta(days=1)), {})
+
+    def test_rejects_closed_dates(self):
+        self.assertFalse(self.get_form(self.old_date).is_valid())
+        self.assertTrue(self.get_form(datetime.date.today()).is_valid())
+        # Nor can a closed transaction be moved to an open date
+        self.assertFalse(self.get_form(datetime.date.today(), self.old_transaction).is_valid())
+
+    def test_rejects_deleting_closed_transactions(self):
+        self.assertRaises(ValidationError, self.old_transaction.delete)
+        self.assertTrue(InventoryTransaction.objects.filter(pk=self.old_transaction.pk).exists())
+
+        transaction = self.add_transaction(3)
+        transaction.delete()
+        self.assertEqual(get_balances(self.inventory), {self.supply.pk:7})
+
+    def test_delete_view_keeps_closed_transactions(self):
+        User.objects.create_superuser(u'admin', u'admin@example.com', u'password')
+        self.client.login(username=u'admin', password=u'password')
+        response = self.client.post(reverse('inventory_transaction_delete', args=[self.old_transaction.pk]), {}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(InventoryTransaction.objects.filter(pk=self.old_transaction.pk).exists())
+        self.assertTrue([message for message in response.context['messages'] if 'closed by a check point' in message.message])
+
+    def test_check_compares_the_check_point_balances(self):
+        self.assertFalse(run_command('rebuild_balances', check=True)[1])
+        # Saved without the form validation
+        self.add_transaction(100, date=self.old_date)
+        output, failed = run_command('rebuild_balances', check=True)
+        self.assertTrue(failed)
+        self.assertTrue('check point balance: 7, ledger: 107' in output)
+
+
+class CheckpointInventoriesTest(InventoryTestCase):
+    def setUp(self):
+        super(CheckpointInventoriesTest, self).setUp()
+        self.today = datetime.date.today()
+        self.add_transaction(10, date=self.today - datetime.timedelta(days=10))
+        self.add_transaction(-4, date=self.today - datetime.timedelta(days=6))
+        self.add_transaction(2, supply=self.other_supply, date=self.today - datetime.timedelta(days=6))
+        self.add_transaction(5, date=self.today)
+
+    def checkpoint(self, days_ago, *args, **options):
+        return run_command('checkpoint_inventories', date=str(self.today - datetime.timedelta(days=days_ago)), *args, **options)
+
+    def test_check_points_add_to_the_previous_one(self):
+        self.checkpoint(8)
+        self.checkpoint(3)
+        check_point = InventoryCheckPoint.objects.filter(inventory=self.inventory).latest('datetime')
+        self.assertEqual(dict(check_point.inventorycpqty_set.values_list('supply', 'quantity')), {self.supply.pk:6, self.other_supply.pk:2})
+        self.assertEqual(get_balances(self.inventory), {self.supply.pk:11, self.other_supply.pk:2})
+
+    def test_archive_keeps_the_balances(self):
+        self.checkpoint(3, archive=True)
+        self.assertEqual(InventoryTransaction.objects.count(), 1)
+        self.assertEqual(InventoryTransactionArchive.objects.count(), 3)
+        self.assertEqual(get_balances(self.inventory), {self.supply.pk:11, self.other_supply.pk:2})
+        self.assertEqual(get_balances(self.inventory, self.today - datetime.timedelta(days=8)), {self.supply.pk:10})
+        self.assertEqual(self.get_qty(self.inventory, self.supply), 11)
+        self.assertFalse(run_command('rebuild_balances', check=True)[1])
+
+    def test_skips_covered_inventories(self):
+        self.checkpoint(3)
+        output, failed = self.checkpoint(4)
+        self.assertTrue('Wrote 0 check points' in output)
+
+    def test_rejects_open_days(self):
+        output, failed = self.checkpoint(0)
+        self.assertTrue(failed)
+        self.assertFalse(InventoryCheckPoint.objects.exists())
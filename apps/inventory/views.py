@@ -14,11 +14,13 @@ from photos.views import generic_photos
 from assets.models import Person, Item, ItemGroup
 
 from models import ItemTemplate, Inventory, \
-                   InventoryTransaction, Supplier
+                   InventoryTransaction, Supplier, StockBalance
 
 from inventory import location_filter
 
-from forms import InventoryForm_view, InventoryTransactionForm
+from forms import InventoryForm_view, InventoryTransactionForm, \
+                  InventoryBalanceDateForm
+from api import get_balances_list
 
 
 def supplier_assign_remove_itemtemplates(request, object_id):
@@ -85,15 +87,7 @@ def inventory_view(request, object_id):
     inventory = get_object_or_404(Inventory, pk=object_id)
     form = InventoryForm_view(instance=inventory)
 
-    transactions = InventoryTransaction.objects.filter(inventory=inventory)
-    supply_qty={}
-    for t in transactions:
-        if t.supply in supply_qty:
-            supply_qty[t.supply] = supply_qty[t.supply] + t.quantity
-        else:
-            supply_qty[t.supply] = t.quantity
-
-    supplies_list = [{'item_template':x, 'qty':y} for x,y in supply_qty.items()]
+    balances = StockBalance.objects.filter(inventory=inventory).select_related('supply').order_by('supply__description')
 
     return render_to_response('generic_detail.html', {
         'object_name':_(u'inventory'),
@@ -103,8 +97,8 @@ def inventory_view(request, object_id):
             {
                 'name':'generic_list_subtemplate.html',
                 'title':_(u'current balances for inventory: %s') % inventory,
-                'object_list':supplies_list,
-                'main_object':'item_template',
+                'object_list':balances,
+                'main_object':'supply',
                 'extra_columns':[{'name':_(u'quantity'),'attribute':'qty'}],
 
             }
@@ -113,6 +107,38 @@ def inventory_view(request, object_id):
     context_instance=RequestContext(request))
 
 
+def inventory_balances(request, object_id):
+    inventory = get_object_or_404(Inventory, pk=object_id)
+    form = InventoryForm_view(instance=inventory)
+
+    date = None
+    filter_form = InventoryBalanceDateForm(request.GET)
+    if filter_form.is_valid():
+        date = filter_form.cleaned_data['date']
+
+    if date:
+        title = _(u'balances for inventory: %(inventory)s as of: %(date)s') % {'inventory':inventory, 'date':date}
+    else:
+        title = _(u'current balances for inventory: %s') % inventory
+
+    return render_to_response('generic_detail.html', {
+        'object_name':_(u'inventory'),
+        'object':inventory,
+        'form':form,
+        'filter_form':filter_form,
+        'subtemplates_dict':[
+            {
+                'name':'generic_list_subtemplate.html',
+                'title':title,
+                'object_list':get_balances_list(inventory, date),
+                'main_object':'item_template',
+                'extra_columns':[{'name':_(u'quantity'),'attribute':'qty'}],
+            }
+        ]
+    },
+    context_instance=RequestContext(request))
+
+
 def inventory_list_transactions(request, object_id):
     inventory = get_object_or_404(Inventory, pk=object_id)
     form = InventoryForm_view(instance=inventory)
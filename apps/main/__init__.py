@@ -21,6 +21,7 @@ register_menu([
 
     {'text':_(u'tools'), 'view':'import_wizard', 'links': [
         {'text':_(u'import'), 'view':'import_wizard', 'famfam':'lightning_add'},
+        {'text':_(u'export'), 'view':'export_file', 'famfam':'lightning_go'},
     ],'famfam':'wrench', 'name':'tools','position':6},
 
     {'text':_(u'about'), 'view':'about', 'position':8},
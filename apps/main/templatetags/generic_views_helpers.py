@@ -4,6 +4,9 @@ from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.template.defaultfilters import stringfilter
 from django.template import Library, Node, Variable, VariableDoesNotExist
+from django.db.models.query import QuerySet
+
+from common.db import plan_list_queryset, prefetch_list_relations, get_keyset_page
 
 
 register = Library()
@@ -64,3 +67,74 @@ def return_attrib(obj, attrib, arguments={}):
 @register.filter
 def object_property(value, arg):
     return return_attrib(value, arg)
+
+
+
+def get_list_attributes(context):
+    attributes = [column['attribute'] for column in context.get('extra_columns') or []]
+    if context.get('main_object'):
+        attributes.append(context['main_object'])
+    return attributes
+
+
+class PlanObjectListNode(Node):
+    def render(self, context):
+        context['object_list'] = plan_list_queryset(context.get('object_list'), get_list_attributes(context))
+        return ''
+
+
+class PrefetchObjectListNode(Node):
+    def render(self, context):
+        if isinstance(context.get('object_list'), (QuerySet, list)):
+            context['object_list'] = prefetch_list_relations(context['object_list'], context.get('main_object'))
+        return ''
+
+
+class KeysetPaginateNode(Node):
+    def render(self, context):
+        request = context['request']
+        page = get_keyset_page(context['object_list'], request.GET.get('cursor'), getattr(settings, 'PAGINATION_DEFAULT_PAGINATION', 20))
+        if page is None:
+            return ''
+
+        def get_url(cursor):
+            if cursor:
+                query = request.GET.copy()
+                query['cursor'] = cursor
+                return '?%s' % query.urlencode()
+
+        context['object_list'] = page['object_list']
+        context['keyset_page'] = {
+            'next_url':get_url(page['next_cursor']),
+            'previous_url':get_url(page['previous_cursor']),
+        }
+        return ''
+
+
+@register.tag
+def plan_object_list(parser, token):
+    """
+    Joins the relations shown by the list to its object_list queryset,
+    to be used before paginating it
+    """
+    return PlanObjectListNode()
+
+
+@register.tag
+def prefetch_object_list(parser, token):
+    """
+    Fetches the registered relations of the page of object_list at once,
+    to be used after paginating it
+    """
+    return PrefetchObjectListNode()
+
+
+@register.tag
+def keyset_paginate(parser, token):
+    """
+    Replaces object_list with the page of the cursor in the request,
+    seeking on the ordering of the queryset instead of using OFFSET,
+    and sets keyset_page to its next and previous links.  Leaves
+    object_list alone if the queryset can't be paged this way
+    """
+    return KeysetPaginateNode()
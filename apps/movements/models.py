@@ -143,9 +143,9 @@ class PurchaseOrderItem(models.Model):
 
 
 register(PurchaseRequestStatus, _(u'purchase request status'), ['name'])
-register(PurchaseRequest, _(u'purchase request'), ['user_id', 'id', 'budget', 'required_date', 'status__name', 'originator'])
+register(PurchaseRequest, _(u'purchase request'), ['user_id', ('id', 10), 'budget', 'required_date', 'status__name', 'originator'])
 register(PurchaseRequestItem, _(u'purchase request item'), ['item_template__description', 'qty', 'notes'])
 register(PurchaseOrderStatus, _(u'purchase order status'), ['name'])
 register(PurchaseOrderItemStatus, _(u'purchase order item status'), ['name'])
-register(PurchaseOrder, _(u'purchase order'), ['user_id', 'id', 'required_date', 'status__name', 'supplier__name', 'notes'])
+register(PurchaseOrder, _(u'purchase order'), ['user_id', ('id', 10), 'required_date', 'status__name', 'supplier__name', 'notes'])
 register(PurchaseOrderItem, _(u'purchase order item'), ['item_template__description', 'qty'])
@@ -171,6 +171,8 @@ LOGIN_EXEMPT_URLS = (
 #INVENTORY_MAX_TEMPLATE_PHOTOS = 5
 #ASSETS_MAX_ASSET_PHOTOS = 5
 #ASSETS_MAX_PERSON_PHOTOS = 5
+#--------- Dynamic search --------------
+#DYNAMIC_SEARCH_BACKEND = 'dynamic_search.backends.index.InvertedIndexBackend'
 #--------- Pagination ------------------
 PAGINATION_DEFAULT_PAGINATION = 10
 #--------- Web theme app ---------------